@@ -1,54 +1,40 @@
-import os, datetime, subprocess, json, random, string, uuid
+import os, sys, re, datetime, logging, subprocess, json, random, string, uuid, threading, queue, time, shutil, bisect, tempfile, sqlite3, itertools, math, stat, mimetypes, hashlib, smtplib, contextlib, concurrent.futures
 from dotenv import load_dotenv 
 from flask import (
-    Flask, render_template, request, jsonify,
-    send_from_directory, make_response
+    Flask, Blueprint, render_template, request, jsonify,
+    send_file, make_response, redirect, g, Response, current_app
 )
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import FileWrapper
+from urllib.parse import quote as url_quote
 
-print("DEBUG: app.py is being loaded!")
+try:
+    import fcntl, resource
+except ImportError:  # Windows
+    fcntl = resource = None
 
 load_dotenv() 
 
-app = Flask(__name__) # Only one app = Flask(__name__) needed here
-
-# --- NEW: Explicit Logging Configuration ---
-import logging
-app.logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-if not app.logger.handlers:
-    app.logger.addHandler(handler)
-# --- END NEW Logging Configuration ---
-
-# --- App Configuration ---
-app.config.update(
-    # Hostname from your screenshot
-    MAIL_SERVER="smtpout.secureserver.net", 
-    
-    # Port from your screenshot
-    MAIL_PORT=465, 
-    
-    # Use SSL for port 465
-    MAIL_USE_SSL=True,
-    MAIL_USE_TLS=False,
-    
-    # These pull credentials from Render's environment
-    MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
-    MAIL_PASSWORD=os.getenv("MAIL_PASSWORD"),
-    
-    # "From" display on your emails
-    MAIL_DEFAULT_SENDER=("GrabScreen", os.getenv("MAIL_USERNAME")),
-)
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret")
-
-# --- App Initialization ---
-serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
+# Importing this module only defines things: no disk, database, SMTP or
+# ffmpeg access happens until something needs it. The directories and the
+# ffmpeg check run on the first request, the database is opened (and
+# migrated) by the first get_db() in each process, and the mailer is set up
+# when the first message is queued. That keeps worker boot and the cleanup
+# CLI fast, and makes `gunicorn --preload` safe: the master imports the code
+# and builds the app once, shared copy-on-write, and every worker opens its
+# own connections and threads after the fork.
+
+# Routes live on this blueprint; create_app() registers it. `app` (at the
+# bottom of the file) is the instance gunicorn, the CLI and the background
+# threads use.
+bp = Blueprint("grabscreen", __name__)
+mail = Mail()
+
+SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret")
 TOKEN_EXPIRY_SECONDS = 15 * 60
-mail = Mail(app)
 
 # --- Dynamic Path Configuration based on OS ---
 IS_WINDOWS = os.name == 'nt' # 'nt' for Windows, 'posix' for Linux/macOS
@@ -61,6 +47,7 @@ if IS_WINDOWS:
     # FFMPEG_DIR should be the path to the 'bin' folder containing ffmpeg.exe
     FFMPEG_DIR = "C:\\ffmpeg-7.1.1-essentials_build\\bin" # <--- e.g., "C:\\ffmpeg-7.0.2-full_build\\bin" (VERIFY!)
     FFMPEG_PATH = os.path.join(FFMPEG_DIR, "ffmpeg.exe") # Add .exe for Windows
+    FFPROBE_PATH = os.path.join(FFMPEG_DIR, "ffprobe.exe")
 else:
     # --- Paths for Linux/Render Deployment ---
     # RECDIR must point to your Render Persistent Disk mount path + a subdirectory for your files
@@ -68,56 +55,279 @@ else:
     # On Render, FFmpeg is usually installed system-wide (e.g., via apt-get).
     # If it's in the system's PATH, just "ffmpeg" is enough.
     FFMPEG_PATH = "ffmpeg" # Assumes 'ffmpeg' is in the system's PATH on Render
+    FFPROBE_PATH = "ffprobe" # Ships alongside ffmpeg in the same package
     # If you put a static ffmpeg build on the persistent disk, the path would be:
     # FFMPEG_PATH = "/var/data/ffmpeg-7.0.2-amd64-static/ffmpeg" 
     # (assuming you extracted 'ffmpeg-7.0.2-amd64-static' into /var/data/)
 
-#
-# --- REPLACE the old directory creation block with this new one ---
-#
+# Environment overrides, e.g. for benchmark.py's stub binaries.
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", FFMPEG_PATH)
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", FFPROBE_PATH)
 
 # --- Path for the subdirectory INSIDE the persistent disk ---
 # RECDIR is now /var/data/recordings
 RECDIR_SUBFOLDER = "recordings" 
-RECDIR = os.path.join("/var/data", RECDIR_SUBFOLDER)
+RECDIR = os.getenv("RECDIR", os.path.join("/var/data", RECDIR_SUBFOLDER))
 
 # Define the MP4 directory path based on the new RECDIR
 MP4_DIR = os.path.join(RECDIR, "mp4_converted")
 
-# --- Safer Directory Creation ---
-# This code will only run if the app is NOT in cleanup mode,
-# and it creates the subdirectories correctly without touching /var/data itself.
-
-import sys
-# Only try to create directories if we are NOT running the cleanup command
-if 'cleanup' not in sys.argv:
-    try:
-        # Create the 'recordings' subdirectory inside /var/data
-        os.makedirs(RECDIR, exist_ok=True)
-        # Create the 'mp4_converted' subdirectory inside /var/data/recordings
-        os.makedirs(MP4_DIR, exist_ok=True)
-        app.logger.info(f"Successfully ensured directories exist: {RECDIR} and {MP4_DIR}")
-    except PermissionError:
-        app.logger.error("FATAL: Permission denied to create directories inside /var/data. Check your Render disk setup.")
-    except Exception as e:
-        app.logger.error(f"FATAL: Could not create directories. Error: {e}")
+_initialized = False
+_init_lock = threading.Lock()
+
+def initialize():
+    """Creates the recording directories and checks ffmpeg, once per process.
+
+    Runs before the first request rather than at import, so the cleanup CLI
+    never touches /var/data itself. Needs an app context.
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        try:
+            # Create the 'recordings' subdirectory inside /var/data
+            os.makedirs(RECDIR, exist_ok=True)
+            # Create the 'mp4_converted' subdirectory inside /var/data/recordings
+            os.makedirs(MP4_DIR, exist_ok=True)
+            current_app.logger.info(f"Successfully ensured directories exist: {RECDIR} and {MP4_DIR}")
+        except PermissionError:
+            current_app.logger.error("FATAL: Permission denied to create directories inside /var/data. Check your Render disk setup.")
+        except Exception as e:
+            current_app.logger.error(f"FATAL: Could not create directories. Error: {e}")
+
+        # --- FFmpeg Path Verification (for better debugging) ---
+        # This check is more effective for absolute paths.
+        # If FFMPEG_PATH is just "ffmpeg", os.path.exists will return False, which is fine
+        # because subprocess.run will search the system's PATH.
+        if os.path.isabs(FFMPEG_PATH) and not os.path.exists(FFMPEG_PATH):
+            current_app.logger.error(f"FATAL ERROR: FFmpeg executable not found at '{FFMPEG_PATH}'. Please verify the path and installation steps for this environment.")
+        elif not os.path.isabs(FFMPEG_PATH):
+            current_app.logger.info(f"FFmpeg path '{FFMPEG_PATH}' is relative/assumed in PATH. Not performing direct file existence check.")
+
+        # Mail queued before a restart would otherwise wait for the next queue_mail().
+        try:
+            if mail_configured() and get_db().execute("SELECT 1 FROM outbox WHERE state = 'pending' LIMIT 1").fetchone():
+                _ensure_outbox_sender(current_app._get_current_object())
+        except sqlite3.Error as e:
+            current_app.logger.error(f"Could not read the outbox: {e}")
+        _initialized = True
 
-# --- FFmpeg Path Verification (for better debugging) ---
-# This check is more effective for absolute paths.
-# If FFMPEG_PATH is just "ffmpeg", os.path.exists will return False, which is fine
-# because subprocess.run will search the system's PATH.
-if os.path.isabs(FFMPEG_PATH) and not os.path.exists(FFMPEG_PATH):
-    app.logger.error(f"FATAL ERROR: FFmpeg executable not found at '{FFMPEG_PATH}'. Please verify the path and installation steps for this environment.")
-elif not os.path.isabs(FFMPEG_PATH):
-    app.logger.info(f"FFmpeg path '{FFMPEG_PATH}' is relative/assumed in PATH. Not performing direct file existence check.")
 
+UPLOAD_DIR = os.path.join(RECDIR, ".uploads")
+UPLOAD_BUFFER_SIZE = 1024 * 1024  # 1 MiB reads/writes for incoming video data
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+UPLOAD_ID_RE = re.compile(r"[0-9a-f]{32}")
 
 LINKS_FILE = "public_links.json"
 SESSIONS_FILE = "user_sessions.json"
 PRO_WAITLIST_FILE = "pro_waitlist.txt" 
 
+# ─────────────────────────────────────────────────────────
+# Metrics
+# ─────────────────────────────────────────────────────────
+# A small in-process registry of counters and histograms, exposed in the
+# Prometheus text format at /metrics. Recording a sample is a dict update
+# under a lock. Each worker process writes a snapshot to METRICS_DIR at
+# most every METRICS_FLUSH_SECONDS (piggybacking on requests), and /metrics
+# merges every snapshot, so a scrape sees the whole instance whichever
+# worker answers it. Gauges are computed at scrape time and only taken from
+# processes that are still alive.
+
+METRICS_DIR = os.path.join(RECDIR, ".metrics")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "15"))
+METRICS_DISK_USAGE_SECONDS = 60
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FFMPEG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "grabscreen_http_request_duration_seconds": ("histogram", "Time to build a response, by endpoint.", LATENCY_BUCKETS),
+    "grabscreen_upload_bytes_total": ("counter", "Bytes of video received.", None),
+    "grabscreen_upload_throughput_bytes_per_second": ("histogram", "Receive rate of each upload request.", THROUGHPUT_BUCKETS),
+    "grabscreen_ffmpeg_runs_total": ("counter", "ffmpeg/ffprobe runs by operation and outcome.", None),
+    "grabscreen_ffmpeg_wall_seconds": ("histogram", "Wall-clock time of ffmpeg/ffprobe runs.", FFMPEG_BUCKETS),
+    "grabscreen_ffmpeg_cpu_seconds_total": ("counter", "User+system CPU time used by ffmpeg/ffprobe.", None),
+    "grabscreen_ffmpeg_slot_wait_seconds": ("histogram", "Time spent waiting for an ffmpeg slot.", LATENCY_BUCKETS),
+    "grabscreen_admission_rejections_total": ("counter", "Requests turned away by admission control.", None),
+    "grabscreen_cache_lookups_total": ("counter", "Derived-artifact cache lookups by kind and result.", None),
+    "grabscreen_store_operations_total": ("counter", "Metadata store statements/file accesses.", None),
+    "grabscreen_outbox_messages_total": ("counter", "Outbox messages queued, sent, retried or given up on.", None),
+    "grabscreen_jobs": ("gauge", "Background jobs by kind and state.", None),
+    "grabscreen_disk_bytes": ("gauge", "Bytes on disk by storage area.", None),
+    "grabscreen_filesystem_bytes": ("gauge", "Size and free space of the RECDIR filesystem.", None),
+}
+
+_metrics_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [count per bucket..., count, sum]
+_metrics_flushed = 0.0
+_disk_usage_cache = (0.0, [])
+
+def endpoint_label():
+    # Without the blueprint prefix, so the series keep their names.
+    return (request.endpoint or "unmatched").rpartition(".")[2]
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = (name, _label_key(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    key = (name, _label_key(labels))
+    with _metrics_lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * (len(buckets) + 2)
+        series[bisect.bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+def _metrics_snapshot():
+    gauges = _process_gauges()
+    with _metrics_lock:
+        return {
+            "pid": os.getpid(),
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, list(labels), list(series)] for (name, labels), series in _histograms.items()],
+            "gauges": gauges,
+        }
+
+def flush_metrics(force=False):
+    """Writes this process's snapshot for /metrics to merge. Cheap to call often."""
+    global _metrics_flushed
+    now = time.time()
+    if not force and now - _metrics_flushed < METRICS_FLUSH_SECONDS:
+        return
+    _metrics_flushed = now
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(_metrics_snapshot(), f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        app.logger.warning(f"Could not write metrics snapshot: {e}")
+
+def _pid_alive(pid):
+    if IS_WINDOWS:
+        # os.kill() would terminate the process there.
+        return pid == os.getpid()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def _process_gauges():
+    counts = {}
+    with _jobs_lock:
+        for job in jobs.values():
+            if job["state"] in (JOB_QUEUED, JOB_RUNNING):
+                key = ("grabscreen_jobs", (("kind", job["kind"]), ("state", job["state"])))
+                counts[key] = counts.get(key, 0) + 1
+    return [[name, list(labels), value] for (name, labels), value in counts.items()]
+
+def _disk_usage_gauges():
+    """Bytes per storage area, walked at most once per METRICS_DISK_USAGE_SECONDS."""
+    global _disk_usage_cache
+    checked, gauges = _disk_usage_cache
+    if time.time() - checked < METRICS_DISK_USAGE_SECONDS:
+        return gauges
+    areas = {".blobs": "recordings", os.path.basename(MP4_DIR): "mp4", os.path.basename(HLS_DIR): "hls",
+             os.path.basename(PREVIEW_DIR): "previews", os.path.basename(UPLOAD_DIR): "uploads"}
+    totals = {}
+    for entry in os.scandir(RECDIR):
+        area = areas.get(entry.name, "other")
+        if entry.is_dir(follow_symlinks=False):
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry.path) for f in files)
+        else:
+            st = entry.stat(follow_symlinks=False)
+            # Names linked to a blob are already counted under .blobs.
+            size = st.st_size if st.st_nlink == 1 else 0
+            area = "recordings" if entry.name.endswith(".webm") else area
+        totals[area] = totals.get(area, 0) + size
+    usage = shutil.disk_usage(RECDIR)
+    gauges = [["grabscreen_disk_bytes", [["area", area]], size] for area, size in totals.items()]
+    gauges += [["grabscreen_filesystem_bytes", [["kind", "total"]], usage.total],
+               ["grabscreen_filesystem_bytes", [["kind", "free"]], usage.free]]
+    _disk_usage_cache = (time.time(), gauges)
+    return gauges
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def render_metrics():
+    """Merges every worker's snapshot into Prometheus text exposition format."""
+    flush_metrics(force=True)
+    counters, histograms, gauges = {}, {}, {}
+    for entry in os.scandir(METRICS_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            with open(entry.path) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snap["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, series in snap["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [0] * len(series))
+            for i, value in enumerate(series):
+                merged[i] += value
+        if _pid_alive(snap["pid"]):
+            for name, labels, value in snap["gauges"]:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+    for name, labels, value in _disk_usage_gauges():
+        gauges[(name, tuple(map(tuple, labels)))] = value
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for (series_name, labels), value in sorted({**counters, **gauges}.items()):
+            if series_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (series_name, labels), series in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], series):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {series[-1]}")
+    return "\n".join(lines) + "\n"
+
+def prune_metrics_snapshots(max_age=24 * 60 * 60):
+    """Drops snapshots of workers that exited long ago (their counters reset, like a restart)."""
+    if not os.path.isdir(METRICS_DIR):
+        return 0
+    removed = 0
+    for entry in os.scandir(METRICS_DIR):
+        pid = entry.name.split(".")[0]
+        if pid.isdigit() and not _pid_alive(int(pid)) and entry.stat().st_mtime < time.time() - max_age:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
 # --- Helper Functions ---
 def load_json(file_path):
+    inc("grabscreen_store_operations_total", store="json", op="read")
     if os.path.exists(file_path):
         with open(file_path, "r") as f:
             try:
@@ -128,156 +338,2787 @@ def load_json(file_path):
     return {}
 
 def save_json(data, file_path):
+    inc("grabscreen_store_operations_total", store="json", op="write")
     with open(file_path, "w") as f:
         json.dump(data, f, indent=2)
 
-public_links = load_json(LINKS_FILE)
-user_sessions = load_json(SESSIONS_FILE)
+# ─────────────────────────────────────────────────────────
+# Metadata Store (SQLite)
+# ─────────────────────────────────────────────────────────
+# Sessions, recordings, public links, derived artifacts and jobs live in one SQLite
+# database in WAL mode, so every gunicorn worker reads the same state and each
+# lookup is an indexed query instead of a parse of a whole JSON file. The old
+# JSON files are imported once, the first time the database is opened.
+
+# On the persistent disk next to RECDIR, not in the app checkout: a redeploy
+# replaces the checkout, and the index must outlive it like the files do.
+DB_FILE = os.getenv("DB_FILE", os.path.join(os.path.dirname(RECDIR), "grabscreen.db"))
+
+# Seconds a recording (and everything derived from it) is kept; None = forever.
+RETENTION_POLICIES = {
+    "default": 24 * 60 * 60,
+    "pro": 30 * 24 * 60 * 60,
+    "pinned": None,
+}
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recordings (
+    filename TEXT PRIMARY KEY,
+    token TEXT,
+    created REAL NOT NULL,
+    retention TEXT NOT NULL DEFAULT 'default',
+    expires_at REAL,
+    content_hash TEXT,
+    derived_key TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_by_token ON recordings (token, created);
+CREATE INDEX IF NOT EXISTS recordings_by_expiry ON recordings (expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS recordings_by_hash ON recordings (content_hash);
+CREATE INDEX IF NOT EXISTS recordings_by_derivation ON recordings (derived_key) WHERE derived_key IS NOT NULL;
+CREATE TABLE IF NOT EXISTS public_links (
+    token TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    created REAL NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS public_links_by_file ON public_links (filename, created);
+CREATE INDEX IF NOT EXISTS public_links_by_expiry ON public_links (expires_at) WHERE expires_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_access REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_source ON artifacts (source);
+CREATE INDEX IF NOT EXISTS artifacts_by_recency ON artifacts (pinned, last_access);
+CREATE TABLE IF NOT EXISTS probes (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    probed_at REAL NOT NULL,
+    info TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cache_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    message TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claim TEXT,
+    claimed_until REAL,
+    last_error TEXT,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    priority INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (kind, filename) WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_by_filename ON jobs (filename, state);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# Under gevent a blocked SQLite call blocks every greenlet in the worker, so
+# a writer waits at most this long for the lock before failing.
+DB_BUSY_TIMEOUT_SECONDS = float(os.getenv("DB_BUSY_TIMEOUT_SECONDS", "2"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))   # idle connections kept per process
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+_db_pool = []        # idle connections of this process
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+class _CountingConnection(sqlite3.Connection):
+    """Counts statements by kind for grabscreen_store_operations_total."""
+    def execute(self, sql, *args):
+        op = "read" if sql.lstrip()[:6].upper() in ("SELECT", "PRAGMA") else "write"
+        inc("grabscreen_store_operations_total", store="sqlite", op=op)
+        return super().execute(sql, *args)
+
+def _connect_db():
+    os.makedirs(os.path.dirname(os.path.abspath(DB_FILE)), exist_ok=True)
+    # Pooled connections move between threads, but only one uses them at a time.
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_SECONDS, factory=_CountingConnection,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _migrate_json_files(conn):
+    """One-time import of user_sessions.json / public_links.json."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    now = time.time()
+    sessions = load_json(SESSIONS_FILE)
+    links = load_json(LINKS_FILE)
+    with conn:
+        for token, files in sessions.items():
+            conn.execute("INSERT OR IGNORE INTO sessions (token, created) VALUES (?, ?)", (token, now))
+            for i, fname in enumerate(files):
+                # Keep the original list order within each session.
+                conn.execute("INSERT OR REPLACE INTO recordings (filename, token, created) VALUES (?, ?, ?)",
+                             (fname, token, now + i * 1e-6))
+        for token, fname in links.items():
+            conn.execute("INSERT OR IGNORE INTO public_links (token, filename, created) VALUES (?, ?, ?)",
+                         (token, fname, now))
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
+    if sessions or links:
+        app.logger.info(f"Migrated {len(sessions)} sessions and {len(links)} public links from JSON into {DB_FILE}")
+
+def _backfill_expiry(conn):
+    """Gives recordings indexed before retention existed their default expiry."""
+    with conn:
+        conn.execute("UPDATE recordings SET expires_at = created + ? WHERE expires_at IS NULL AND retention = 'default'",
+                     (RETENTION_POLICIES["default"],))
+
+def get_db():
+    """Returns this thread's connection, creating the schema on first use.
+
+    Under gevent workers threading.local is per greenlet, so each request
+    gets its own connection and transactions never interleave. Requests
+    take it from a per-process pool and hand it back in release_db(), so
+    only the first DB_POOL_SIZE concurrent requests pay for connecting;
+    long-lived threads (job workers, the mail sender) keep theirs.
+    """
+    global _db_initialized, _db_pool_pid
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and getattr(_db_local, "pid", None) == os.getpid():
+        return conn
+    with _db_pool_lock:
+        if _db_pool_pid != os.getpid():
+            _db_pool.clear()   # the parent's, inherited over a fork
+            _db_pool_pid = os.getpid()
+        conn = _db_pool.pop() if _db_pool else None
+    conn = conn or _connect_db()
+    _db_local.conn, _db_local.pid = conn, os.getpid()
+    if not _db_initialized:
+        with _db_init_lock:
+            if not _db_initialized:
+                conn.executescript(DB_SCHEMA)
+                _migrate_json_files(conn)
+                _backfill_expiry(conn)
+                _db_initialized = True
+    return conn
+
+def release_db():
+    """Returns this thread's connection to the pool (or closes it if the pool is full)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        return
+    _db_local.conn = None
+    if _db_local.pid != os.getpid():
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if _db_pool_pid == os.getpid() and len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+def session_exists(token):
+    return bool(token) and get_db().execute("SELECT 1 FROM sessions WHERE token = ?", (token,)).fetchone() is not None
+
+def create_session():
+    token = uuid.uuid4().hex[:16]
+    with get_db() as db:
+        db.execute("INSERT INTO sessions (token, created) VALUES (?, ?)", (token, time.time()))
+    return token
+
+def forget_session_token(token):
+    with get_db() as db:
+        db.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        db.execute("UPDATE recordings SET token = NULL WHERE token = ?", (token,))
+
+def add_recording(fname, token=None, retention="default", content_hash=None, derived_key=None):
+    now = time.time()
+    keep = RETENTION_POLICIES[retention]
+    with get_db() as db:
+        db.execute("INSERT OR REPLACE INTO recordings (filename, token, created, retention, expires_at, content_hash, derived_key) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (fname, token, now, retention, now + keep if keep else None, content_hash, derived_key))
+
+def set_retention(fname, retention):
+    """Switches fname to another retention policy, counted from when it was created."""
+    keep = RETENTION_POLICIES[retention]
+    with get_db() as db:
+        updated = db.execute("UPDATE recordings SET retention = ?, expires_at = CASE WHEN ? IS NULL THEN NULL ELSE created + ? END "
+                             "WHERE filename = ?", (retention, keep, keep, fname)).rowcount
+    row = get_db().execute("SELECT content_hash FROM recordings WHERE filename = ?", (fname,)).fetchone()
+    if row and row["content_hash"]:
+        sync_artifact_pins(row["content_hash"])
+    return updated
+
+def session_recordings(token):
+    rows = get_db().execute("SELECT filename FROM recordings WHERE token = ? ORDER BY created", (token,))
+    return [row["filename"] for row in rows]
+
+def remove_recordings(filenames):
+    with get_db() as db:
+        db.executemany("DELETE FROM recordings WHERE filename = ?", [(f,) for f in filenames])
+
+# public_links is the bidirectional token <-> filename index: the primary key
+# answers /public/<token>, and public_links_by_file answers "which links does
+# this recording have" without scanning. A file may have several links, each
+# with its own optional expiry.
+
+def link_token_for(fname):
+    """Returns a live link token for fname, preferring links that never expire."""
+    row = get_db().execute(
+        "SELECT token FROM public_links WHERE filename = ? AND (expires_at IS NULL OR expires_at > ?) "
+        "ORDER BY expires_at IS NOT NULL, created DESC LIMIT 1", (fname, time.time())).fetchone()
+    return row["token"] if row else None
+
+def links_for(fname):
+    rows = get_db().execute(
+        "SELECT token, created, expires_at FROM public_links WHERE filename = ? AND (expires_at IS NULL OR expires_at > ?) "
+        "ORDER BY created", (fname, time.time()))
+    return [dict(row) for row in rows]
+
+def create_public_link(fname, expires_in=None):
+    token = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    now = time.time()
+    expires_at = now + expires_in if expires_in else None
+    with get_db() as db:
+        db.execute("INSERT INTO public_links (token, filename, created, expires_at) VALUES (?, ?, ?, ?)",
+                   (token, fname, now, expires_at))
+    return token
+
+def resolve_public_link(token):
+    row = get_db().execute(
+        "SELECT filename FROM public_links WHERE token = ? AND (expires_at IS NULL OR expires_at > ?)",
+        (token, time.time())).fetchone()
+    return row["filename"] if row else None
+
+def delete_public_links(fname, token=None):
+    """Removes the given link (or every link) to fname and returns how many were removed."""
+    with get_db() as db:
+        if token:
+            return db.execute("DELETE FROM public_links WHERE filename = ? AND token = ?", (fname, token)).rowcount
+        return db.execute("DELETE FROM public_links WHERE filename = ?", (fname,)).rowcount
+
+def purge_expired_links():
+    with get_db() as db:
+        return db.execute("DELETE FROM public_links WHERE expires_at <= ?", (time.time(),)).rowcount
+
+# ─────────────────────────────────────────────────────────
+# Derived Artifact Cache
+# ─────────────────────────────────────────────────────────
+# Converted MP4s (and anything else derived from a recording) are cache
+# entries in the artifacts table. Total unpinned size is kept under
+# ARTIFACT_CACHE_BYTES by evicting the least recently (LRU) or least
+# frequently (LFU) used entries. Recordings and clips themselves are never
+# artifacts, so eviction can't touch them. Files derived from a recording on
+# the "pinned" retention policy are pinned too: kept forever, like it.
+
+ARTIFACT_CACHE_BYTES = int(os.getenv("ARTIFACT_CACHE_BYTES", str(5 * 1024 ** 3)))
+ARTIFACT_CACHE_POLICY = os.getenv("ARTIFACT_CACHE_POLICY", "lru").lower()
+ARTIFACT_EVICTION_ORDER = {
+    "lru": "last_access",
+    "lfu": "hits, last_access",
+}
+
+# An artifact is either a single file or a directory of files (e.g. an HLS
+# rendition set). Directories only count as present once their producer has
+# written ARTIFACT_COMPLETE_MARKER into them.
+ARTIFACT_COMPLETE_MARKER = ".complete"
+
+def _artifact_present(path):
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, ARTIFACT_COMPLETE_MARKER))
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def _artifact_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def remove_artifact_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+# Directory artifacts are wiped and rewritten in place (HLS is served while it
+# is packaged), so builds of the same path take a flock on a file here.
+ARTIFACT_LOCK_DIR = os.path.join(RECDIR, ".locks")
+_local_artifact_locks = {}   # path -> threading.Lock, where flock is unavailable
+_local_artifact_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def artifact_build_lock(path):
+    """Held while (re)building the artifact at path, so two workers never write it at once."""
+    if fcntl is None:
+        with _local_artifact_locks_guard:
+            lock = _local_artifact_locks.setdefault(path, threading.Lock())
+        with lock:
+            yield
+        return
+    os.makedirs(ARTIFACT_LOCK_DIR, exist_ok=True)
+    lock_path = os.path.join(ARTIFACT_LOCK_DIR, hashlib.sha1(path.encode()).hexdigest() + ".lock")
+    while True:
+        with open(lock_path, "a") as f:   # closing it drops the flock
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(0.1)   # polled, like the ffmpeg slots, so a gevent worker keeps serving
+            # The reindex sweep may have deleted the file between our open()
+            # and flock(), and then someone else can lock a new one under the
+            # same name. Only a lock on the file that's still there counts.
+            try:
+                current = os.stat(lock_path)
+            except FileNotFoundError:
+                continue
+            if not os.path.samestat(current, os.fstat(f.fileno())):
+                continue
+            os.utime(lock_path)   # the sweep only removes lock files unused for a day
+            yield
+            return
+
+def _bump_cache_stat(name, amount=1):
+    with get_db() as db:
+        db.execute("INSERT INTO cache_stats (name, value) VALUES (?, ?) "
+                   "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, amount))
+
+_PINNED_SOURCE_SQL = "EXISTS (SELECT 1 FROM recordings WHERE content_hash = ? AND retention = 'pinned')"
+
+def register_artifact(source, kind, path):
+    size = _artifact_size(path)
+    now = time.time()
+    with get_db() as db:
+        db.execute("INSERT OR REPLACE INTO artifacts (path, source, kind, size, created, last_access, hits, pinned) "
+                   f"VALUES (?, ?, ?, ?, ?, ?, 0, {_PINNED_SOURCE_SQL})", (path, source, kind, size, now, now, source))
+    enforce_cache_budget(keep=path)
+
+def sync_artifact_pins(source):
+    """Re-derives `pinned` for source's artifacts after its recordings' retention changed."""
+    with get_db() as db:
+        db.execute(f"UPDATE artifacts SET pinned = {_PINNED_SOURCE_SQL} WHERE source = ?", (source, source))
+
+def cache_lookup(source, kind, path, record=True):
+    """True if the derived file at `path` is present. Hits refresh its recency."""
+    db = get_db()
+    row = db.execute("SELECT size FROM artifacts WHERE path = ?", (path,)).fetchone()
+    present = _artifact_present(path)
+    if row and not present:
+        with db:
+            db.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+    elif present and not row:
+        # Produced before the cache existed; adopt it rather than re-transcoding.
+        register_artifact(source, kind, path)
+    if record:
+        if present:
+            with db:
+                db.execute("UPDATE artifacts SET last_access = ?, hits = hits + 1 WHERE path = ?", (time.time(), path))
+        _bump_cache_stat("hits" if present else "misses")
+        inc("grabscreen_cache_lookups_total", kind=kind, result="hit" if present else "miss")
+    return present
+
+def is_cached_artifact(path):
+    return get_db().execute("SELECT 1 FROM artifacts WHERE path = ?", (path,)).fetchone() is not None
+
+def enforce_cache_budget(budget=None, keep=None):
+    """Evicts unpinned artifacts until they fit in `budget` bytes. Returns the number evicted."""
+    budget = ARTIFACT_CACHE_BYTES if budget is None else budget
+    order = ARTIFACT_EVICTION_ORDER.get(ARTIFACT_CACHE_POLICY, ARTIFACT_EVICTION_ORDER["lru"])
+    db = get_db()
+    used = db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE pinned = 0").fetchone()[0]
+    evicted = 0
+    while used > budget:
+        victims = db.execute(f"SELECT path, size FROM artifacts WHERE pinned = 0 AND path != ? ORDER BY {order} LIMIT 32",
+                             (keep or "",)).fetchall()
+        if not victims:
+            break
+        for victim in victims:
+            if used <= budget:
+                break
+            try:
+                remove_artifact_path(victim["path"])
+            except OSError as e:
+                app.logger.warning(f"Could not evict cached artifact {victim['path']}: {e}")
+                continue
+            with db:
+                db.execute("DELETE FROM artifacts WHERE path = ?", (victim["path"],))
+            used -= victim["size"]
+            evicted += 1
+            app.logger.info(f"Evicted cached artifact {victim['path']} ({victim['size']} bytes)")
+    if evicted:
+        _bump_cache_stat("evictions", evicted)
+    return evicted
+
+def cache_stats():
+    db = get_db()
+    stats = {row["name"]: row["value"] for row in db.execute("SELECT name, value FROM cache_stats")}
+    usage = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(CASE WHEN pinned = 0 THEN size END), 0) "
+                       "FROM artifacts").fetchone()
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    return {
+        "policy": ARTIFACT_CACHE_POLICY,
+        "budget_bytes": ARTIFACT_CACHE_BYTES,
+        "entries": usage[0],
+        "bytes": usage[1],
+        "evictable_bytes": usage[2],
+        "hits": hits,
+        "misses": misses,
+        "evictions": stats.get("evictions", 0),
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+    }
+
+def artifacts_for(source):
+    return [dict(row) for row in get_db().execute("SELECT * FROM artifacts WHERE source = ?", (source,))]
+
+def forget_artifacts(source):
+    with get_db() as db:
+        db.execute("DELETE FROM artifacts WHERE source = ?", (source,))
+
+# ─────────────────────────────────────────────────────────
+# Content-Addressed Storage
+# ─────────────────────────────────────────────────────────
+# Recording bytes are stored once, in BLOB_DIR under their SHA-256 (sharded
+# two levels deep). The names in RECDIR that routes serve are hard links to
+# those blobs, so a duplicate upload or clip costs a directory entry rather
+# than a second copy. A blob's reference count is the number of recordings
+# rows pointing at it, and purge_recording() drops the blob with its last
+# reference. Derived files are keyed by source hash + encoding parameters,
+# so converting the same content the same way is a cache hit whichever name
+# asked for it.
+
+BLOB_DIR = os.path.join(RECDIR, ".blobs")
+CONTENT_HASH_RE = re.compile(r"[0-9a-f]{64}")
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], f"{digest}.webm")
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_BUFFER_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def copy_hashing(src, dst, length=UPLOAD_BUFFER_SIZE):
+    """shutil.copyfileobj() that returns the SHA-256 of everything copied."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: src.read(length), b""):
+        h.update(chunk)
+        dst.write(chunk)
+    return h.hexdigest()
+
+def _link_blob(digest, dst):
+    # Link under a temp name and rename, so dst is never missing or partial.
+    tmp = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        os.link(blob_path(digest), tmp)
+    except OSError:
+        # No hard links on this filesystem: dedup then only saves transcodes.
+        shutil.copyfile(blob_path(digest), tmp)
+    os.replace(tmp, dst)
+
+def _store_blob(path, digest, move=True):
+    """Puts the file at path into the blob store unless the blob exists. Returns True for a duplicate."""
+    target = blob_path(digest)
+    if os.path.exists(target):
+        return True
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if move:
+        os.replace(path, target)
+    else:
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+    return False
+
+def store_recording(tmp_path, digest, fname):
+    """Moves a finished upload or clip into the blob store and links it into RECDIR as fname.
+
+    Returns True if the content was already stored (tmp_path is discarded).
+    """
+    duplicate = _store_blob(tmp_path, digest)
+    if duplicate:
+        os.remove(tmp_path)
+    _link_blob(digest, os.path.join(RECDIR, fname))
+    return duplicate
+
+def content_hash_for(fname):
+    """SHA-256 of a recording. Files from before the blob store are adopted on first use."""
+    row = get_db().execute("SELECT content_hash FROM recordings WHERE filename = ?", (fname,)).fetchone()
+    if row and row["content_hash"]:
+        return row["content_hash"]
+    path = os.path.join(RECDIR, fname)
+    if not os.path.isfile(path):
+        return None
+    digest = hash_file(path)
+    if _store_blob(path, digest, move=False):
+        _link_blob(digest, path)
+    if row:
+        with get_db() as db:
+            db.execute("UPDATE recordings SET content_hash = ? WHERE filename = ?", (digest, fname))
+    else:
+        add_recording(fname, content_hash=digest)
+    return digest
+
+def blob_refcount(digest):
+    return get_db().execute("SELECT COUNT(*) FROM recordings WHERE content_hash = ?", (digest,)).fetchone()[0]
+
+def find_derived_recording(derived_key):
+    """Content hash of an existing recording produced the same way (e.g. an identical clip), if any."""
+    row = get_db().execute("SELECT content_hash FROM recordings WHERE derived_key = ? AND content_hash IS NOT NULL LIMIT 1",
+                           (derived_key,)).fetchone()
+    return row["content_hash"] if row and os.path.exists(blob_path(row["content_hash"])) else None
+
+def derived_path(root, fname, params, ext=""):
+    """Where the output of processing fname with params lives under root."""
+    digest = content_hash_for(fname) or os.path.splitext(fname)[0]
+    variant = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(root, digest[:2], f"{digest}-{variant}{ext}")
+
+def blob_paths(digest):
+    """The blob and every artifact derived from it."""
+    return [blob_path(digest)] + [artifact["path"] for artifact in artifacts_for(digest)]
+
+def purge_blob(digest):
+    for path in blob_paths(digest):
+        remove_artifact_path(path)
+    forget_artifacts(digest)
 
 #cleanup_old_files
 
-def cleanup_old_files():
-    """Deletes files older than 24 hours from recordings and converted folders."""
-    app.logger.info("--- [CRON] Running scheduled cleanup task ---")
-    now = datetime.datetime.now()
-    # Files created more than 24 hours ago will be deleted
-    cutoff = now - datetime.timedelta(hours=24)
-    
-    deleted_count = 0
-    
-    # List of directories to clean up
-    directories_to_clean = [RECDIR, MP4_DIR]
-    
-    for directory in directories_to_clean:
+# ─────────────────────────────────────────────────────────
+# Retention & Cleanup
+# ─────────────────────────────────────────────────────────
+# Every recording has an expires_at from its retention policy, indexed in
+# recordings_by_expiry. The cron job walks that index from the oldest entry
+# and stops at the first one that hasn't expired, so a run costs O(expired)
+# rather than a stat of every file on the disk. purge_recording() removes a
+# recording together with everything hanging off it; shared blobs and their
+# derived files stay until their last reference goes. What the index can't
+# see (files it never tracked, leftovers of crashed jobs) is swept by age,
+# but only by `cleanup --reindex`: the cron only lists UPLOAD_DIR.
+
+CLEANUP_BATCH_SIZE = 500
+UPLOAD_STALE_SECONDS = 24 * 60 * 60
+
+def purge_recording(fname, dry_run=False):
+    """Deletes a recording, its derived files, probe, session entry and links.
+
+    Returns the paths removed (or that would be removed, with dry_run).
+    """
+    row = get_db().execute("SELECT content_hash FROM recordings WHERE filename = ?", (fname,)).fetchone()
+    digest = row["content_hash"] if row else None
+    last_reference = digest is not None and blob_refcount(digest) <= 1
+    stem = os.path.splitext(fname)[0]
+    # Name-keyed derived files are from before the blob store.
+    candidates = [os.path.join(RECDIR, fname), os.path.join(MP4_DIR, f"{stem}.mp4"),
+                  os.path.join(HLS_DIR, stem), os.path.join(PREVIEW_DIR, stem)]
+    candidates += [artifact["path"] for artifact in artifacts_for(fname)]
+    if last_reference:
+        candidates += blob_paths(digest)
+    paths = [p for p in dict.fromkeys(candidates) if os.path.exists(p)]
+    if dry_run:
+        return paths
+
+    cancel_jobs_for(fname)
+    for path in paths:
+        remove_artifact_path(path)
+    remove_recordings([fname])
+    delete_public_links(fname)
+    forget_artifacts(fname)
+    if last_reference:
+        forget_artifacts(digest)
+    elif digest:
+        sync_artifact_pins(digest)
+    forget_probe(fname)
+    return paths
+
+def expired_recordings(now=None, limit=CLEANUP_BATCH_SIZE, after=None):
+    rows = get_db().execute(
+        "SELECT filename, expires_at FROM recordings WHERE expires_at <= ? AND (? IS NULL OR expires_at > ?) "
+        "ORDER BY expires_at LIMIT ?", (now or time.time(), after, after, limit))
+    return [dict(row) for row in rows]
+
+def _reclaimable_bytes(paths):
+    """Bytes freed by deleting paths. A hard-linked file only counts once all its links go."""
+    total, inodes = 0, {}
+    for path in paths:
+        if os.path.isdir(path):
+            total += _artifact_size(path)
+        elif os.path.exists(path):
+            st = os.stat(path)
+            inodes.setdefault((st.st_dev, st.st_ino), [st, 0])[1] += 1
+    return total + sum(st.st_size for st, links in inodes.values() if links >= st.st_nlink)
+
+def cleanup_old_files(dry_run=False):
+    """Purges expired recordings (and everything derived from them) via the expiry index."""
+    app.logger.info(f"--- [CRON] Running scheduled cleanup task{' (dry run)' if dry_run else ''} ---")
+    now = time.time()
+    report = {"dry_run": dry_run, "recordings": [], "files": 0, "bytes": 0, "links": 0, "stale_uploads": 0}
+
+    # Abandoned chunked uploads and streamed conversions. This directory only
+    # holds in-flight work, so it's cheap to list. Everything else the expiry
+    # index can't reach is left to `cleanup --reindex`.
+    if os.path.isdir(UPLOAD_DIR):
+        stale = [e.path for e in os.scandir(UPLOAD_DIR)
+                 if e.is_file() and e.stat().st_mtime < now - UPLOAD_STALE_SECONDS]
+        report["stale_uploads"] = len(stale)
+        report["bytes"] += _reclaimable_bytes(stale)
+        if not dry_run:
+            for path in stale:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    app.logger.error(f"[CRON] Error removing {path}: {e}")
+            app.logger.info(f"[CRON] Cleanup: Removed {len(stale)} abandoned uploads.")
+
+    after = None
+    while True:
+        batch = expired_recordings(now, after=after if dry_run else None)
+        if not batch:
+            break
+        for row in batch:
+            fname = row["filename"]
+            try:
+                report["links"] += len(links_for(fname))
+                paths = purge_recording(fname, dry_run=True)
+                report["bytes"] += _reclaimable_bytes(paths)
+                if not dry_run:
+                    paths = purge_recording(fname)
+                    app.logger.info(f"[CRON] Cleanup: Purged {fname} ({len(paths)} paths)")
+                report["files"] += len(paths)
+                report["recordings"].append(fname)
+            except Exception as e:
+                app.logger.error(f"[CRON] Error purging {fname}: {e}")
+                if not dry_run:
+                    # Push it back so one bad entry can't stall every run.
+                    with get_db() as db:
+                        db.execute("UPDATE recordings SET expires_at = ? WHERE filename = ?", (now + 3600, fname))
+        # A dry run deletes nothing, so page through the index instead.
+        after = batch[-1]["expires_at"]
+        if len(batch) < CLEANUP_BATCH_SIZE:
+            break
+
+    if not dry_run:
+        try:
+            evicted = enforce_cache_budget()
+            app.logger.info(f"[CRON] Cleanup: Evicted {evicted} over-budget cached files.")
+        except Exception as e:
+            app.logger.error(f"[CRON] Error pruning the artifact cache: {e}")
+
         try:
-            if not os.path.isdir(directory):
-                app.logger.warning(f"[CRON] Cleanup skipped: Directory not found at {directory}")
+            expired_links = purge_expired_links()
+            app.logger.info(f"[CRON] Cleanup: Removed {expired_links} expired public links.")
+        except Exception as e:
+            app.logger.error(f"[CRON] Error purging expired public links: {e}")
+
+        try:
+            purge_rate_buckets()
+            prune_metrics_snapshots()
+            purge_sent_mail()
+            purge_finished_jobs()
+        except Exception as e:
+            app.logger.error(f"[CRON] Error purging rate limit buckets, metrics snapshots, sent mail or old jobs: {e}")
+
+    app.logger.info(f"--- [CRON] Cleanup finished. {'Would purge' if dry_run else 'Purged'} "
+                    f"{len(report['recordings'])} recordings ({report['files']} paths, {report['bytes']} bytes). ---")
+    return report
+
+def index_untracked_recordings(older_than=None, dry_run=False):
+    """Adds recordings in RECDIR that have no row, with an expiry from their mtime. Returns how many."""
+    if not os.path.isdir(RECDIR):
+        app.logger.warning(f"⚠️ Recording directory {RECDIR} does not exist, nothing to index.")
+        return 0
+    known = {row["filename"] for row in get_db().execute("SELECT filename FROM recordings")}
+    added = 0
+    for entry in os.scandir(RECDIR):
+        if entry.is_file() and entry.name.endswith(".webm") and entry.name not in known:
+            mtime = entry.stat().st_mtime
+            if older_than is not None and mtime >= older_than:
+                continue   # may still be on its way in
+            if not dry_run:
+                with get_db() as db:
+                    db.execute("INSERT OR IGNORE INTO recordings (filename, token, created, retention, expires_at) "
+                               "VALUES (?, NULL, ?, 'default', ?)", (entry.name, mtime, mtime + RETENTION_POLICIES["default"]))
+            added += 1
+    return added
+
+def remove_unused_locks(older_than):
+    """Deletes artifact lock files nobody holds that were last used before older_than. Returns how many.
+
+    Each file is unlinked while we hold its flock, so a builder that opened
+    it just before sees it gone once it gets the lock, and retries on a new
+    one (see artifact_build_lock()).
+    """
+    if fcntl is None or not os.path.isdir(ARTIFACT_LOCK_DIR):
+        return 0
+    removed = 0
+    for entry in os.scandir(ARTIFACT_LOCK_DIR):
+        if entry.stat().st_mtime >= older_than:
+            continue
+        try:
+            with open(entry.path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass   # held, or already gone
+    return removed
+
+def sweep_untracked_files(now):
+    """Finds files the expiry index can't reach, for reindex_storage(). Returns the paths to delete.
+
+    Everything here must be UPLOAD_STALE_SECONDS old: work files and dirs of
+    jobs that never finished, and derived files no artifact row points at.
+    """
+    if not os.path.isdir(RECDIR):
+        app.logger.warning(f"⚠️ Recording directory {RECDIR} does not exist, nothing to sweep.")
+        return []
+    cutoff = now - UPLOAD_STALE_SECONDS
+
+    def old(entry):
+        return entry.stat(follow_symlinks=False).st_mtime < cutoff
+
+    stale = []
+    # Clip and edit work dirs, and half-made links into the blob store.
+    for entry in os.scandir(RECDIR):
+        if entry.is_dir(follow_symlinks=False) and entry.name.startswith((".clip_", ".edit_")) and old(entry):
+            stale.append(entry.path)
+        elif entry.is_file(follow_symlinks=False) and entry.name.endswith(".tmp") and old(entry):
+            stale.append(entry.path)
+    # Derived files: tracked ones go with their recording or by eviction.
+    # Anything else in a content-keyed shard (an unregistered result, a .part
+    # file, a .segments dir) is left over from a job that died.
+    tracked = {row["path"] for row in get_db().execute("SELECT path FROM artifacts")}
+    for root in (MP4_DIR, HLS_DIR, PREVIEW_DIR):
+        if not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False) and len(entry.name) == 2:
+                stale += [e.path for e in os.scandir(entry.path) if e.path not in tracked and old(e)]
+            elif old(entry) and not os.path.exists(os.path.join(RECDIR, os.path.splitext(entry.name)[0] + ".webm")):
+                stale.append(entry.path)   # name-keyed, from before the blob store, and its recording is gone
+    return stale
+
+def reindex_storage():
+    """Full scan for files the indexes don't know about, for `cleanup --reindex`.
+
+    Untracked recordings are indexed with an expiry from their mtime and
+    moved into the blob store along with any recording that isn't there
+    yet. Name-keyed MP4s are moved to their content-keyed path, and
+    recordings, artifacts and blobs that lost their other half are purged.
+    Finally, leftovers the expiry index can't reach are swept (see
+    sweep_untracked_files()).
+    """
+    if not os.path.isdir(RECDIR):
+        # Not mounted yet, most likely: don't read that as every recording being gone.
+        app.logger.warning(f"⚠️ Recording directory {RECDIR} does not exist, skipping the reindex.")
+        return {"indexed": 0, "dropped": 0, "hashed": 0, "adopted_mp4": 0, "orphans": 0, "stale_files": 0,
+                "lock_files": 0}
+    known = {row["filename"] for row in get_db().execute("SELECT filename FROM recordings")}
+    added = index_untracked_recordings()
+    missing = [f for f in known if not os.path.exists(os.path.join(RECDIR, f))]
+    for fname in missing:
+        purge_recording(fname)
+
+    unhashed = [row["filename"] for row in get_db().execute("SELECT filename FROM recordings WHERE content_hash IS NULL")]
+    for fname in unhashed:
+        content_hash_for(fname)
+
+    adopted = 0
+    if os.path.isdir(MP4_DIR):
+        for entry in os.scandir(MP4_DIR):
+            if not entry.is_file() or not entry.name.endswith(".mp4"):
                 continue
-            
-            for filename in os.listdir(directory):
-                file_path = os.path.join(directory, filename)
-                
-                # Make sure it's a file, not a directory
-                if os.path.isfile(file_path):
-                    try:
-                        file_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
-                        if file_mtime < cutoff:
-                            os.remove(file_path)
-                            deleted_count += 1
-                            app.logger.info(f"[CRON] Cleanup: Deleted old file {file_path}")
-                    except Exception as e:
-                        app.logger.error(f"[CRON] Error processing file {file_path}: {e}")
+            source = entry.name[:-len(".mp4")] + ".webm"
+            if os.path.exists(os.path.join(RECDIR, source)) and not os.path.exists(mp4_path_for(source)):
+                os.makedirs(os.path.dirname(mp4_path_for(source)), exist_ok=True)
+                os.replace(entry.path, mp4_path_for(source))
+                register_artifact(content_hash_for(source), "mp4", mp4_path_for(source))
+                adopted += 1
+            else:
+                os.remove(entry.path)
+
+    orphans = 0
+    for row in get_db().execute("SELECT DISTINCT source FROM artifacts").fetchall():
+        source = row["source"]
+        if CONTENT_HASH_RE.fullmatch(source):
+            if not blob_refcount(source):
+                purge_blob(source)
+                orphans += 1
+        elif not os.path.exists(os.path.join(RECDIR, source)):
+            for artifact in artifacts_for(source):
+                remove_artifact_path(artifact["path"])
+            forget_artifacts(source)
+            orphans += 1
+    if os.path.isdir(BLOB_DIR):
+        for root, _, files in os.walk(BLOB_DIR):
+            for name in files:
+                digest = os.path.splitext(name)[0]
+                if CONTENT_HASH_RE.fullmatch(digest) and not blob_refcount(digest):
+                    purge_blob(digest)
+                    orphans += 1
+
+    stale = sweep_untracked_files(time.time())
+    for path in stale:
+        try:
+            remove_artifact_path(path)
+        except OSError as e:
+            app.logger.error(f"Reindex: Error removing {path}: {e}")
+    locks = remove_unused_locks(time.time() - UPLOAD_STALE_SECONDS)
+    app.logger.info(f"Reindex: indexed {added} recordings, dropped {len(missing)} missing, hashed {len(unhashed)}, "
+                    f"adopted {adopted} MP4s, purged {orphans} orphans, removed {len(stale)} stale files and {locks} lock files.")
+    return {"indexed": added, "dropped": len(missing), "hashed": len(unhashed), "adopted_mp4": adopted, "orphans": orphans,
+            "stale_files": len(stale), "lock_files": locks}
+
+# ─────────────────────────────────────────────────────────
+# Media Serving
+# ─────────────────────────────────────────────────────────
+# Every media route goes through send_media(), which guarantees byte ranges,
+# a strong ETag and Last-Modified/304 handling. The bytes themselves are
+# handed off as early as possible:
+#   * MEDIA_ACCEL_REDIRECT_PREFIX set: an empty response with X-Accel-Redirect,
+#     and nginx (location <prefix> { internal; alias <RECDIR>/; }) streams the
+#     file, ranges and all.
+#   * USE_X_SENDFILE=1: Flask's X-Sendfile header for Apache/lighttpd.
+#   * Otherwise the server's wsgi.file_wrapper, which gunicorn sends with
+#     sendfile(2). werkzeug wraps a 206 body in a _RangeWrapper that copies
+#     through Python, so send_media() gives byte ranges a file wrapper of
+#     their own: an fd seeked to the range start (gunicorn sends from the
+#     fd's offset for Content-Length bytes) and a read() capped at the range
+#     end for servers that iterate instead.
+
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE") == "1"
+
+class _FileRange:
+    """The `length` bytes of an unbuffered file from its current offset, for a wsgi.file_wrapper."""
+    def __init__(self, f, length):
+        self._f, self._left = f, length
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def read(self, size=-1):
+        size = self._left if size is None or size < 0 else min(size, self._left)
+        data = self._f.read(size) if size else b""
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+def _send_range(response, path):
+    """Swaps werkzeug's copying range body for one the server can sendfile()."""
+    content_range = response.content_range
+    f = open(path, "rb", buffering=0)
+    try:
+        f.seek(content_range.start)
+    except OSError:
+        f.close()
+        raise
+    response.response.close()
+    wrapper = request.environ.get("wsgi.file_wrapper", FileWrapper)
+    response.response = wrapper(_FileRange(f, content_range.stop - content_range.start), 8192)
+    response.direct_passthrough = True
+
+def _strong_etag(st):
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+def send_media(directory, fname, mimetype=None, as_attachment=False, download_name=None, cache_control=None):
+    path = safe_join(directory, fname)
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return "❌ File not found.", 404
+
+    if MEDIA_ACCEL_REDIRECT_PREFIX and os.path.abspath(path).startswith(os.path.abspath(RECDIR) + os.sep):
+        rel = os.path.relpath(path, RECDIR).replace(os.sep, "/")
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_REDIRECT_PREFIX}/{url_quote(rel)}"
+        response.mimetype = mimetype or mimetypes.guess_type(fname)[0] or "application/octet-stream"
+        response.set_etag(_strong_etag(st))
+        response.last_modified = st.st_mtime
+        if as_attachment:
+            response.headers.set("Content-Disposition", "attachment", filename=download_name or os.path.basename(fname))
+        # Revalidations are answered here: no need to wake nginx for a 304.
+        # Ranges are left to nginx, which has the file.
+        response.make_conditional(request)
+        if response.status_code == 304:
+            del response.headers["X-Accel-Redirect"]
+    else:
+        response = send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                             download_name=download_name, conditional=True,
+                             etag=_strong_etag(st), last_modified=st.st_mtime)
+        if response.status_code == 206 and not response.headers.get("X-Sendfile"):
+            _send_range(response, path)
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+# ─────────────────────────────────────────────────────────
+# Admission Control
+# ─────────────────────────────────────────────────────────
+# Every ffmpeg process (clips, conversions, HLS, previews) needs one of
+# FFMPEG_SLOTS slots, shared by all worker processes on the host through
+# flock()ed slot files. Requests wait up to ADMISSION_WAIT_SECONDS for a slot
+# and otherwise get a 503 with Retry-After; job workers just wait their turn,
+# and at most MAX_QUEUED_JOBS jobs someone asked for (plus, separately,
+# MAX_QUEUED_BACKGROUND_JOBS pipeline jobs) may be waiting. On top of that, work-
+# creating requests draw from token buckets per client IP and per magic_token
+# (429 when empty), and each ffmpeg runs under memory/CPU-time rlimits.
+
+FFMPEG_SLOTS = int(os.getenv("FFMPEG_SLOTS", str(max(1, os.cpu_count() or 1))))
+FFMPEG_SLOT_DIR = os.path.join(RECDIR, ".slots")
+ADMISSION_WAIT_SECONDS = float(os.getenv("ADMISSION_WAIT_SECONDS", "3"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50"))
+MAX_QUEUED_BACKGROUND_JOBS = int(os.getenv("MAX_QUEUED_BACKGROUND_JOBS", "100"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "6"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+FFMPEG_MEMORY_LIMIT_MB = int(os.getenv("FFMPEG_MEMORY_LIMIT_MB", "2048"))   # 0 = unlimited
+FFMPEG_CPU_LIMIT_SECONDS = int(os.getenv("FFMPEG_CPU_LIMIT_SECONDS", "1800"))  # 0 = unlimited
+# A streamed conversion holds its slot only while the client keeps reading.
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("STREAM_IDLE_TIMEOUT_SECONDS", "60"))
+
+# Behind Render's (or any) reverse proxy, the client address comes from
+# X-Forwarded-For. Only trust as many hops as there really are proxies.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+class Overloaded(Exception):
+    """Raised when there is no ffmpeg slot or queue space; answered with a 503."""
+    def __init__(self, message, retry_after=2):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@bp.app_errorhandler(Overloaded)
+def handle_overloaded(e):
+    app.logger.warning(f"Shedding {request.method} {request.path}: {e}")
+    inc("grabscreen_admission_rejections_total", reason="overloaded", endpoint=endpoint_label())
+    response = jsonify({"status": "fail", "error": f"{e} Please try again shortly."})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(int(math.ceil(e.retry_after)))
+    return response
+
+# Without flock (Windows) the slots are only shared within this process.
+_local_ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_SLOTS)
+
+def _try_ffmpeg_slot():
+    if fcntl is None:
+        return _local_ffmpeg_slots if _local_ffmpeg_slots.acquire(blocking=False) else None
+    os.makedirs(FFMPEG_SLOT_DIR, exist_ok=True)
+    for i in range(FFMPEG_SLOTS):
+        f = open(os.path.join(FFMPEG_SLOT_DIR, f"{i}.lock"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except OSError:
+            f.close()
+    return None
+
+def acquire_ffmpeg_slot(wait=None, cancelled=None):
+    """Returns a slot handle for release_ffmpeg_slot(), or None if none freed up within `wait` seconds."""
+    deadline = None if wait is None else time.time() + wait
+    while True:
+        slot = _try_ffmpeg_slot()
+        if slot is not None:
+            return slot
+        if (deadline is not None and time.time() >= deadline) or (cancelled and cancelled()):
+            return None
+        time.sleep(0.1)
+
+def release_ffmpeg_slot(slot):
+    if slot is _local_ffmpeg_slots:
+        slot.release()
+    else:
+        slot.close()   # closing the file drops its flock
+
+def _limit_ffmpeg_resources():
+    # Runs in the child between fork and exec.
+    if FFMPEG_MEMORY_LIMIT_MB:
+        limit = FFMPEG_MEMORY_LIMIT_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if FFMPEG_CPU_LIMIT_SECONDS:
+        resource.setrlimit(resource.RLIMIT_CPU, (FFMPEG_CPU_LIMIT_SECONDS, FFMPEG_CPU_LIMIT_SECONDS + 5))
+
+def take_rate_token(key):
+    """Token bucket: takes a token for key and returns 0, or returns the seconds until one is available."""
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    now = time.time()
+    with get_db() as db:
+        # One statement, so concurrent workers can't both spend the last token.
+        taken = db.execute(
+            "INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ? - 1, ?) "
+            "ON CONFLICT(key) DO UPDATE SET tokens = MIN(?, tokens + (excluded.updated - updated) * ?) - 1, "
+            "updated = excluded.updated WHERE MIN(?, tokens + (excluded.updated - updated) * ?) >= 1",
+            (key, RATE_LIMIT_BURST, now, RATE_LIMIT_BURST, rate, RATE_LIMIT_BURST, rate)).rowcount
+    if taken:
+        return 0
+    row = get_db().execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+    available = min(RATE_LIMIT_BURST, row["tokens"] + (now - row["updated"]) * rate)
+    return max(1, math.ceil((1 - available) / rate)) if rate else 60
+
+def rate_limit_response(scope=""):
+    """A 429 response if this client (by IP and by magic_token) is out of tokens, else None.
+
+    A scope gets buckets of its own, so cheap but numerous requests can't
+    use up the client's clips and conversions.
+    """
+    keys = [f"{scope}ip:{request.remote_addr}"]
+    token = request.cookies.get("magic_token")
+    if token:
+        keys.append(f"{scope}token:{token}")
+    for key in keys:
+        retry_after = take_rate_token(key)
+        if retry_after:
+            app.logger.warning(f"Rate limited {key} on {request.path} for {retry_after}s")
+            inc("grabscreen_admission_rejections_total", reason="rate_limited", endpoint=endpoint_label())
+            response = jsonify({"status": "fail", "error": f"Too many requests. Please wait {retry_after}s and try again."})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(retry_after)
+            return response
+    return None
+
+def purge_rate_buckets():
+    """Drops buckets that have refilled completely; they behave the same as no row."""
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    if not rate:
+        return 0
+    with get_db() as db:
+        return db.execute("DELETE FROM rate_buckets WHERE updated < ?", (time.time() - RATE_LIMIT_BURST / rate,)).rowcount
+
+# ─────────────────────────────────────────────────────────
+# Background Transcode Jobs
+# ─────────────────────────────────────────────────────────
+# Conversions run on a small pool of worker threads so a request never waits
+# on ffmpeg. Requests for the same (kind, filename) while a job is queued or
+# running are merged into that job.
+
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+TRANSCODE_TIMEOUT_SECONDS = int(os.getenv("TRANSCODE_TIMEOUT_SECONDS", "120"))
+# Long recordings get longer: this many seconds of encoding per second of
+# video, never less than TRANSCODE_TIMEOUT_SECONDS.
+TRANSCODE_TIMEOUT_PER_SECOND = float(os.getenv("TRANSCODE_TIMEOUT_PER_SECOND", "1.5"))
+JOB_RETENTION_SECONDS = 60 * 60
+# How often a running job checks the store for a cancel issued by another worker.
+JOB_CANCEL_POLL_SECONDS = 1.0
+JOB_OWNER_DIR = os.path.join(RECDIR, ".jobs")
+JOB_LOST_ERROR = "The server restarted while processing this video. Please try again."
+
+JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+# Lower runs first. Someone is waiting on interactive jobs; background jobs
+# (the post-upload pipeline) also run their ffmpeg at idle CPU/IO priority.
+# A queued background job that someone starts waiting on is moved up the
+# queue, but one that is already running stays at idle priority: raising a
+# process's priority back needs CAP_SYS_NICE, which the server doesn't have.
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = 0, 10
+
+class TranscodeError(Exception):
+    """Raised by a job function when ffmpeg fails; the message is shown to the user."""
+
+class JobCancelled(Exception):
+    """Raised by run_ffmpeg when the job it belongs to was cancelled."""
+
+# Every job has a row in the jobs table, so any gunicorn worker can report on
+# it, join it instead of starting a duplicate, or cancel it. The worker that
+# queued a job runs it and keeps its live parts (queue entry, ffmpeg
+# processes) in `jobs`; it picks up cancels from other workers by polling the
+# row. Each worker holds a flock on its own file in JOB_OWNER_DIR while it
+# lives, so rows left queued or running by a dead worker can be told apart.
+jobs = {}            # job_id -> job dict, for the jobs this process runs
+_jobs_lock = threading.Lock()
+_job_queue = queue.PriorityQueue()
+_job_seq = itertools.count()
+_job_workers = []
+_job_context = threading.local()
+_job_owner = None    # (pid, owner id, flock'ed file)
+
+def job_to_dict(job):
+    return {k: job[k] for k in ("id", "kind", "filename", "state", "error", "created", "finished")}
+
+def _job_owner_id():
+    """This process's owner id for job rows; its lock file stays flock'ed until the process exits."""
+    global _job_owner
+    if _job_owner is None or _job_owner[0] != os.getpid():
+        if _job_owner and _job_owner[2]:
+            _job_owner[2].close()   # the parent's, inherited over a fork; the parent still holds it
+        owner, lock = f"{os.getpid()}-{uuid.uuid4().hex[:8]}", None
+        if fcntl:
+            os.makedirs(JOB_OWNER_DIR, exist_ok=True)
+            lock = open(os.path.join(JOB_OWNER_DIR, f"{owner}.lock"), "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        _job_owner = (os.getpid(), owner, lock)
+    return _job_owner[1]
+
+def _job_owner_alive(owner):
+    if owner == _job_owner_id():
+        return True
+    if fcntl is None:
+        return _pid_alive(int(owner.split("-")[0]))
+    path = os.path.join(JOB_OWNER_DIR, f"{owner}.lock")
+    try:
+        with open(path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True   # still locked by its process
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return False
+
+def _fail_lost_jobs(db):
+    """Marks jobs whose worker process is gone as failed, so they are neither joined nor waited on."""
+    owners = [row["owner"] for row in db.execute(
+        "SELECT DISTINCT owner FROM jobs WHERE state IN (?, ?)", (JOB_QUEUED, JOB_RUNNING))]
+    for owner in owners:
+        if not _job_owner_alive(owner):
+            db.execute("UPDATE jobs SET state = ?, error = ?, finished = ? WHERE owner = ? AND state IN (?, ?)",
+                       (JOB_FAILED, JOB_LOST_ERROR, time.time(), owner, JOB_QUEUED, JOB_RUNNING))
+
+def get_job(job_id):
+    """The job's row as a dict, or None. Works for jobs run by any worker."""
+    row = get_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row and row["state"] in (JOB_QUEUED, JOB_RUNNING) and not _job_owner_alive(row["owner"]):
+        with get_db() as db:
+            _fail_lost_jobs(db)
+        row = get_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def active_job(kind, filename):
+    """The queued or running job of this kind for filename, from any worker, or None."""
+    row = get_db().execute("SELECT * FROM jobs WHERE kind = ? AND filename = ? AND state IN (?, ?)",
+                           (kind, filename, JOB_QUEUED, JOB_RUNNING)).fetchone()
+    return dict(row) if row else None
+
+def _save_job_state(job):
+    with get_db() as db:
+        # A cancel from another worker that this one never noticed still wins.
+        db.execute("UPDATE jobs SET state = CASE WHEN state = ? THEN state ELSE ? END, "
+                   "error = CASE WHEN state = ? THEN error ELSE ? END, finished = ? WHERE id = ?",
+                   (JOB_CANCELLED, job["state"], JOB_CANCELLED, job["error"], job["finished"], job["id"]))
+
+def _job_cancelled(job):
+    """True once the job is cancelled, here or (checked every JOB_CANCEL_POLL_SECONDS) by another worker."""
+    if job["state"] == JOB_CANCELLED:
+        return True
+    now = time.time()
+    if now - job.get("checked", 0) < JOB_CANCEL_POLL_SECONDS:
+        return False
+    job["checked"] = now
+    row = get_db().execute("SELECT state FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+    if row and row["state"] == JOB_CANCELLED:
+        with _jobs_lock:
+            job["state"], job["error"] = JOB_CANCELLED, "Cancelled"
+        return True
+    return False
+
+def _prune_finished_jobs():
+    # Caller must hold _jobs_lock.
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id, job in list(jobs.items()):
+        if job["finished"] and job["finished"] < cutoff:
+            del jobs[job_id]
+
+def purge_finished_jobs():
+    """Drops job rows finished more than JOB_RETENTION_SECONDS ago and lock files of exited workers."""
+    with get_db() as db:
+        _fail_lost_jobs(db)
+        removed = db.execute("DELETE FROM jobs WHERE finished < ?", (time.time() - JOB_RETENTION_SECONDS,)).rowcount
+    if fcntl and os.path.isdir(JOB_OWNER_DIR):
+        for entry in os.scandir(JOB_OWNER_DIR):
+            if entry.name.endswith(".lock"):
+                _job_owner_alive(entry.name[:-len(".lock")])   # removes the file if its process is gone
+    return removed
+
+def _low_priority_prefix():
+    prefix = []
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", "19"]
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    return prefix
+
+LOW_PRIORITY_PREFIX = [] if IS_WINDOWS else _low_priority_prefix()
+
+_children_rusage_lock = threading.Lock()
+_children_cpu_seen = 0.0
+
+def _reaped_children_cpu():
+    """CPU seconds of child processes reaped since the previous call.
+
+    Called right after each ffmpeg exits, so the delta is that process's CPU
+    time (another child reaped in the same instant would be lumped in).
+    """
+    global _children_cpu_seen
+    if resource is None:
+        return 0.0
+    with _children_rusage_lock:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total = usage.ru_utime + usage.ru_stime
+        delta, _children_cpu_seen = total - _children_cpu_seen, total
+    return max(0.0, delta)
+
+def run_ffmpeg(cmd, timeout=None, slot=True, op=None):
+    """subprocess.run(cmd, check=True, capture_output=True, text=True) for ffmpeg/ffprobe.
+
+    The process holds an ffmpeg slot (unless slot=False, for quick probes)
+    and runs under the ffmpeg rlimits. Inside a job it is registered so
+    cancel_jobs_for() can kill it, and background jobs run it at idle
+    priority. Outside a job, Overloaded is raised if no slot frees up in time.
+    `op` labels its metrics and defaults to the job kind.
+    """
+    job = getattr(_job_context, "job", None)
+    op = op or (job["kind"] if job else "ffmpeg")
+    if job and job["priority"] >= PRIORITY_BACKGROUND:
+        cmd = LOW_PRIORITY_PREFIX + list(cmd)
+    held = None
+    waited = time.perf_counter()
+    if slot:
+        if job:
+            held = acquire_ffmpeg_slot(cancelled=lambda: _job_cancelled(job))
+            if held is None:
+                raise JobCancelled()
+        else:
+            held = acquire_ffmpeg_slot(wait=ADMISSION_WAIT_SECONDS)
+            if held is None:
+                raise Overloaded("The server is busy processing other videos.")
+        observe("grabscreen_ffmpeg_slot_wait_seconds", time.perf_counter() - waited, op=op)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        result = _run_ffmpeg_process(cmd, job, timeout)
+        status = "ok"
+        return result
+    except subprocess.TimeoutExpired:
+        status = "timeout"
+        raise
+    except JobCancelled:
+        status = "cancelled"
+        raise
+    except FileNotFoundError:
+        status = "missing"
+        raise
+    finally:
+        if held is not None:
+            release_ffmpeg_slot(held)
+        observe("grabscreen_ffmpeg_wall_seconds", time.perf_counter() - started, op=op)
+        inc("grabscreen_ffmpeg_cpu_seconds_total", _reaped_children_cpu(), op=op)
+        inc("grabscreen_ffmpeg_runs_total", op=op, status=status)
+
+def _run_ffmpeg_process(cmd, job, timeout):
+    preexec_fn = _limit_ffmpeg_resources if resource else None
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, preexec_fn=preexec_fn) as proc:
+        if job:
+            with _jobs_lock:
+                job["processes"].add(proc)
+                cancelled = job["state"] == JOB_CANCELLED
+            if cancelled:
+                proc.kill()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                # Inside a job, wake up now and then to see if another worker cancelled it.
+                wait = JOB_CANCEL_POLL_SECONDS if job else None
+                if deadline is not None:
+                    left = max(0, deadline - time.monotonic())
+                    wait = left if wait is None else min(wait, left)
+                try:
+                    stdout, stderr = proc.communicate(timeout=wait)
+                    break
+                except subprocess.TimeoutExpired as e:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        proc.kill()
+                        proc.communicate()
+                        raise subprocess.TimeoutExpired(cmd, timeout, stderr=e.stderr)
+                    if _job_cancelled(job):
+                        proc.kill()
+        finally:
+            if job:
+                with _jobs_lock:
+                    job["processes"].discard(proc)
+    if job and job["state"] == JOB_CANCELLED:
+        raise JobCancelled()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def run_ffmpeg_parallel(runs):
+    """Runs [(cmd, timeout, op), ...] through run_ffmpeg at the same time. Returns their results.
+
+    Each run still takes its own ffmpeg slot, so at most FFMPEG_SLOTS of them
+    are in flight. Inside a job the pool threads act for that job (cancelling
+    it kills all of them); if one run fails, the rest are abandoned and
+    killed and its error is raised.
+    """
+    job = getattr(_job_context, "job", None)
+    failed = threading.Event()
+
+    def run(cmd, timeout, op):
+        if failed.is_set():
+            raise JobCancelled()
+        _job_context.job = job
+        try:
+            return run_ffmpeg(cmd, timeout=timeout, op=op)
+        finally:
+            _job_context.job = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(runs), FFMPEG_SLOTS)) as pool:
+        futures = [pool.submit(run, *r) for r in runs]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            failed.set()
+            for future in futures:
+                future.cancel()
+            if job:
+                with _jobs_lock:
+                    for proc in job["processes"]:
+                        proc.kill()
+            raise
+
+def stream_ffmpeg(cmd, op, chunk_size=UPLOAD_BUFFER_SIZE):
+    """Starts ffmpeg writing to stdout and returns a generator of its output chunks.
+
+    The slot is taken before returning (raising Overloaded as run_ffmpeg
+    does outside a job), so the caller can still answer with a 503. Chunks
+    are yielded as soon as ffmpeg writes them. Closing the generator early
+    kills ffmpeg; exhausting it raises CalledProcessError if ffmpeg failed,
+    or TimeoutExpired if it was stopped for going STREAM_IDLE_TIMEOUT_SECONDS
+    without a chunk being taken, or TRANSCODE_TIMEOUT_SECONDS overall.
+    """
+    waited = time.perf_counter()
+    held = acquire_ffmpeg_slot(wait=ADMISSION_WAIT_SECONDS)
+    if held is None:
+        raise Overloaded("The server is busy processing other videos.")
+    observe("grabscreen_ffmpeg_slot_wait_seconds", time.perf_counter() - waited, op=op)
+    # stderr goes to a file: nobody reads it until ffmpeg is done, and a full pipe would stall it.
+    stderr = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                                preexec_fn=_limit_ffmpeg_resources if resource else None)
+    except BaseException:
+        stderr.close()
+        release_ffmpeg_slot(held)
+        inc("grabscreen_ffmpeg_runs_total", op=op, status="missing")
+        raise
+    return _ffmpeg_output_chunks(proc, cmd, stderr, held, op, chunk_size)
+
+def _ffmpeg_output_chunks(proc, cmd, stderr, held, op, chunk_size):
+    started = time.perf_counter()
+    last_progress = [time.monotonic()]
+    finished, timed_out, release_lock = threading.Event(), threading.Event(), threading.Lock()
+
+    def release():
+        nonlocal held
+        with release_lock:
+            if held is not None:
+                release_ffmpeg_slot(held)
+                held = None
+
+    def watchdog():
+        # While the server writes a chunk to a stalled client, the generator
+        # is suspended, perhaps for good (or it was never started), so the
+        # deadlines are enforced from the outside: kill ffmpeg and hand its
+        # slot to someone else.
+        deadline = time.monotonic() + TRANSCODE_TIMEOUT_SECONDS
+        while not finished.wait(1):
+            now = time.monotonic()
+            if now - last_progress[0] > STREAM_IDLE_TIMEOUT_SECONDS or now > deadline:
+                app.logger.warning(f"Stopping a stalled {op} stream (pid {proc.pid}).")
+                timed_out.set()
+                proc.kill()
+                proc.wait()
+                release()
+                return
+
+    def chunks():
+        status = "error"
+        try:
+            while True:
+                chunk = proc.stdout.read1(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+                last_progress[0] = time.monotonic()
+            if proc.wait():
+                if timed_out.is_set():
+                    raise subprocess.TimeoutExpired(cmd, STREAM_IDLE_TIMEOUT_SECONDS)
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.read().decode(errors="replace"))
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            finished.set()
+            if timed_out.is_set():
+                status = "timeout"
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            stderr.close()
+            release()
+            observe("grabscreen_ffmpeg_wall_seconds", time.perf_counter() - started, op=op)
+            inc("grabscreen_ffmpeg_cpu_seconds_total", _reaped_children_cpu(), op=op)
+            inc("grabscreen_ffmpeg_runs_total", op=op, status=status)
+
+    threading.Thread(target=watchdog, daemon=True).start()
+    return chunks()
+
+def _job_worker_loop():
+    while True:
+        _, _, job_id, func = _job_queue.get()
+        try:
+            with _jobs_lock:
+                job = jobs.get(job_id)
+                # Stale entries: the job was cancelled, or re-queued at a higher priority and already ran.
+                if not job or job["state"] != JOB_QUEUED:
+                    continue
+                job["state"] = JOB_RUNNING
+            with get_db() as db:
+                started = db.execute("UPDATE jobs SET state = ? WHERE id = ? AND state = ?",
+                                     (JOB_RUNNING, job_id, JOB_QUEUED)).rowcount
+            if not started:
+                # Cancelled by another worker while it was queued.
+                with _jobs_lock:
+                    job["state"], job["error"], job["finished"] = JOB_CANCELLED, "Cancelled", time.time()
+                continue
+            _job_context.job = job
+            try:
+                func(job["filename"])
+                state, error = JOB_DONE, None
+            except JobCancelled:
+                state, error = JOB_CANCELLED, "Cancelled"
+            except TranscodeError as e:
+                state, error = JOB_FAILED, str(e)
+            except Exception as e:
+                if job["state"] != JOB_CANCELLED:
+                    app.logger.error(f"❌ Unexpected error in {job['kind']} job for {job['filename']}: {e}")
+                state, error = JOB_FAILED, f"An unexpected error occurred: {str(e)}"
+            finally:
+                _job_context.job = None
+            with _jobs_lock:
+                if job["state"] == JOB_CANCELLED:
+                    state, error = JOB_CANCELLED, "Cancelled"
+                job["state"], job["error"], job["finished"] = state, error, time.time()
+            _save_job_state(job)
+        finally:
+            _job_queue.task_done()
+
+def _ensure_job_workers():
+    # Threads don't survive a fork, so (re)start them lazily in whichever
+    # process first needs them.
+    with _jobs_lock:
+        if len([t for t in _job_workers if t.is_alive()]) >= TRANSCODE_WORKERS:
+            return
+        _job_workers[:] = [t for t in _job_workers if t.is_alive()]
+        for i in range(TRANSCODE_WORKERS - len(_job_workers)):
+            t = threading.Thread(target=_job_worker_loop, name=f"transcode-{len(_job_workers)}", daemon=True)
+            t.start()
+            _job_workers.append(t)
+
+def enqueue_job(kind, filename, func, priority=PRIORITY_INTERACTIVE):
+    """Queues `func(filename)` on this process's worker pool. Returns (job, created).
+
+    If any worker already has a queued or running job of this kind for
+    filename, that job is returned instead. Raises Overloaded instead of
+    creating a job once MAX_QUEUED_JOBS interactive (or, for background
+    jobs, MAX_QUEUED_BACKGROUND_JOBS background) jobs are waiting across all
+    workers, so the pipeline can't crowd out requests someone waits on.
+    """
+    _ensure_job_workers()
+    owner = _job_owner_id()
+    with _jobs_lock:
+        _prune_finished_jobs()
+        for _ in range(2):
+            with get_db() as db:
+                _fail_lost_jobs(db)
+                row = db.execute("SELECT * FROM jobs WHERE kind = ? AND filename = ? AND state IN (?, ?)",
+                                 (kind, filename, JOB_QUEUED, JOB_RUNNING)).fetchone()
+                if row:
+                    existing = jobs.get(row["id"])
+                    if existing is None:
+                        return dict(row), False   # run by another worker
+                    if existing["state"] == JOB_QUEUED and priority < existing["priority"]:
+                        # Someone is now waiting on a background job: queue it again
+                        # up front; the worker skips whichever entry comes second.
+                        existing["priority"] = priority
+                        db.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, existing["id"]))
+                        _job_queue.put((priority, next(_job_seq), existing["id"], existing["func"]))
+                    return existing, False
+                background = priority >= PRIORITY_BACKGROUND
+                queued = db.execute(f"SELECT COUNT(*) FROM jobs WHERE state = ? AND priority {'>=' if background else '<'} ?",
+                                    (JOB_QUEUED, PRIORITY_BACKGROUND)).fetchone()[0]
+                if queued >= (MAX_QUEUED_BACKGROUND_JOBS if background else MAX_QUEUED_JOBS):
+                    raise Overloaded("Too many videos are waiting to be processed.", retry_after=10)
+                job = {
+                    "id": uuid.uuid4().hex,
+                    "kind": kind,
+                    "filename": filename,
+                    "state": JOB_QUEUED,
+                    "error": None,
+                    "created": time.time(),
+                    "finished": None,
+                    "priority": priority,
+                    "func": func,
+                    "processes": set(),   # ffmpeg processes it is running
+                }
+                try:
+                    db.execute("INSERT INTO jobs (id, kind, filename, state, priority, owner, created) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (job["id"], kind, filename, JOB_QUEUED, priority, owner, job["created"]))
+                except sqlite3.IntegrityError:
+                    continue   # another worker queued the same job first; join that one
+            jobs[job["id"]] = job
+            break
+        else:
+            raise Overloaded("The server is busy processing other videos.")
+    _job_queue.put((priority, next(_job_seq), job["id"], func))
+    return job, True
+
+def cancel_jobs_for(filename):
+    """Cancels queued and running jobs for filename, killing any ffmpeg they started.
+
+    Jobs run by other workers are marked cancelled in the store; those workers
+    kill their ffmpeg within JOB_CANCEL_POLL_SECONDS.
+    """
+    now = time.time()
+    with get_db() as db:
+        cancelled = db.execute(
+            "UPDATE jobs SET state = ?, error = 'Cancelled', finished = ? WHERE filename = ? AND state IN (?, ?)",
+            (JOB_CANCELLED, now, filename, JOB_QUEUED, JOB_RUNNING)).rowcount
+    with _jobs_lock:
+        for job in jobs.values():
+            if job["filename"] != filename or job["state"] not in (JOB_QUEUED, JOB_RUNNING):
+                continue
+            if job["state"] == JOB_QUEUED:
+                job["finished"] = now
+            job["state"], job["error"] = JOB_CANCELLED, "Cancelled"
+            for proc in job["processes"]:
+                proc.kill()
+    if cancelled:
+        app.logger.info(f"Cancelled {cancelled} job(s) for {filename}")
+    return cancelled
+
+# Part of the cache key: changing these produces new files instead of serving stale ones.
+MP4_VIDEO_ARGS = [
+    "-r", "30",           # Force output framerate to 30 FPS
+    "-c:v", "libx264",
+    "-preset", "ultrafast", # Faster encoding, lower quality/larger file for quick conversions
+    "-crf", "28",         # Constant Rate Factor (0-51), higher means lower quality/smaller file
+]
+MP4_AUDIO_ARGS = [
+    "-c:a", "aac",
+    "-b:a", "64k",
+]
+MP4_ENCODE_ARGS = MP4_VIDEO_ARGS + MP4_AUDIO_ARGS
+
+# Recordings at least this long are split at keyframes into up to
+# PARALLEL_TRANSCODE_SEGMENTS pieces that are encoded at the same time (one
+# ffmpeg slot each) and joined with the concat demuxer. The audio track is
+# encoded in one piece alongside them, so segment boundaries can't leave
+# gaps or clicks in it. Set PARALLEL_TRANSCODE_SEGMENTS=1 to always use a
+# single ffmpeg.
+PARALLEL_TRANSCODE_MIN_SECONDS = float(os.getenv("PARALLEL_TRANSCODE_MIN_SECONDS", "60"))
+PARALLEL_TRANSCODE_SEGMENTS = int(os.getenv("PARALLEL_TRANSCODE_SEGMENTS", str(FFMPEG_SLOTS)))
+MIN_SEGMENT_SECONDS = 10
+
+def transcode_timeout(duration):
+    return max(TRANSCODE_TIMEOUT_SECONDS, int((duration or 0) * TRANSCODE_TIMEOUT_PER_SECOND))
+
+def plan_segments(keyframes, duration, count, min_length=MIN_SEGMENT_SECONDS):
+    """Keyframe times to split a recording at, for up to `count` roughly equal segments.
+
+    Returns [] when the recording is too short or has too few keyframes to split.
+    """
+    count = min(count, int(duration // min_length))
+    cuts = []
+    for i in range(1, count):
+        target = duration * i / count
+        pos = bisect.bisect_left(keyframes, target)
+        candidates = keyframes[max(0, pos - 1):pos + 1]
+        if not candidates:
+            continue
+        cut = min(candidates, key=lambda k: abs(k - target))
+        if cut - (cuts[-1] if cuts else 0.0) >= min_length and duration - cut >= min_length:
+            cuts.append(cut)
+    return cuts
+
+def mp4_path_for(filename):
+    return derived_path(MP4_DIR, filename, MP4_ENCODE_ARGS, ".mp4")
+
+def convert_to_mp4(filename):
+    """Transcodes RECDIR/filename into MP4_DIR. Runs on a job worker."""
+    webm_path = os.path.join(RECDIR, filename)
+    mp4_path = mp4_path_for(filename)
+    # Encode to a temp name and rename, so a half-written file is never served.
+    # Duplicates of one recording may convert at once, so the name is unique.
+    tmp_path = f"{mp4_path}.{uuid.uuid4().hex[:8]}.part"
+    os.makedirs(os.path.dirname(mp4_path), exist_ok=True)
+
+    try:
+        info = probe_recording(filename)
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        app.logger.warning(f"Could not probe {filename}, converting it in one piece: {e}")
+        info = None
+    duration = (info or {}).get("duration") or 0
+    cuts = []
+    if info and info["video"] and duration >= PARALLEL_TRANSCODE_MIN_SECONDS and PARALLEL_TRANSCODE_SEGMENTS > 1:
+        cuts = plan_segments(info["keyframes"], duration, PARALLEL_TRANSCODE_SEGMENTS)
+
+    ffmpeg_cmd = [
+        FFMPEG_PATH,
+        "-y",                 # Overwrite output file without asking
+        "-i", webm_path,      # Input WEBM file
+        *MP4_ENCODE_ARGS,
+        "-f", "mp4",
+        tmp_path,
+    ]
+
+    app.logger.info(f"Attempting to convert {filename} to MP4" + (f" in {len(cuts) + 1} segments..." if cuts else "..."))
+    try:
+        if cuts:
+            result = _convert_segmented(webm_path, tmp_path, info, cuts)
+        else:
+            result = run_ffmpeg(ffmpeg_cmd, timeout=transcode_timeout(duration))
+        if result.stderr:
+            app.logger.warning(f"⚠️ FFmpeg stderr (might be warnings) for {filename}:\n{result.stderr}")
+    except subprocess.TimeoutExpired as e:
+        app.logger.error(f"❌ FFmpeg conversion timed out for {filename} after {e.timeout} seconds. Stderr from partial output: {e.stderr}")
+        raise TranscodeError(f"Video conversion timed out ({e.timeout}s). Try a shorter clip or simpler conversion. Server might be under heavy load or resource constraints.")
+    except subprocess.CalledProcessError as e:
+        app.logger.error(f"❌ FFmpeg conversion failed for {filename} with error code {e.returncode}:\n{e.stderr}")
+        raise TranscodeError(f"Video conversion failed: {e.stderr}")
+    except FileNotFoundError:
+        app.logger.error(f"❌ FFmpeg command not found. Ensure FFmpeg is installed on the server at '{FFMPEG_PATH}' or is in the system's PATH.")
+        raise TranscodeError("Server error: FFmpeg not found for video conversion.")
+    finally:
+        # A failed run can leave a partial .part behind; only a non-empty file
+        # from a successful run survives this block.
+        if os.path.exists(tmp_path) and (sys.exc_info()[0] or os.path.getsize(tmp_path) == 0):
+            os.remove(tmp_path)
+
+    if not os.path.exists(tmp_path):
+        app.logger.error(f"❌ Converted MP4 is 0 bytes or missing after conversion: {mp4_path}")
+        raise TranscodeError("Converted video is empty or corrupt. Try re-uploading or trimming the recording.")
+
+    os.replace(tmp_path, mp4_path)
+    register_artifact(content_hash_for(filename), "mp4", mp4_path)
+    app.logger.info(f"✅ Successfully converted {filename} to {mp4_path}")
+
+def _convert_segmented(webm_path, out_path, info, cuts):
+    """convert_to_mp4 for long recordings: split at `cuts`, encode the pieces in parallel, concat."""
+    work_dir = f"{out_path}.segments"
+    os.makedirs(work_dir)
+    duration = info["duration"]
+    try:
+        # Stream copy, so this is only as slow as reading the file. The cuts
+        # are keyframes, so every piece starts with one.
+        run_ffmpeg([FFMPEG_PATH, "-y", "-i", webm_path, "-map", "0:v:0", "-c", "copy",
+                    "-f", "segment", "-segment_times", ",".join(f"{t:.3f}" for t in cuts),
+                    "-segment_time_delta", "0.01", "-reset_timestamps", "1",
+                    os.path.join(work_dir, "source%03d.webm")],
+                   timeout=transcode_timeout(duration), op="mp4_split")
+        sources = sorted(f for f in os.listdir(work_dir) if f.startswith("source"))
+        if not sources:
+            raise subprocess.CalledProcessError(1, "segment", stderr="Splitting produced no segments.")
+        bounds = [0.0, *cuts, duration]
+        longest = max(b - a for a, b in zip(bounds, bounds[1:])) if len(sources) == len(bounds) - 1 else duration
+
+        # Every piece is scaled to the recording's size: MediaRecorder changes
+        # resolution mid-stream when a window is resized, and the pieces must
+        # match to be concatenated.
+        video = info["video"]
+        scale = ["-vf", f"scale={video['width']}:{video['height']}"] if video.get("width") and video.get("height") else []
+        threads = ["-threads", str(max(1, (os.cpu_count() or 1) // min(len(sources), FFMPEG_SLOTS)))]
+        runs = [([FFMPEG_PATH, "-y", "-i", os.path.join(work_dir, source), *scale, *MP4_VIDEO_ARGS, *threads,
+                  "-an", "-f", "mp4", os.path.join(work_dir, f"video{i:03d}.mp4")],
+                 transcode_timeout(longest), "mp4_segment")
+                for i, source in enumerate(sources)]
+        audio_path = os.path.join(work_dir, "audio.m4a")
+        if info["audio"]:
+            runs.append(([FFMPEG_PATH, "-y", "-i", webm_path, "-vn", *MP4_AUDIO_ARGS, "-f", "mp4", audio_path],
+                         transcode_timeout(duration), "mp4_audio"))
+        run_ffmpeg_parallel(runs)
+
+        list_path = os.path.join(work_dir, "segments.txt")
+        with open(list_path, "w") as f:
+            f.writelines(f"file 'video{i:03d}.mp4'\n" for i in range(len(sources)))
+        audio_input, audio_map = (["-i", audio_path], ["-map", "1:a"]) if info["audio"] else ([], [])
+        return run_ffmpeg([FFMPEG_PATH, "-y", "-f", "concat", "-i", list_path, *audio_input, "-map", "0:v", *audio_map,
+                           "-c", "copy", "-f", "mp4", out_path],
+                          timeout=transcode_timeout(duration), op="mp4_concat")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def enqueue_mp4_conversion(filename):
+    # A finished stream being copied into the cache produces the same file; wait for that instead.
+    remux = active_job("mp4_remux", filename)
+    if remux:
+        return remux, False
+    return enqueue_job("mp4", filename, mp4_stage)
+
+# Streaming conversion: fragmented MP4 can be written front to back with no
+# seeking, so it goes out to the client as ffmpeg produces it. The same bytes
+# are kept in UPLOAD_DIR, and once the stream ends a background job remuxes
+# them (stream copy) into the regular faststart file for the cache.
+MP4_STREAM_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+def stream_mp4(filename):
+    """A streaming response with filename converted to fragmented MP4 on the fly."""
+    frag_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.frag.mp4")
+    chunks = stream_ffmpeg([FFMPEG_PATH, "-y", "-i", os.path.join(RECDIR, filename), *MP4_ENCODE_ARGS,
+                            "-movflags", MP4_STREAM_MOVFLAGS, "-f", "mp4", "pipe:1"], op="mp4_stream")
+
+    def generate():
+        complete = False
+        try:
+            with open(frag_path, "wb") as cache:
+                for chunk in chunks:
+                    cache.write(chunk)
+                    yield chunk
+            complete = True
+        except subprocess.CalledProcessError as e:
+            # The headers are long gone; all we can do is end the response early.
+            app.logger.error(f"❌ Streaming MP4 conversion failed for {filename} with error code {e.returncode}:\n{e.stderr}")
+        except subprocess.TimeoutExpired:
+            app.logger.error(f"❌ Streaming MP4 conversion of {filename} stalled or ran too long and was stopped.")
+        finally:
+            chunks.close()
+            if not complete or not _finish_streamed_mp4(filename, frag_path):
+                if os.path.exists(frag_path):
+                    os.remove(frag_path)
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    response = Response(generate(), mimetype="video/mp4")
+    response.headers.set("Content-Disposition", "attachment", filename=filename.replace(".webm", ".mp4"))
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"   # don't let a proxy hold chunks back
+    return response
+
+def _finish_streamed_mp4(filename, frag_path):
+    """Queues the remux of a finished stream into the cache. Returns False if nothing was queued.
+
+    A download may be waiting on this job (see enqueue_mp4_conversion()), so
+    if the remux fails it converts the recording the regular way instead.
+    """
+    def remux(filename):
+        try:
+            if cache_lookup(content_hash_for(filename), "mp4", mp4_path_for(filename), record=False):
+                return
+            mp4_path = mp4_path_for(filename)
+            tmp_path = f"{mp4_path}.{uuid.uuid4().hex[:8]}.part"
+            os.makedirs(os.path.dirname(mp4_path), exist_ok=True)
+            try:
+                run_ffmpeg([FFMPEG_PATH, "-y", "-i", frag_path, "-c", "copy", "-movflags", "+faststart",
+                            "-f", "mp4", tmp_path], timeout=TRANSCODE_TIMEOUT_SECONDS, op="mp4_remux")
+                os.replace(tmp_path, mp4_path)
+            except (subprocess.SubprocessError, OSError) as e:
+                app.logger.warning(f"Could not cache the streamed MP4 for {filename}, converting it again: {e}")
+                convert_to_mp4(filename)   # raises TranscodeError, which fails the job
+                return
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            register_artifact(content_hash_for(filename), "mp4", mp4_path)
+            app.logger.info(f"✅ Cached streamed MP4 for {filename} at {mp4_path}")
+        finally:
+            os.remove(frag_path)
+
+    try:
+        # If a regular conversion is already on its way, this copy isn't needed.
+        if active_job("mp4", filename):
+            return False
+        _, created = enqueue_job("mp4_remux", filename, remux, priority=PRIORITY_BACKGROUND)
+    except Overloaded:
+        return False
+    return created
+
+# ─────────────────────────────────────────────────────────
+# Media Probing
+# ─────────────────────────────────────────────────────────
+# ffprobe runs at most once per version (size + mtime) of a recording. The
+# structured result lives in the probes table next to the recording's other
+# metadata, and clip, conversion, streaming and the UI timeline all read it
+# from there instead of probing again.
+
+def _parse_rate(rate):
+    try:
+        num, den = (rate or "0/0").split("/")
+        return round(int(num) / int(den), 3) if int(den) else None
+    except ValueError:
+        return None
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _run_ffprobe(path):
+    streams_cmd = [FFPROBE_PATH, "-v", "error", "-show_entries",
+                   "format=duration,bit_rate,format_name:stream=index,codec_type,codec_name,width,height,r_frame_rate,sample_rate,channels",
+                   "-of", "json", path]
+    # Both runs take an ffmpeg slot: the packet pass reads the whole file,
+    # and a request may be waiting on it (Overloaded if none frees up).
+    meta = json.loads(run_ffmpeg(streams_cmd, timeout=60, op="probe").stdout or "{}")
+    # Packet headers give keyframe positions and the real end time without
+    # decoding anything; MediaRecorder WebMs often carry no duration at all.
+    # One CSV line per packet ("pts_time,duration_time,flags") rather than a
+    # JSON object keeps the output of an hour-long recording to a few MB.
+    packets_cmd = [FFPROBE_PATH, "-v", "error", "-select_streams", "v:0",
+                   "-show_entries", "packet=pts_time,duration_time,flags", "-of", "csv=p=0", path]
+    packets = run_ffmpeg(packets_cmd, timeout=60, op="probe").stdout
+
+    keyframes, end = [], 0.0
+    for line in packets.splitlines():
+        fields = line.split(",")
+        pts = _float_or_none(fields[0])
+        if pts is None or len(fields) < 3:
+            continue
+        end = max(end, pts + (_float_or_none(fields[1]) or 0.0))
+        if "K" in fields[2]:
+            keyframes.append(pts)
+
+    video = next((st for st in meta.get("streams", []) if st.get("codec_type") == "video"), {})
+    audio = next((st for st in meta.get("streams", []) if st.get("codec_type") == "audio"), {})
+    fmt = meta.get("format", {})
+    return {
+        "duration": _float_or_none(fmt.get("duration")) or (round(end, 3) if end else None),
+        "format": fmt.get("format_name"),
+        "bit_rate": int(fmt["bit_rate"]) if str(fmt.get("bit_rate", "")).isdigit() else None,
+        "video": {
+            "codec": video.get("codec_name"),
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "fps": _parse_rate(video.get("r_frame_rate")),
+        } if video else None,
+        "audio": {
+            "codec": audio.get("codec_name"),
+            "sample_rate": int(audio["sample_rate"]) if audio.get("sample_rate") else None,
+            "channels": audio.get("channels"),
+        } if audio else None,
+        "keyframes": sorted(keyframes),
+    }
+
+def probe_recording(fname):
+    """Returns the cached ffprobe result for RECDIR/fname, probing if the file changed."""
+    st = os.stat(os.path.join(RECDIR, fname))
+    db = get_db()
+    row = db.execute("SELECT size, mtime_ns, info FROM probes WHERE filename = ?", (fname,)).fetchone()
+    if row and row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns:
+        return json.loads(row["info"])
+    info = dict(_run_ffprobe(os.path.join(RECDIR, fname)), size=st.st_size)
+    with db:
+        db.execute("INSERT OR REPLACE INTO probes (filename, size, mtime_ns, probed_at, info) VALUES (?, ?, ?, ?, ?)",
+                   (fname, st.st_size, st.st_mtime_ns, time.time(), json.dumps(info)))
+    return info
+
+def forget_probe(fname):
+    with get_db() as db:
+        db.execute("DELETE FROM probes WHERE filename = ?", (fname,))
+
+def keyframe_index(fname):
+    """{"codec", "keyframes"} for the clip engine, from the probe cache."""
+    info = probe_recording(fname)
+    return {"codec": (info["video"] or {}).get("codec"), "keyframes": info["keyframes"]}
+
+# ─────────────────────────────────────────────────────────
+# HLS Streaming
+# ─────────────────────────────────────────────────────────
+# Recordings are packaged as HLS (fMP4 segments) the first time someone asks
+# for a playlist. The playlist is an EVENT playlist, so it can be served as
+# soon as the first segment of each rendition exists: time to first frame is
+# one segment of encoding no matter how long the recording is.
+
+HLS_DIR = os.path.join(RECDIR, "hls")
+HLS_SEGMENT_SECONDS = 4
+HLS_STARTUP_WAIT_SECONDS = 10
+HLS_MASTER_PLAYLIST = "master.m3u8"
+HLS_RENDITIONS = [
+    # Heights are caps: a rendition never upscales a smaller recording.
+    {"height": 720, "video_bitrate": "2500k", "audio_bitrate": "128k"},
+    {"height": 360, "video_bitrate": "800k", "audio_bitrate": "96k"},
+]
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def hls_dir_for(filename):
+    return derived_path(HLS_DIR, filename, {"renditions": HLS_RENDITIONS, "segment_seconds": HLS_SEGMENT_SECONDS})
+
+def _hls_is_playable(out_dir):
+    # ffmpeg writes the master playlist once every rendition has a segment.
+    return os.path.exists(os.path.join(out_dir, HLS_MASTER_PLAYLIST))
+
+def build_hls(filename):
+    """Packages RECDIR/filename as multi-rendition HLS. Runs on a job worker."""
+    with artifact_build_lock(hls_dir_for(filename)):
+        _build_hls(filename)
+
+def _build_hls(filename):
+    in_path = os.path.join(RECDIR, filename)
+    out_dir = hls_dir_for(filename)
+    if cache_lookup(content_hash_for(filename), "hls", out_dir, record=False):
+        return
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+    info = probe_recording(filename)
+    audio = info["audio"] is not None
+    n = len(HLS_RENDITIONS)
+    split = f"[0:v]split={n}" + "".join(f"[s{i}]" for i in range(n))
+    scales = [f"[s{i}]scale=-2:'min({r['height']},ih)'[v{i}]" for i, r in enumerate(HLS_RENDITIONS)]
+    cmd = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y", "-i", in_path,
+           "-filter_complex", ";".join([split] + scales)]
+    stream_map = []
+    for i, r in enumerate(HLS_RENDITIONS):
+        cmd += ["-map", f"[v{i}]"]
+        if audio:
+            cmd += ["-map", "0:a:0"]
+        cmd += [f"-b:v:{i}", r["video_bitrate"]]
+        if audio:
+            cmd += [f"-b:a:{i}", r["audio_bitrate"]]
+        stream_map.append(f"v:{i},a:{i}" if audio else f"v:{i}")
+    gop = str(30 * HLS_SEGMENT_SECONDS)
+    cmd += [
+        "-c:v", "libx264", "-preset", "veryfast", "-r", "30",
+        # Fixed GOPs so every segment starts on a keyframe in every rendition.
+        "-g", gop, "-keyint_min", gop, "-sc_threshold", "0",
+        "-c:a", "aac",
+        "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "event",
+        "-hls_segment_type", "fmp4", "-hls_flags", "independent_segments+temp_file",
+        "-hls_fmp4_init_filename", "init.mp4",
+        "-hls_segment_filename", os.path.join(out_dir, "v%v", "seg_%05d.m4s"),
+        "-master_pl_name", HLS_MASTER_PLAYLIST,
+        "-var_stream_map", " ".join(stream_map),
+        os.path.join(out_dir, "v%v", "index.m3u8"),
+    ]
 
+    app.logger.info(f"Packaging {filename} as HLS...")
+    try:
+        run_ffmpeg(cmd, timeout=transcode_timeout(info["duration"]))
+    except subprocess.TimeoutExpired:
+        app.logger.error(f"❌ HLS packaging timed out for {filename}")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise TranscodeError("Streaming version took too long to prepare.")
+    except subprocess.CalledProcessError as e:
+        app.logger.error(f"❌ HLS packaging failed for {filename}:\n{e.stderr}")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise TranscodeError("Streaming version could not be prepared.")
+    except FileNotFoundError:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise TranscodeError("Server error: FFmpeg not found for streaming.")
+    except JobCancelled:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+
+    open(os.path.join(out_dir, ARTIFACT_COMPLETE_MARKER), "w").close()
+    register_artifact(content_hash_for(filename), "hls", out_dir)
+    app.logger.info(f"✅ HLS ready for {filename} in {out_dir}")
+
+def serve_hls_asset(filename, asset):
+    """Serves the master playlist (packaging on first request) or one of its files."""
+    if not os.path.exists(os.path.join(RECDIR, filename)):
+        return "❌ Recording not found.", 404
+    out_dir = hls_dir_for(filename)
+
+    if asset == HLS_MASTER_PLAYLIST and not cache_lookup(content_hash_for(filename), "hls", out_dir):
+        job = None
+        if not _hls_is_playable(out_dir):
+            limited = rate_limit_response()
+            if limited:
+                return limited
+            job, _ = enqueue_job("hls", filename, build_hls)
+        deadline = time.time() + HLS_STARTUP_WAIT_SECONDS
+        while not _hls_is_playable(out_dir) and time.time() < deadline:
+            if job:
+                job = get_job(job["id"]) or job
+            if job and job["state"] == JOB_FAILED:
+                return jsonify({"status": "fail", "error": job["error"]}), 500
+            time.sleep(0.25)
+        if not _hls_is_playable(out_dir):
+            response = jsonify({"status": "pending"})
+            response.status_code = 202
+            response.headers["Retry-After"] = "2"
+            return response
+
+    if asset.endswith(".m3u8"):
+        # Playlists keep growing until packaging is complete.
+        complete = os.path.exists(os.path.join(out_dir, ARTIFACT_COMPLETE_MARKER))
+        return send_media(out_dir, asset, mimetype="application/vnd.apple.mpegurl",
+                          cache_control="public, max-age=3600" if complete else "no-cache")
+    return send_media(out_dir, asset, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+# ─────────────────────────────────────────────────────────
+# Clip Engine
+# ─────────────────────────────────────────────────────────
+# Trims are stream-copied whenever the cut can start on a keyframe. Otherwise
+# only the partial GOP before the next keyframe is re-encoded (in the source's
+# codec) and concatenated with a stream-copied remainder. "precise" mode keeps
+# the old behaviour: a full re-encode of the requested range.
+
+CLIP_MODE_FAST, CLIP_MODE_PRECISE = "fast", "precise"
+CLIP_METHOD_COPY, CLIP_METHOD_SMART, CLIP_METHOD_REENCODE = "copy", "smart", "reencode"
+KEYFRAME_SNAP_SECONDS = 0.25   # how far a start point may be moved back onto a keyframe
+
+# Encoders that produce streams the concat demuxer can join with a stream copy of the source.
+SMART_CUT_ENCODERS = {"vp8": "libvpx", "vp9": "libvpx-vp9"}
+
+def plan_clip(keyframes, start, end, mode=CLIP_MODE_FAST):
+    """Chooses how to cut [start, end). Returns (method, cut_point)."""
+    if mode == CLIP_MODE_PRECISE or not keyframes:
+        return CLIP_METHOD_REENCODE, start
+    i = bisect.bisect_right(keyframes, start)
+    if i > 0 and start - keyframes[i - 1] <= KEYFRAME_SNAP_SECONDS:
+        return CLIP_METHOD_COPY, keyframes[i - 1]
+    if i < len(keyframes) and keyframes[i] - start <= KEYFRAME_SNAP_SECONDS:
+        return CLIP_METHOD_COPY, keyframes[i]
+    if i >= len(keyframes) or keyframes[i] >= end:
+        # The whole clip sits inside one GOP; re-encoding it is already cheap.
+        return CLIP_METHOD_REENCODE, start
+    return CLIP_METHOD_SMART, keyframes[i]
+
+def _run_clip_cmd(cmd):
+    run_ffmpeg([FFMPEG_PATH, "-hide_banner", "-loglevel", "error"] + cmd, op="clip")
+
+def cut_clip(fname, out_path, start, end, mode=CLIP_MODE_FAST):
+    """Writes RECDIR/fname[start:end] to out_path and returns the method used."""
+    in_path = os.path.join(RECDIR, fname)
+    index = None
+    if mode != CLIP_MODE_PRECISE:
+        try:
+            index = keyframe_index(fname)
         except Exception as e:
-            app.logger.error(f"[CRON] Error accessing directory {directory}: {e}")
-            
-    app.logger.info(f"--- [CRON] Cleanup finished. Deleted {deleted_count} old files. ---")
+            app.logger.warning(f"Keyframe probe failed for {fname}, falling back to re-encode: {e}")
+
+    method, cut = plan_clip(index["keyframes"] if index else [], start, end, mode)
+    if method == CLIP_METHOD_SMART and index.get("codec") not in SMART_CUT_ENCODERS:
+        method, cut = CLIP_METHOD_REENCODE, start
+
+    if method == CLIP_METHOD_COPY:
+        _run_clip_cmd(["-ss", str(cut), "-i", in_path, "-t", str(end - cut),
+                       "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero", "-y", out_path])
+    elif method == CLIP_METHOD_SMART:
+        work_dir = tempfile.mkdtemp(prefix=".clip_", dir=RECDIR)
+        try:
+            head, tail = os.path.join(work_dir, "head.webm"), os.path.join(work_dir, "tail.webm")
+            _run_clip_cmd(["-ss", str(start), "-i", in_path, "-t", str(cut - start),
+                           "-c:v", SMART_CUT_ENCODERS[index["codec"]], "-b:v", "2M",
+                           "-deadline", "realtime", "-cpu-used", "8",
+                           "-c:a", "libopus", "-b:a", "128k", "-y", head])
+            _run_clip_cmd(["-ss", str(cut), "-i", in_path, "-t", str(end - cut),
+                           "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero", "-y", tail])
+            list_path = os.path.join(work_dir, "list.txt")
+            with open(list_path, "w") as f:
+                f.write(f"file '{head}'\nfile '{tail}'\n")
+            _run_clip_cmd(["-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", "-y", out_path])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        _run_clip_cmd(["-ss", str(start), "-t", str(end - start), "-i", in_path,
+                       "-c:v", "libvpx-vp9", "-b:v", "1M",
+                       "-c:a", "libopus", "-b:a", "128k", "-y", out_path])
+    return method
+
+# Edit lists join ranges of one or more recordings in a single ffmpeg run.
+# If every range can start on a keyframe and all sources have the same
+# stream parameters, the concat demuxer stream-copies them (inpoint/outpoint
+# per entry). Otherwise one filter graph scales and concatenates the ranges
+# in a single decode/encode pass, with silence for sources without audio.
+
+EDIT_MAX_RANGES = 20
+EDIT_ENCODE_ARGS = ["-c:v", "libvpx-vp9", "-b:v", "1M", "-deadline", "realtime", "-cpu-used", "8",
+                    "-c:a", "libopus", "-b:a", "128k"]
+
+def _stream_signature(info):
+    video, audio = info["video"] or {}, info["audio"] or {}
+    return (video.get("codec"), video.get("width"), video.get("height"),
+            audio.get("codec"), audio.get("sample_rate"), audio.get("channels"))
+
+def plan_edit(ranges, infos, mode=CLIP_MODE_FAST):
+    """Chooses how to render [(source, start, end), ...]. Returns (method, ranges).
+
+    For CLIP_METHOD_COPY the returned starts are snapped onto keyframes.
+    """
+    if mode != CLIP_MODE_PRECISE and len({_stream_signature(infos[src]) for src, _, _ in ranges}) == 1:
+        snapped = []
+        for src, start, end in ranges:
+            method, cut = plan_clip(infos[src]["keyframes"], start, end, mode)
+            if method != CLIP_METHOD_COPY:
+                break
+            snapped.append((src, cut, end))
+        else:
+            return CLIP_METHOD_COPY, snapped
+    return CLIP_METHOD_REENCODE, ranges
+
+def _concat_entry(path):
+    return "file '" + path.replace("'", "'\\''") + "'\n"
+
+def _edit_filter_cmd(ranges, infos, out_path):
+    # One input per range, seeked with -ss, so no decoder reads more than its range.
+    first = infos[ranges[0][0]]["video"]
+    width, height = first.get("width") or 1280, first.get("height") or 720
+    has_audio = any(infos[src]["audio"] for src, _, _ in ranges)
+    inputs, filters, pads = [], [], []
+    for n, (src, start, end) in enumerate(ranges):
+        inputs += ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", os.path.join(RECDIR, src)]
+        filters.append(f"[{n}:v:0]setpts=PTS-STARTPTS,scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                       f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1[v{n}]")
+        pads.append(f"[v{n}]")
+        if has_audio:
+            if infos[src]["audio"]:
+                filters.append(f"[{n}:a:0]asetpts=PTS-STARTPTS,aresample=48000,aformat=channel_layouts=stereo[a{n}]")
+            else:
+                filters.append(f"anullsrc=r=48000:cl=stereo,atrim=duration={end - start:.3f}[a{n}]")
+            pads.append(f"[a{n}]")
+    outputs = "[v][a]" if has_audio else "[v]"
+    filters.append(f"{''.join(pads)}concat=n={len(ranges)}:v=1:a={int(has_audio)}{outputs}")
+    return inputs + ["-filter_complex", ";".join(filters), "-map", "[v]", *(["-map", "[a]"] if has_audio else []),
+                     *EDIT_ENCODE_ARGS, "-y", out_path]
+
+def render_edit(ranges, infos, out_path, mode=CLIP_MODE_FAST):
+    """Writes the ranges [(source, start, end), ...] back to back to out_path. Returns the method used.
+
+    `infos` maps each source to its probe_recording() result.
+    """
+    method, ranges = plan_edit(ranges, infos, mode)
+    if method == CLIP_METHOD_COPY:
+        work_dir = tempfile.mkdtemp(prefix=".edit_", dir=RECDIR)
+        try:
+            list_path = os.path.join(work_dir, "list.txt")
+            with open(list_path, "w") as f:
+                for src, start, end in ranges:
+                    f.write(_concat_entry(os.path.join(RECDIR, src)) + f"inpoint {start:.3f}\noutpoint {end:.3f}\n")
+            _run_clip_cmd(["-f", "concat", "-safe", "0", "-i", list_path, "-map", "0", "-c", "copy",
+                           "-avoid_negative_ts", "make_zero", "-y", out_path])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        _run_clip_cmd(_edit_filter_cmd(ranges, infos, out_path))
+    return method
+
+# ─────────────────────────────────────────────────────────
+# Post-Upload Pipeline
+# ─────────────────────────────────────────────────────────
+# As soon as a recording lands, the stages named in EAGER_PIPELINE are queued
+# as background jobs, so the first "Download MP4" is usually a cache hit.
+# A stage is any function of the recording's filename registered with
+# @pipeline_stage; its name doubles as the job kind, so an interactive request
+# for the same work joins (and re-prioritises) the queued stage.
+
+PIPELINE_STAGES = {}
+EAGER_PIPELINE = [name.strip() for name in os.getenv("EAGER_PIPELINE", "probe,previews,mp4").split(",") if name.strip()]
+
+PREVIEW_DIR = os.path.join(RECDIR, "previews")
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "jpg")   # "webp" needs an ffmpeg built with libwebp
+PREVIEW_POSTER_WIDTH = 480
+PREVIEW_TILE_WIDTH = 160
+PREVIEW_SPRITE_COLUMNS = 10
+PREVIEW_INTERVAL_SECONDS = 5
+PREVIEW_MAX_TILES = 100
+# After a failed on-demand build, requests get a 404 for this long instead of
+# another job. Job rows are only kept JOB_RETENTION_SECONDS, so no longer.
+PREVIEW_RETRY_SECONDS = min(int(os.getenv("PREVIEW_RETRY_SECONDS", "900")), JOB_RETENTION_SECONDS)
+
+def pipeline_stage(name):
+    def register(func):
+        PIPELINE_STAGES[name] = func
+        return func
+    return register
+
+def schedule_pipeline(filename):
+    for name in EAGER_PIPELINE:
+        func = PIPELINE_STAGES.get(name)
+        if func is None:
+            app.logger.warning(f"Unknown pipeline stage '{name}' in EAGER_PIPELINE; skipping.")
+            continue
+        try:
+            enqueue_job(name, filename, func, priority=PRIORITY_BACKGROUND)
+        except Overloaded:
+            # Every stage is also built on demand, so dropping one only costs latency later.
+            app.logger.warning(f"Job queue full; not scheduling '{name}' for {filename}.")
+
+def preview_dir_for(filename):
+    return derived_path(PREVIEW_DIR, filename, [PREVIEW_FORMAT, PREVIEW_POSTER_WIDTH, PREVIEW_TILE_WIDTH,
+                                                PREVIEW_SPRITE_COLUMNS, PREVIEW_INTERVAL_SECONDS, PREVIEW_MAX_TILES])
+
+@pipeline_stage("probe")
+def probe_stage(filename):
+    probe_recording(filename)
+
+@pipeline_stage("previews")
+def build_previews(filename):
+    """Poster, seek-preview sprite sheet and its WebVTT index, in one ffmpeg pass."""
+    with artifact_build_lock(preview_dir_for(filename)):
+        _build_previews(filename)
+
+def _build_previews(filename):
+    if cache_lookup(content_hash_for(filename), "previews", preview_dir_for(filename), record=False):
+        return
+    info = probe_recording(filename)
+    video = info["video"] or {}
+    duration = info["duration"] or 0
+    if not duration or not video.get("width") or not video.get("height"):
+        raise TranscodeError("Previews need a recording with a known duration and size.")
+
+    # Keep the sheet bounded for long recordings by widening the interval.
+    interval = max(PREVIEW_INTERVAL_SECONDS, math.ceil(duration / PREVIEW_MAX_TILES))
+    count = max(1, math.ceil(duration / interval))
+    cols = min(PREVIEW_SPRITE_COLUMNS, count)
+    rows = math.ceil(count / cols)
+    tile_w = PREVIEW_TILE_WIDTH
+    tile_h = max(2, round(tile_w * video["height"] / video["width"] / 2) * 2)
+
+    out_dir = preview_dir_for(filename)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    poster_path = os.path.join(out_dir, f"poster.{PREVIEW_FORMAT}")
+    sprite_name = f"sprite.{PREVIEW_FORMAT}"
+    graph = (f"[0:v]split=2[p][s];"
+             f"[p]thumbnail=30,scale={PREVIEW_POSTER_WIDTH}:-2[poster];"
+             f"[s]fps=1/{interval},scale={tile_w}:{tile_h},tile={cols}x{rows}[sprite]")
+    try:
+        run_ffmpeg([FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y",
+                    "-i", os.path.join(RECDIR, filename), "-filter_complex", graph,
+                    "-map", "[poster]", "-frames:v", "1", "-q:v", "4", poster_path,
+                    "-map", "[sprite]", "-frames:v", "1", "-q:v", "5", os.path.join(out_dir, sprite_name)],
+                   timeout=TRANSCODE_TIMEOUT_SECONDS)
+    except subprocess.CalledProcessError as e:
+        app.logger.error(f"❌ Preview generation failed for {filename}:\n{e.stderr}")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise TranscodeError("Previews could not be generated.")
+    except JobCancelled:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+
+    def stamp(t):
+        return f"{int(t // 3600):02d}:{int(t % 3600 // 60):02d}:{t % 60:06.3f}"
+
+    cues = ["WEBVTT", ""]
+    for i in range(count):
+        x, y = (i % cols) * tile_w, (i // cols) * tile_h
+        cues += [f"{stamp(i * interval)} --> {stamp(min((i + 1) * interval, duration))}",
+                 f"{sprite_name}#xywh={x},{y},{tile_w},{tile_h}", ""]
+    with open(os.path.join(out_dir, "thumbs.vtt"), "w") as f:
+        f.write("\n".join(cues))
+
+    open(os.path.join(out_dir, ARTIFACT_COMPLETE_MARKER), "w").close()
+    register_artifact(content_hash_for(filename), "previews", out_dir)
+
+@pipeline_stage("mp4")
+def mp4_stage(filename):
+    if not cache_lookup(content_hash_for(filename), "mp4", mp4_path_for(filename), record=False):
+        convert_to_mp4(filename)
+
+# Off by default; add "hls" to EAGER_PIPELINE to package streams up front.
+pipeline_stage("hls")(build_hls)
+
+# ─────────────────────────────────────────────────────────
+# Email Outbox
+# ─────────────────────────────────────────────────────────
+# Routes only insert a row into the outbox table and return. A sender
+# thread in each worker process claims due messages in batches (the claim
+# is one UPDATE, so two processes never send the same row), sends them over
+# one SMTP connection that stays open while there is mail to send, and
+# reschedules failures with exponential backoff. Rows survive restarts, so
+# nothing is lost if a worker dies mid-send.
+
+MAIL_BATCH_SIZE = 20
+MAIL_POLL_SECONDS = 5             # picks up mail queued by other processes and retries
+MAIL_IDLE_SECONDS = 30            # close the SMTP connection after this long without mail
+MAIL_CLAIM_SECONDS = 120
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "8"))
+MAIL_RETRY_BASE_SECONDS = 30
+MAIL_RETRY_MAX_SECONDS = 60 * 60
+MAIL_SENT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+_outbox_wakeup = threading.Event()
+_outbox_lock = threading.Lock()
+
+def mail_configured():
+    # A local debugging server takes mail without credentials.
+    config = current_app.config
+    local = config["MAIL_SERVER"] in ("localhost", "127.0.0.1")
+    return bool(config.get("MAIL_USERNAME")) and (bool(config.get("MAIL_PASSWORD")) or local)
+
+def queue_mail(subject, recipients, body, reply_to=None):
+    """Stores a message in the outbox for the sender thread. Returns its id."""
+    message = {"subject": subject, "recipients": recipients, "body": body, "reply_to": reply_to}
+    now = time.time()
+    with get_db() as db:
+        outbox_id = db.execute("INSERT INTO outbox (message, created, next_attempt_at) VALUES (?, ?, ?)",
+                               (json.dumps(message), now, now)).lastrowid
+    inc("grabscreen_outbox_messages_total", result="queued")
+    _ensure_outbox_sender(current_app._get_current_object())
+    _outbox_wakeup.set()
+    return outbox_id
+
+def _ensure_outbox_sender(flask_app):
+    # Like the job workers, started lazily so it runs in whichever process forked last.
+    # One per app, sending with that app's mail settings.
+    with _outbox_lock:
+        sender = flask_app.extensions.get("outbox_sender")
+        if sender is None or not sender.is_alive():
+            sender = threading.Thread(target=_outbox_loop, args=(flask_app,), name="outbox-sender", daemon=True)
+            sender.start()
+            flask_app.extensions["outbox_sender"] = sender
+
+def _claim_outbox_batch():
+    claim, now = uuid.uuid4().hex, time.time()
+    with get_db() as db:
+        db.execute("UPDATE outbox SET claim = ?, claimed_until = ? WHERE id IN ("
+                   "SELECT id FROM outbox WHERE state = 'pending' AND next_attempt_at <= ? "
+                   "AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY next_attempt_at LIMIT ?)",
+                   (claim, now + MAIL_CLAIM_SECONDS, now, now, MAIL_BATCH_SIZE))
+    return [dict(row) for row in get_db().execute("SELECT id, message, attempts FROM outbox WHERE claim = ?", (claim,))]
+
+def _mark_sent(outbox_id):
+    with get_db() as db:
+        db.execute("UPDATE outbox SET state = 'sent', sent_at = ?, claim = NULL, claimed_until = NULL, last_error = NULL "
+                   "WHERE id = ?", (time.time(), outbox_id))
+    inc("grabscreen_outbox_messages_total", result="sent")
+
+def _mark_failed(row, error):
+    attempts = row["attempts"] + 1
+    if attempts >= MAIL_MAX_ATTEMPTS:
+        state, next_attempt_at = "failed", time.time()
+        app.logger.error(f"❌ Giving up on outbox message {row['id']} after {attempts} attempts: {error}")
+    else:
+        state = "pending"
+        delay = min(MAIL_RETRY_MAX_SECONDS, MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        next_attempt_at = time.time() + delay * random.uniform(0.8, 1.2)
+        app.logger.warning(f"Outbox message {row['id']} failed (attempt {attempts}), retrying in {delay}s: {error}")
+    with get_db() as db:
+        db.execute("UPDATE outbox SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ?, claim = NULL, "
+                   "claimed_until = NULL WHERE id = ?", (state, attempts, next_attempt_at, str(error)[:500], row["id"]))
+    inc("grabscreen_outbox_messages_total", result="failed" if state == "failed" else "retry")
+
+def _close_smtp(conn):
+    try:
+        conn.__exit__(None, None, None)
+    except Exception:
+        pass
+
+def _outbox_loop(flask_app):
+    conn, last_sent = None, 0.0
+    with flask_app.app_context():
+        while True:
+            _outbox_wakeup.wait(MAIL_POLL_SECONDS)
+            _outbox_wakeup.clear()
+            try:
+                batch = _claim_outbox_batch()
+            except sqlite3.Error as e:
+                app.logger.error(f"Could not read the outbox: {e}")
+                continue
+            if not batch:
+                if conn is not None and time.time() - last_sent > MAIL_IDLE_SECONDS:
+                    _close_smtp(conn)
+                    conn = None
+                continue
+
+            for row in batch:
+                data = json.loads(row["message"])
+                msg = Message(subject=data["subject"], recipients=data["recipients"], body=data["body"],
+                              reply_to=data.get("reply_to"))
+                # A kept-alive connection may have been dropped by the server:
+                # reconnect once before counting it as a failed attempt.
+                for fresh in (False, True):
+                    try:
+                        if conn is None or fresh:
+                            if conn is not None:
+                                _close_smtp(conn)
+                            conn = mail.connect().__enter__()
+                        conn.send(msg)
+                        _mark_sent(row["id"])
+                        last_sent = time.time()
+                        break
+                    except smtplib.SMTPServerDisconnected as e:
+                        conn = None
+                        if fresh:
+                            _mark_failed(row, e)
+                    except Exception as e:
+                        if conn is not None:
+                            _close_smtp(conn)
+                        conn = None
+                        _mark_failed(row, e)
+                        break
+            # A full batch probably means more is waiting.
+            if len(batch) == MAIL_BATCH_SIZE:
+                _outbox_wakeup.set()
+
+def outbox_status(outbox_id):
+    row = get_db().execute("SELECT state, attempts, last_error FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+    return dict(row) if row else None
+
+def purge_sent_mail():
+    with get_db() as db:
+        return db.execute("DELETE FROM outbox WHERE state = 'sent' AND sent_at < ?",
+                          (time.time() - MAIL_SENT_RETENTION_SECONDS,)).rowcount
 
 # ─────────────────────────────────────────────────────────
 # Routes
 # ─────────────────────────────────────────────────────────
 
-@app.route("/")
+@bp.before_app_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    initialize()
+
+@bp.after_app_request
+def _record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        observe("grabscreen_http_request_duration_seconds", time.perf_counter() - started,
+                endpoint=endpoint_label(), method=request.method, status=response.status_code)
+    flush_metrics()
+    return response
+
+@bp.teardown_app_request
+def _release_request_db(exc):
+    release_db()
+
+@bp.route("/metrics", endpoint="metrics")
+def metrics_route():
+    response = make_response(render_metrics())
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+@bp.route("/")
 def index():
     return render_template("index.html", year=datetime.datetime.now().year)
 
 # In app.py
 
-@app.route("/upload", methods=["POST"])
+def _register_upload(fname, digest, duplicate=False):
+    """Adds a freshly stored recording to the caller's session and builds the upload response."""
+    token = request.cookies.get("magic_token")
+    if not session_exists(token):
+        token = create_session()
+
+    add_recording(fname, token, content_hash=digest)
+    schedule_pipeline(fname)
+
+    response = jsonify({"status": "ok", "filename": fname, "duplicate": duplicate})
+    response.set_cookie("magic_token", token, max_age=365*24*60*60)
+    return response
+
+def _record_upload(size, seconds, kind):
+    inc("grabscreen_upload_bytes_total", size, kind=kind)
+    if size and seconds > 0:
+        observe("grabscreen_upload_throughput_bytes_per_second", size / seconds, kind=kind)
+
+def _new_recording_name(prefix="recording"):
+    # The random suffix keeps uploads that land in the same second apart.
+    return f"{prefix}_{datetime.datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:6]}.webm"
+
+@bp.route("/upload", methods=["POST"])
 def upload():
     video_file = request.files.get("video")
     if not video_file:
         return jsonify({"status": "fail", "error": "No file"}), 400
 
-    fname = datetime.datetime.now().strftime("recording_%Y%m%d_%H%M%S.webm")
-    save_path = os.path.join(RECDIR, fname)
+    fname = _new_recording_name()
+    tmp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
 
     try:
-        # --- NEW: Memory-efficient streaming save ---
-        CHUNK_SIZE = 4096  # Process in 4KB chunks
-        with open(save_path, "wb") as f:
-            while True:
-                chunk = video_file.stream.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                f.write(chunk)
-        app.logger.info(f"Successfully saved uploaded video to {save_path} by streaming.")
-        # --- END NEW ---
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        # Hash while streaming so storing the blob needs no second read.
+        started = time.perf_counter()
+        with open(tmp_path, "wb", buffering=UPLOAD_BUFFER_SIZE) as f:
+            digest = copy_hashing(video_file.stream, f)
+            size = f.tell()
+        _record_upload(size, time.perf_counter() - started, "single")
+        duplicate = store_recording(tmp_path, digest, fname)
+        app.logger.info(f"Successfully saved uploaded video as {fname} by streaming{' (duplicate content)' if duplicate else ''}.")
     except Exception as e:
         app.logger.error(f"Failed to save uploaded video file: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return jsonify({"status": "fail", "error": str(e)}), 500
 
-    token = request.cookies.get("magic_token")
-    if not token or token not in user_sessions:
-        token = uuid.uuid4().hex[:16]
-        user_sessions[token] = []
+    return _register_upload(fname, digest, duplicate)
+
+# --- Resumable chunked uploads ---
+# init -> PUT chunks at byte offsets -> finalize. Chunks go straight into a
+# (preallocated) .part file, and progress is kept in a small JSON state file so
+# an interrupted upload can resume from whatever worker picks it up next.
+# While chunks arrive in order on one worker they are hashed as they stream
+# in; anything else (a resume elsewhere, a gap) falls back to hashing the
+# assembled file at finalize.
+
+# upload_id -> (sha256 object, bytes hashed so far, last used), least recently
+# used first. Finalize removes an entry; one whose upload was abandoned is
+# dropped after UPLOAD_STALE_SECONDS or when more than UPLOAD_HASHERS_MAX are
+# in progress. Losing one only means hashing the file at finalize.
+UPLOAD_HASHERS_MAX = 1000
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+def _take_upload_hasher(upload_id):
+    with _upload_hashers_lock:
+        hasher, hashed, _ = _upload_hashers.pop(upload_id, (None, 0, None))
+    return hasher, hashed
+
+def _keep_upload_hasher(upload_id, hasher, hashed):
+    now = time.time()
+    with _upload_hashers_lock:
+        _upload_hashers[upload_id] = (hasher, hashed, now)
+        for stale_id, (_, _, used) in list(_upload_hashers.items()):
+            if used >= now - UPLOAD_STALE_SECONDS and len(_upload_hashers) <= UPLOAD_HASHERS_MAX:
+                break
+            del _upload_hashers[stale_id]
+
+def _upload_paths(upload_id):
+    return (os.path.join(UPLOAD_DIR, f"{upload_id}.json"),
+            os.path.join(UPLOAD_DIR, f"{upload_id}.part"))
+
+def _load_upload(upload_id):
+    if not UPLOAD_ID_RE.fullmatch(upload_id):
+        return None
+    state_path, _ = _upload_paths(upload_id)
+    state = load_json(state_path)
+    return state or None
+
+def _save_upload(state):
+    state_path, _ = _upload_paths(state["upload_id"])
+    tmp_path = state_path + ".tmp"
+    save_json(state, tmp_path)
+    os.replace(tmp_path, state_path)
+
+@bp.route("/upload/init", methods=["POST"], endpoint="upload_init")
+def upload_init():
+    data = request.get_json(silent=True) or {}
+    size = data.get("size")
+    if size is not None:
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            return jsonify({"status": "fail", "error": "Invalid size"}), 400
+        if size <= 0 or size > MAX_UPLOAD_BYTES:
+            return jsonify({"status": "fail", "error": f"Upload size must be between 1 and {MAX_UPLOAD_BYTES} bytes"}), 413
+
+    upload_id = uuid.uuid4().hex
+    _, part_path = _upload_paths(upload_id)
+    try:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        with open(part_path, "wb") as f:
+            # Reserve the space up front when the client knows the total size,
+            # so out-of-order or resumed writes never extend a fragmented file.
+            if size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+        _save_upload({"upload_id": upload_id, "size": size, "received": 0, "created": time.time()})
+    except Exception as e:
+        app.logger.error(f"Failed to start chunked upload: {e}")
+        return jsonify({"status": "fail", "error": "Could not start the upload."}), 500
 
-    user_sessions[token].append(fname)
-    save_json(user_sessions, SESSIONS_FILE)
+    return jsonify({"status": "ok", "upload_id": upload_id, "received": 0, "chunk_size": UPLOAD_BUFFER_SIZE})
 
-    response = jsonify({"status": "ok", "filename": fname})
-    response.set_cookie("magic_token", token, max_age=365*24*60*60)
-    return response
+@bp.route("/upload/<upload_id>", methods=["GET"], endpoint="upload_status")
+def upload_status(upload_id):
+    state = _load_upload(upload_id)
+    if not state:
+        return jsonify({"status": "fail", "error": "Unknown upload"}), 404
+    return jsonify({"status": "ok", "upload_id": upload_id, "received": state["received"], "size": state["size"]})
 
-@app.route("/session/files")
+@bp.route("/upload/<upload_id>", methods=["PUT"], endpoint="upload_chunk")
+def upload_chunk(upload_id):
+    state = _load_upload(upload_id)
+    if not state:
+        return jsonify({"status": "fail", "error": "Unknown upload"}), 404
+
+    try:
+        offset = int(request.args.get("offset", state["received"]))
+    except ValueError:
+        return jsonify({"status": "fail", "error": "Invalid offset"}), 400
+    # Chunks may overlap what we already have (a retried request) but may not
+    # leave a gap; tell the client where to resume from instead.
+    if offset < 0 or offset > state["received"]:
+        return jsonify({"status": "fail", "error": "Offset does not match received bytes", "received": state["received"]}), 409
+
+    limit = state["size"] or MAX_UPLOAD_BYTES
+    length = request.content_length
+    if length is not None and offset + length > limit:
+        return jsonify({"status": "fail", "error": "Chunk exceeds the upload size", "received": state["received"]}), 413
+
+    _, part_path = _upload_paths(upload_id)
+    hasher, hashed = _take_upload_hasher(upload_id)
+    if hasher is None and offset == 0:
+        hasher = hashlib.sha256()
+    if hashed < offset:
+        hasher = None
+    written = 0
+    started = time.perf_counter()
+    try:
+        with open(part_path, "r+b", buffering=UPLOAD_BUFFER_SIZE) as f:
+            f.seek(offset)
+            while True:
+                chunk = request.stream.read(UPLOAD_BUFFER_SIZE)
+                if not chunk:
+                    break
+                if offset + written + len(chunk) > limit:
+                    return jsonify({"status": "fail", "error": "Chunk exceeds the upload size", "received": state["received"]}), 413
+                f.write(chunk)
+                if hasher is not None:
+                    # A retried chunk overlaps bytes already hashed; only feed the new tail.
+                    skip = max(0, hashed - (offset + written))
+                    if skip < len(chunk):
+                        hasher.update(chunk[skip:] if skip else chunk)
+                        hashed = offset + written + len(chunk)
+                written += len(chunk)
+    except Exception as e:
+        app.logger.error(f"Failed to write chunk for upload {upload_id} at offset {offset}: {e}")
+        return jsonify({"status": "fail", "error": "Could not save the chunk.", "received": state["received"]}), 500
+
+    _record_upload(written, time.perf_counter() - started, "chunked")
+    state["received"] = max(state["received"], offset + written)
+    if hasher is not None:
+        _keep_upload_hasher(upload_id, hasher, hashed)
+    _save_upload(state)
+    return jsonify({"status": "ok", "received": state["received"]})
+
+@bp.route("/upload/<upload_id>/finalize", methods=["POST"], endpoint="upload_finalize")
+def upload_finalize(upload_id):
+    state = _load_upload(upload_id)
+    if not state:
+        return jsonify({"status": "fail", "error": "Unknown upload"}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get("size", state["received"]))
+    except (TypeError, ValueError):
+        return jsonify({"status": "fail", "error": "Invalid size"}), 400
+    if size <= 0 or size != state["received"] or (state["size"] and size != state["size"]):
+        return jsonify({"status": "fail", "error": "Upload is incomplete", "received": state["received"]}), 409
+
+    state_path, part_path = _upload_paths(upload_id)
+    fname = _new_recording_name()
+    hasher, hashed = _take_upload_hasher(upload_id)
+    try:
+        # Drop any preallocated tail beyond what was actually sent.
+        os.truncate(part_path, size)
+        digest = hasher.hexdigest() if hasher is not None and hashed == size else hash_file(part_path)
+        duplicate = store_recording(part_path, digest, fname)
+        os.remove(state_path)
+        app.logger.info(f"Successfully assembled chunked upload {upload_id} into {fname} ({size} bytes"
+                        f"{', duplicate content' if duplicate else ''}).")
+    except Exception as e:
+        app.logger.error(f"Failed to finalize chunked upload {upload_id}: {e}")
+        return jsonify({"status": "fail", "error": "Could not finalize the upload."}), 500
+
+    return _register_upload(fname, digest, duplicate)
+
+@bp.route("/session/files")
 def session_files():
     token = request.cookies.get("magic_token")
-    if not token or token not in user_sessions:
+    if not session_exists(token):
         return jsonify({"status": "empty", "files": []})
     
-    # Ensure all files in the session actually exist on disk
-    existing_files = [f for f in user_sessions.get(token, []) if os.path.exists(os.path.join(RECDIR, f))]
-    if len(existing_files) != len(user_sessions.get(token, [])):
-        user_sessions[token] = existing_files
-        save_json(user_sessions, SESSIONS_FILE)
-
-    return jsonify({"status": "ok", "files": existing_files})
+    # Cleanup removes session entries together with their files, so the
+    # index can be trusted without a stat per file.
+    return jsonify({"status": "ok", "files": session_recordings(token)})
 
-@app.route("/session/forget", methods=["POST"])
+@bp.route("/session/forget", methods=["POST"])
 def forget_session():
     token = request.cookies.get("magic_token")
-    if token and token in user_sessions:
-        del user_sessions[token]
-        save_json(user_sessions, SESSIONS_FILE)
+    if session_exists(token):
+        forget_session_token(token)
     response = jsonify({"status": "ok"})
     response.set_cookie("magic_token", "", expires=0)
     return response
 
-@app.route("/clip/<orig>", methods=["POST"])
+@bp.route("/clip/<orig>", methods=["POST"])
 def clip(orig):
     try:
         data = request.get_json(force=True)
         start = float(data["start"])
         end = float(data["end"])
+        mode = data.get("mode", CLIP_MODE_FAST)
     except Exception as e:
         return jsonify({"status": "fail", "error": f"Invalid JSON: {str(e)}"}), 400
 
     if start >= end:
         return jsonify({"status": "fail", "error": "Start time must be less than end time"}), 400
+    if mode not in (CLIP_MODE_FAST, CLIP_MODE_PRECISE):
+        return jsonify({"status": "fail", "error": f"Unknown clip mode: {mode}"}), 400
 
     in_path = os.path.join(RECDIR, orig)
     if not os.path.exists(in_path):
         return jsonify({"status": "fail", "error": "Original file not found"}), 404
 
-    clip_name = datetime.datetime.now().strftime("clip_%Y%m%d_%H%M%S.webm")
-    out_path = os.path.join(RECDIR, clip_name)
-    duration = end - start
+    try:
+        duration = probe_recording(orig)["duration"]
+    except Overloaded:
+        raise
+    except Exception as e:
+        app.logger.warning(f"Probe failed for {orig}; clipping without a duration check: {e}")
+        duration = None
+    if duration and start >= duration:
+        return jsonify({"status": "fail", "error": f"Start time is past the end of the recording ({duration:.1f}s)"}), 400
+    end = min(end, duration) if duration else end
+
+    clip_name = _new_recording_name("clip")
+    # Same source content, same cut: reuse the earlier clip's bytes.
+    derived_key = f"clip:{content_hash_for(orig)}:{start:.3f}:{end:.3f}:{mode}"
+    out_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.webm")
 
-    cmd = [
-        FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
-        "-ss", str(start), "-t", str(duration), "-i", in_path,
-        "-c:v", "libvpx-vp9", "-b:v", "1M",
-        "-c:a", "libopus", "-b:a", "128k",
-        "-y", out_path
-    ]
     try:
-        # For cross-platform, it's safer to rely on FFMPEG_PATH being an absolute path or in system PATH.
-        subprocess.run(cmd, check=True, capture_output=True, text=True) 
+        digest = find_derived_recording(derived_key)
+        if digest:
+            _link_blob(digest, os.path.join(RECDIR, clip_name))
+            method = "cached"
+        else:
+            limited = rate_limit_response()
+            if limited:
+                return limited
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+            method = cut_clip(orig, out_path, start, end, mode)
+            digest = hash_file(out_path)
+            store_recording(out_path, digest, clip_name)
+        app.logger.info(f"Clipped {orig} [{start}-{end}] into {clip_name} using {method}")
         token = request.cookies.get("magic_token")
-        if token and token in user_sessions:
-            user_sessions[token].append(clip_name)
-            save_json(user_sessions, SESSIONS_FILE)
-        return jsonify({"status": "ok", "clip": clip_name})
+        add_recording(clip_name, token if session_exists(token) else None, content_hash=digest, derived_key=derived_key)
+        schedule_pipeline(clip_name)
+        return jsonify({"status": "ok", "clip": clip_name, "method": method})
+    except Overloaded:
+        raise
     except subprocess.CalledProcessError as e:
         app.logger.error(f"FFmpeg clipping failed for {orig}: {e.stderr}")
         return jsonify({"status": "fail", "error": e.stderr}), 500
@@ -287,163 +3128,344 @@ def clip(orig):
     except Exception as e:
         app.logger.error(f"Unexpected error during clipping for {orig}: {e}")
         return jsonify({"status": "fail", "error": f"An unexpected error occurred during clipping: {str(e)}"}), 500
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+@bp.route("/edit", methods=["POST"], endpoint="edit")
+def edit():
+    """Joins {"ranges": [{"source", "start", "end"}, ...]} into one new recording."""
+    try:
+        data = request.get_json(force=True)
+        ranges = [(str(r["source"]), float(r["start"]), float(r["end"])) for r in data["ranges"]]
+        mode = data.get("mode", CLIP_MODE_FAST)
+    except Exception as e:
+        return jsonify({"status": "fail", "error": f"Invalid JSON: {str(e)}"}), 400
+
+    if not ranges or len(ranges) > EDIT_MAX_RANGES:
+        return jsonify({"status": "fail", "error": f"An edit needs between 1 and {EDIT_MAX_RANGES} ranges"}), 400
+    if mode not in (CLIP_MODE_FAST, CLIP_MODE_PRECISE):
+        return jsonify({"status": "fail", "error": f"Unknown clip mode: {mode}"}), 400
+
+    infos, checked = {}, []
+    for src, start, end in ranges:
+        if os.path.basename(src) != src or not src.endswith(".webm") or not os.path.isfile(os.path.join(RECDIR, src)):
+            return jsonify({"status": "fail", "error": f"Recording not found: {src}"}), 404
+        if src not in infos:
+            try:
+                infos[src] = probe_recording(src)
+            except Overloaded:
+                raise
+            except Exception as e:
+                app.logger.error(f"Probe failed for {src} during edit: {e}")
+                return jsonify({"status": "fail", "error": f"Could not read {src}"}), 500
+            if not infos[src]["video"]:
+                return jsonify({"status": "fail", "error": f"{src} has no video"}), 400
+        duration = infos[src]["duration"]
+        end = min(end, duration) if duration else end
+        if start < 0 or start >= end:
+            return jsonify({"status": "fail", "error": f"Invalid range {start}-{end} for {src}"}), 400
+        checked.append((src, start, end))
+
+    name = _new_recording_name("edit")
+    # Same sources, same ranges: reuse the earlier edit's bytes.
+    spec = [[content_hash_for(src), f"{start:.3f}", f"{end:.3f}"] for src, start, end in checked]
+    derived_key = "edit:" + hashlib.sha256(json.dumps([spec, mode]).encode()).hexdigest()
+    out_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.webm")
+
+    try:
+        digest = find_derived_recording(derived_key)
+        if digest:
+            _link_blob(digest, os.path.join(RECDIR, name))
+            method = "cached"
+        else:
+            limited = rate_limit_response()
+            if limited:
+                return limited
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+            method = render_edit(checked, infos, out_path, mode)
+            digest = hash_file(out_path)
+            store_recording(out_path, digest, name)
+        app.logger.info(f"Rendered {len(checked)} range(s) into {name} using {method}")
+        token = request.cookies.get("magic_token")
+        add_recording(name, token if session_exists(token) else None, content_hash=digest, derived_key=derived_key)
+        schedule_pipeline(name)
+        return jsonify({"status": "ok", "recording": name, "method": method,
+                        "duration": round(sum(end - start for _, start, end in checked), 3)})
+    except Overloaded:
+        raise
+    except subprocess.CalledProcessError as e:
+        app.logger.error(f"FFmpeg edit failed: {e.stderr}")
+        return jsonify({"status": "fail", "error": e.stderr}), 500
+    except FileNotFoundError:
+        app.logger.error(f"FFmpeg command not found during edit. Path used: {FFMPEG_PATH}")
+        return jsonify({"status": "fail", "error": "Server error: FFmpeg not found for video editing."}), 500
+    except Exception as e:
+        app.logger.error(f"Unexpected error during edit: {e}")
+        return jsonify({"status": "fail", "error": f"An unexpected error occurred during editing: {str(e)}"}), 500
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+@bp.route("/info/<fname>", endpoint="recording_info")
+def recording_info(fname):
+    if not os.path.exists(os.path.join(RECDIR, fname)):
+        return jsonify({"status": "fail", "error": "File not found"}), 404
+    try:
+        info = probe_recording(fname)
+    except Overloaded:
+        raise
+    except Exception as e:
+        app.logger.error(f"Probe failed for {fname}: {e}")
+        return jsonify({"status": "fail", "error": "Could not read the recording's metadata."}), 500
+    if request.args.get("keyframes") != "1":
+        info = {k: v for k, v in info.items() if k != "keyframes"}
+    return jsonify({"status": "ok", "info": info})
 
-@app.route("/recordings/<fname>", endpoint="get_recording_webm")
+@bp.route("/recordings/<fname>", endpoint="get_recording_webm")
 def recordings(fname):
     # This serves WEBM files for preview and default download
-    return send_from_directory(RECDIR, fname, mimetype="video/webm")
+    return send_media(RECDIR, fname, mimetype="video/webm")
 
-@app.route("/download/<fname>", endpoint="download_webm")
+@bp.route("/hls/<fname>/<path:asset>", endpoint="get_recording_hls")
+def recording_hls(fname, asset):
+    return serve_hls_asset(fname, asset)
+
+@bp.route("/previews/<fname>/<asset>", endpoint="get_recording_preview")
+def recording_preview(fname, asset):
+    if not os.path.exists(os.path.join(RECDIR, fname)):
+        return "❌ Recording not found.", 404
+    out_dir = preview_dir_for(fname)
+    if not cache_lookup(content_hash_for(fname), "previews", out_dir):
+        # Recordings from before the pipeline existed: build on demand and let
+        # the client fall back to the video element meanwhile. Every card on
+        # a page asks at once, so these queue as background work, and a
+        # recording whose previews just failed isn't tried again yet.
+        failed = get_db().execute("SELECT error FROM jobs WHERE kind = 'previews' AND filename = ? AND state = ? "
+                                  "AND finished > ?", (fname, JOB_FAILED, time.time() - PREVIEW_RETRY_SECONDS)).fetchone()
+        if failed:
+            return jsonify({"status": "fail", "error": failed["error"]}), 404
+        if not active_job("previews", fname):
+            limited = rate_limit_response(scope="previews:")
+            if limited:
+                return limited
+            enqueue_job("previews", fname, build_previews, priority=PRIORITY_BACKGROUND)
+        response = jsonify({"status": "pending"})
+        response.status_code = 202
+        response.headers["Retry-After"] = "5"
+        return response
+    if asset == "poster":
+        # Extension-less alias so pages don't need to know PREVIEW_FORMAT.
+        asset = f"poster.{PREVIEW_FORMAT}"
+    return send_media(out_dir, asset, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+@bp.route("/download/<fname>", endpoint="download_webm")
 def download(fname):
     # This is the default WEBM download
-    return send_from_directory(RECDIR, fname, as_attachment=True, mimetype="video/webm")
-
-@app.route("/download/mp4/<filename>", endpoint="download_mp4")
-def download_mp4(filename):
-    app.logger.info(f"DEBUG: Entering download_mp4 function for {filename}")
+    return send_media(RECDIR, fname, as_attachment=True, mimetype="video/webm")
 
+def _validate_mp4_source(filename):
+    """Returns an error response tuple if `filename` can't be converted, else None."""
     if not filename.endswith(".webm"):
         return jsonify({"status": "fail", "error": "Invalid file type. Only .webm allowed for conversion input."}), 400
-
     webm_path = os.path.join(RECDIR, filename)
     if not os.path.exists(webm_path):
         app.logger.error(f"❌ Original WEBM file not found at path: {webm_path}")
         return jsonify({"status": "fail", "error": "Original WEBM file not found"}), 404
+    return None
+
+def _mp4_is_ready(filename, record=True):
+    return cache_lookup(content_hash_for(filename), "mp4", mp4_path_for(filename), record=record)
+
+def _job_response(job, code=202):
+    response = jsonify({
+        "status": "ok",
+        "job": job_to_dict(job),
+        "status_url": request.url_root.rstrip("/") + f"/jobs/{job['id']}",
+        "ready_url": request.url_root.rstrip("/") + f"/jobs/{job['id']}/ready",
+    })
+    response.status_code = code
+    if code == 202:
+        response.headers["Retry-After"] = "2"
+    return response
 
-    mp4_filename = filename.replace(".webm", ".mp4")
-    mp4_path = os.path.join(MP4_DIR, mp4_filename)
-
-    # Check if MP4 already exists and is not empty
-    if os.path.exists(mp4_path) and os.path.getsize(mp4_path) > 0:
-        app.logger.info(f"Serving existing MP4: {mp4_filename}")
-        return send_from_directory(MP4_DIR, mp4_filename, as_attachment=True, mimetype="video/mp4")
-
-    app.logger.info(f"Attempting to convert {filename} to MP4...")
-
-    ffmpeg_cmd = [
-        FFMPEG_PATH,
-        "-y",                 # Overwrite output file without asking
-        "-i", webm_path,      # Input WEBM file
-        "-r", "30",           # Force output framerate to 30 FPS
-        "-c:v", "libx264",
-        "-preset", "ultrafast", # Faster encoding, lower quality/larger file for quick conversions
-        "-crf", "28",         # Constant Rate Factor (0-51), higher means lower quality/smaller file
-        "-c:a", "aac",
-        "-b:a", "64k",
-        mp4_path,
-    ]
-
-    app.logger.info(f"DEBUG: FFmpeg command list: {ffmpeg_cmd}")
-    app.logger.info(f"DEBUG: Checking FFMPEG_PATH existence: {os.path.exists(FFMPEG_PATH)}")
-
-    try:
-        result = subprocess.run(ffmpeg_cmd, check=True, capture_output=True, text=True, timeout=120) # Increased timeout to 120s
-
-        app.logger.info(f"DEBUG: subprocess.run completed. Return code: {result.returncode}")
-        app.logger.info(f"✅ FFmpeg stdout for {filename}:\n{result.stdout}")
-        if result.stderr:
-            app.logger.warning(f"⚠️ FFmpeg stderr (might be warnings) for {filename}:\n{result.stderr}")
-
-        if not os.path.exists(mp4_path) or os.path.getsize(mp4_path) == 0:
-            app.logger.error(f"❌ Converted MP4 is 0 bytes or missing after conversion: {mp4_path}")
-            return jsonify({
-                "status": "fail",
-                "error": "Converted video is empty or corrupt. Try re-uploading or trimming the recording."
-            }), 500
-
-        app.logger.info(f"✅ Successfully converted and serving new MP4: {mp4_filename}")
-        return send_from_directory(MP4_DIR, mp4_filename, as_attachment=True, mimetype="video/mp4")
-
-    except subprocess.TimeoutExpired as e:
-        app.logger.error(f"❌ FFmpeg conversion timed out for {filename} after {e.timeout} seconds. Stderr from partial output: {e.stderr}")
-        return jsonify({"status": "fail", "error": f"Video conversion timed out ({e.timeout}s). Try a shorter clip or simpler conversion. Server might be under heavy load or resource constraints."}), 500
-    except subprocess.CalledProcessError as e:
-        app.logger.error(f"❌ FFmpeg conversion failed for {filename} with error code {e.returncode}:\n{e.stderr}")
-        return jsonify({"status": "fail", "error": f"Video conversion failed: {e.stderr}"}), 500
-    except FileNotFoundError:
-        app.logger.error(f"❌ FFmpeg command not found. Ensure FFmpeg is installed on the server at '{FFMPEG_PATH}' or is in the system's PATH.")
-        return jsonify({"status": "fail", "error": "Server error: FFmpeg not found for video conversion."}), 500
-    except Exception as e:
-        app.logger.error(f"❌ Unexpected error during conversion for {filename}: {e}")
-        return jsonify({"status": "fail", "error": f"An unexpected error occurred during conversion: {str(e)}"}), 500
-
-@app.route("/link/secure/<fname>", endpoint="generate_secure_link")
+@bp.route("/download/mp4/<filename>", endpoint="download_mp4")
+def download_mp4(filename):
+    error = _validate_mp4_source(filename)
+    if error:
+        return error
+
+    # Serve the cached conversion if we have one; otherwise queue a job and let
+    # the client poll instead of holding this worker for the whole encode.
+    if _mp4_is_ready(filename):
+        mp4_path = mp4_path_for(filename)
+        app.logger.info(f"Serving existing MP4: {os.path.basename(mp4_path)}")
+        return send_media(MP4_DIR, os.path.relpath(mp4_path, MP4_DIR).replace(os.sep, "/"),
+                          as_attachment=True, download_name=filename.replace(".webm", ".mp4"),
+                          mimetype="video/mp4")
+
+    limited = rate_limit_response()
+    if limited:
+        return limited
+    # ?stream=1 sends fragmented MP4 while it's being encoded instead of a job to poll.
+    if request.args.get("stream") == "1":
+        return stream_mp4(filename)
+    job, _ = enqueue_mp4_conversion(filename)
+    return _job_response(job)
+
+@bp.route("/convert/mp4/<filename>", methods=["POST"], endpoint="enqueue_mp4")
+def enqueue_mp4(filename):
+    error = _validate_mp4_source(filename)
+    if error:
+        return error
+
+    # The client follows download_url next, which records the cache hit.
+    if _mp4_is_ready(filename, record=False):
+        return jsonify({
+            "status": "ok",
+            "ready": True,
+            "download_url": request.url_root.rstrip("/") + f"/download/mp4/{filename}",
+        })
+
+    limited = rate_limit_response()
+    if limited:
+        return limited
+    job, created = enqueue_mp4_conversion(filename)
+    if created:
+        _bump_cache_stat("misses")
+    app.logger.info(f"MP4 conversion for {filename}: {'queued new' if created else 'joined existing'} job {job['id']}")
+    return _job_response(job)
+
+@bp.route("/cache/stats", endpoint="cache_stats_route")
+def cache_stats_route():
+    return jsonify({"status": "ok", "cache": cache_stats()})
+
+@bp.route("/jobs/<job_id>", endpoint="job_status")
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"status": "fail", "error": "Unknown job"}), 404
+    return jsonify({"status": "ok", "job": job_to_dict(job)})
+
+@bp.route("/jobs/<job_id>/ready", endpoint="job_ready")
+def job_ready(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"status": "fail", "error": "Unknown job"}), 404
+    if job["state"] == JOB_FAILED:
+        return jsonify({"status": "fail", "error": job["error"]}), 500
+    if job["state"] == JOB_CANCELLED:
+        # Final, like a failure: nothing will make this job ready.
+        return jsonify({"status": "fail", "error": job["error"] or "Cancelled", "job": job_to_dict(job)}), 410
+    if job["state"] != JOB_DONE:
+        return _job_response(job)
+    return redirect(request.url_root.rstrip("/") + f"/download/mp4/{job['filename']}")
+
+def link_serializer():
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
+
+@bp.route("/link/secure/<fname>", endpoint="generate_secure_link")
 def generate_secure_link(fname):
     if not os.path.exists(os.path.join(RECDIR, fname)):
         return jsonify({"status": "fail", "error": "file not found"}), 404
 
-    token = serializer.dumps(fname)
+    token = link_serializer().dumps(fname)
     url = request.url_root.rstrip("/") + "/secure/" + token
     return jsonify({"status": "ok", "url": url})
 
-@app.route("/secure/<token>", endpoint="secure_download")
+@bp.route("/secure/<token>", endpoint="secure_download")
 def secure_download(token):
     try:
-        fname = serializer.loads(token, max_age=TOKEN_EXPIRY_SECONDS)
+        fname = link_serializer().loads(token, max_age=TOKEN_EXPIRY_SECONDS)
     except SignatureExpired:
         return "⏳ Link expired.", 410
     except BadSignature:
         return "❌ Invalid link.", 400
-    return send_from_directory(RECDIR, fname)
+    return send_media(RECDIR, fname)
 
-@app.route("/link/public/<fname>", methods=["GET"], endpoint="get_or_create_public_link")
+def _public_playlist_url(token):
+    return request.url_root.rstrip("/") + f"/public/{token}/hls/{HLS_MASTER_PLAYLIST}"
+
+@bp.route("/link/public/<fname>", methods=["GET"], endpoint="get_or_create_public_link")
 def get_or_create_public_link(fname):
-    global public_links
-    public_links = load_json(LINKS_FILE)
     if not os.path.exists(os.path.join(RECDIR, fname)):
         return jsonify({"status": "fail", "error": "File not found"}), 404
 
-    for token, f in public_links.items():
-        if f == fname:
-            url = request.url_root.rstrip("/") + "/public/" + token
-            return jsonify({"status": "ok", "url": url, "isNew": False})
+    token = link_token_for(fname)
+    if token:
+        url = request.url_root.rstrip("/") + "/public/" + token
+        return jsonify({"status": "ok", "url": url, "playlist_url": _public_playlist_url(token), "isNew": False})
 
-    token = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-    public_links[token] = fname
-    save_json(public_links, LINKS_FILE)
-    return jsonify({"status": "ok", "url": request.url_root.rstrip("/") + "/public/" + token, "isNew": True})
+    token = create_public_link(fname)
+    return jsonify({"status": "ok", "url": request.url_root.rstrip("/") + "/public/" + token,
+                    "playlist_url": _public_playlist_url(token), "isNew": True})
+
+@bp.route("/link/public/<fname>", methods=["POST"], endpoint="create_public_link_route")
+def create_public_link_route(fname):
+    # Always mints a new link, optionally expiring, alongside any existing ones.
+    if not os.path.exists(os.path.join(RECDIR, fname)):
+        return jsonify({"status": "fail", "error": "File not found"}), 404
 
-@app.route("/link/public/<fname>", methods=["DELETE"], endpoint="delete_public_link")
+    data = request.get_json(silent=True) or {}
+    expires_in = data.get("expires_in")
+    if expires_in is not None:
+        try:
+            expires_in = int(expires_in)
+        except (TypeError, ValueError):
+            return jsonify({"status": "fail", "error": "expires_in must be a number of seconds"}), 400
+        if expires_in <= 0:
+            return jsonify({"status": "fail", "error": "expires_in must be positive"}), 400
+
+    token = create_public_link(fname, expires_in)
+    return jsonify({"status": "ok", "url": request.url_root.rstrip("/") + "/public/" + token,
+                    "playlist_url": _public_playlist_url(token), "token": token, "isNew": True})
+
+@bp.route("/link/public/<fname>/all", endpoint="list_public_links")
+def list_public_links(fname):
+    root = request.url_root.rstrip("/")
+    links = [dict(link, url=f"{root}/public/{link['token']}", playlist_url=_public_playlist_url(link["token"]))
+             for link in links_for(fname)]
+    return jsonify({"status": "ok", "links": links})
+
+@bp.route("/link/public/<fname>", methods=["DELETE"], endpoint="delete_public_link")
 def delete_public_link(fname):
-    global public_links
-    public_links = load_json(LINKS_FILE)
-    removed = False
-    for token, f in list(public_links.items()):
-        if f == fname:
-            del public_links[token]
-            removed = True
-    if removed:
-        save_json(public_links, LINKS_FILE)
+    # ?token=... removes a single link; without it every link to the file goes.
+    if delete_public_links(fname, request.args.get("token")):
         return jsonify({"status": "ok", "message": "Link removed"})
     return jsonify({"status": "fail", "error": "No public link found"}), 404
 
-@app.route("/public/<token>", endpoint="serve_public_file")
+@bp.route("/public/<token>", endpoint="serve_public_file")
 def serve_public_file(token):
-    public_links = load_json(LINKS_FILE)
-    fname = public_links.get(token)
+    fname = resolve_public_link(token)
     if not fname or not os.path.exists(os.path.join(RECDIR, fname)):
         return "❌ Invalid or expired link.", 404
-    return send_from_directory(RECDIR, fname)
+    return send_media(RECDIR, fname)
+
+@bp.route("/public/<token>/hls/<path:asset>", endpoint="serve_public_hls")
+def serve_public_hls(token, asset):
+    fname = resolve_public_link(token)
+    if not fname:
+        return "❌ Invalid or expired link.", 404
+    return serve_hls_asset(fname, asset)
 
-@app.route("/send_email", methods=["POST"], endpoint="send_email_route")
+@bp.route("/send_email", methods=["POST"], endpoint="send_email_route")
 def send_email():
     data = request.get_json()
-    if not app.config.get("MAIL_USERNAME") or not app.config.get("MAIL_PASSWORD"):
+    if not mail_configured():
         return jsonify({"status": "fail", "error": "Mail service is not configured on the server."}), 503
 
     try:
-        msg = Message(
+        outbox_id = queue_mail(
             "GrabScreen recording",
             recipients=[data["to"]],
             body=f"Hi,\n\nHere is your recording:\n{data['url']}\n\nEnjoy!"
         )
-        mail.send(msg)
-        return jsonify({"status": "ok"})
+        return jsonify({"status": "ok", "queued": True, "id": outbox_id})
     except Exception as e:
-        app.logger.error(f"Mail sending failed: {e}")
+        app.logger.error(f"Queueing mail failed: {e}")
         return jsonify({"status": "fail", "error": "Could not send the email."}), 500
 
-@app.route("/debug/files", endpoint="list_debug_files")
+@bp.route("/debug/files", endpoint="list_debug_files")
 def list_files():
     # Allow debug on Render for convenience if RENDER_EXTERNAL_URL is set
     if os.getenv("FLASK_ENV") == "development" or os.getenv("RENDER_EXTERNAL_URL"): 
@@ -453,45 +3475,30 @@ def list_files():
                f"<h2>MP4 Files ({MP4_DIR}):</h2><pre>{'<br>'.join(mp4_files)}</pre>"
     return "Not available in production", 404
 
-@app.route("/delete/<filename>", methods=["POST"], endpoint="delete_file_route")
+@bp.route("/delete/<filename>", methods=["POST"], endpoint="delete_file_route")
 def delete_file(filename):
     if ".." in filename or filename.startswith("/"):
         return jsonify({"status": "fail", "error": "Invalid filename"}), 400
 
     file_path = os.path.join(RECDIR, filename)
-    mp4_file_path = os.path.join(MP4_DIR, filename.replace(".webm", ".mp4"))
-    
+
     if not os.path.abspath(file_path).startswith(os.path.abspath(RECDIR)):
         return jsonify({"status": "fail", "error": "Access denied"}), 403
 
     if not os.path.exists(file_path):
         return jsonify({"status": "fail", "error": "File not found"}), 404
     try:
-        os.remove(file_path)
-        if os.path.exists(mp4_file_path):
-            os.remove(mp4_file_path)
-            app.logger.info(f"Deleted corresponding MP4 file: {mp4_file_path}")
-
-        token = request.cookies.get("magic_token")
-        if token and token in user_sessions and filename in user_sessions[token]:
-            user_sessions[token].remove(filename)
-            save_json(user_sessions, SESSIONS_FILE)
-        
-        global public_links
-        public_links = load_json(LINKS_FILE)
-        for t, f in list(public_links.items()):
-            if f == filename:
-                del public_links[t]
-        save_json(public_links, LINKS_FILE)
+        for path in purge_recording(filename):
+            app.logger.info(f"Deleted {path}")
 
         return jsonify({"status": "ok", "message": f"{filename} deleted"})
     except Exception as e:
         app.logger.error(f"File deletion failed: {e}")
         return jsonify({"status": "fail", "error": "Could not delete the file."}), 500
 
-@app.route("/contact_us", methods=["POST"], endpoint="contact_us_route")
+@bp.route("/contact_us", methods=["POST"], endpoint="contact_us_route")
 def contact_us():
-    if not app.config.get("MAIL_USERNAME") or not app.config.get("MAIL_PASSWORD"):
+    if not mail_configured():
         return jsonify({"status": "fail", "error": "Mail service is not configured on the server."}), 503
 
     data = request.get_json()
@@ -503,16 +3510,15 @@ def contact_us():
         return jsonify({"status": "fail", "error": "Please fill out all fields."}), 400
 
     try:
-        msg = Message(
+        queue_mail(
             subject=f"[GrabScreen Contact] {subject}",
-            recipients=[app.config["MAIL_USERNAME"]], 
+            recipients=[current_app.config["MAIL_USERNAME"]], 
             body=f"You have a new message from: {from_email}\n\n---\n\n{message_body}",
             reply_to=from_email
         )
-        mail.send(msg)
         return jsonify({"status": "ok", "message": "Your message has been sent!"})
     except Exception as e:
-        app.logger.error(f"Contact form mail sending failed: {e}")
+        app.logger.error(f"Contact form mail queueing failed: {e}")
         return jsonify({"status": "fail", "error": "Sorry, an error occurred and the message could not be sent."}), 500
 
 # ... (end of the /contact_us route) ...
@@ -521,7 +3527,7 @@ def contact_us():
 #
 # --- ADD THIS ENTIRE NEW ROUTE ---
 #
-@app.route("/pro-waitlist", methods=["POST"])
+@bp.route("/pro-waitlist", methods=["POST"])
 def pro_waitlist():
     data = request.get_json()
     if not data:
@@ -544,16 +3550,72 @@ def pro_waitlist():
         app.logger.error(f"Failed to write to pro waitlist file: {e}")
         return jsonify({"status": "fail", "error": "Could not save email due to a server error."}), 500
 
+# ─────────────────────────────────────────────────────────
+# Application Factory
+# ─────────────────────────────────────────────────────────
+
+def create_app(config=None):
+    """Builds the Flask app. Cheap and side-effect free; see initialize() for the rest."""
+    flask_app = Flask(__name__)
+
+    flask_app.logger.setLevel(logging.INFO)
+    if not flask_app.logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        flask_app.logger.addHandler(handler)
+
+    flask_app.config.update(
+        # Hostname from your screenshot. For local testing, point these at a
+        # debugging SMTP server instead, e.g.
+        #   python -m aiosmtpd -n -l localhost:1025
+        #   MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_SSL=0 MAIL_USERNAME=test@localhost
+        MAIL_SERVER=os.getenv("MAIL_SERVER", "smtpout.secureserver.net"),
+        # Port from your screenshot
+        MAIL_PORT=int(os.getenv("MAIL_PORT", "465")),
+        # Use SSL for port 465
+        MAIL_USE_SSL=os.getenv("MAIL_USE_SSL", "1") == "1",
+        MAIL_USE_TLS=os.getenv("MAIL_USE_TLS", "0") == "1",
+        # These pull credentials from Render's environment
+        MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
+        MAIL_PASSWORD=os.getenv("MAIL_PASSWORD"),
+        # "From" display on your emails
+        MAIL_DEFAULT_SENDER=("GrabScreen", os.getenv("MAIL_USERNAME")),
+        SECRET_KEY=SECRET_KEY,
+        MAX_CONTENT_LENGTH=MAX_UPLOAD_BYTES,
+        USE_X_SENDFILE=USE_X_SENDFILE,
+    )
+    flask_app.config.update(config or {})
+    mail.init_app(flask_app)
+
+    if TRUSTED_PROXY_HOPS:
+        flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+    flask_app.register_blueprint(bp)
+    return flask_app
+
+app = create_app()
+
 if __name__ == "__main__":
     # This allows us to run specific functions from the command line
     # For example: `python app.py cleanup`
-    import sys
-    
     if len(sys.argv) > 1:
         # If the first argument is 'cleanup', run the cleanup function
         if sys.argv[1] == 'cleanup':
+            # python app.py cleanup [--dry-run] [--reindex]
             with app.app_context():
-                cleanup_old_files()
+                if '--reindex' in sys.argv:
+                    print(json.dumps(reindex_storage(), indent=2))
+                report = cleanup_old_files(dry_run='--dry-run' in sys.argv)
+                if '--dry-run' in sys.argv:
+                    print(json.dumps(report, indent=2))
+        elif sys.argv[1] == 'retention':
+            # python app.py retention <filename> <default|pro|pinned>
+            if len(sys.argv) != 4 or sys.argv[3] not in RETENTION_POLICIES:
+                print(f"Usage: python app.py retention <filename> <{'|'.join(RETENTION_POLICIES)}>")
+            elif not set_retention(sys.argv[2], sys.argv[3]):
+                print(f"No indexed recording named {sys.argv[2]}")
+            else:
+                print(f"{sys.argv[2]} now uses the '{sys.argv[3]}' retention policy")
         else:
             print(f"Unknown command: {sys.argv[1]}")
     else:
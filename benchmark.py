@@ -0,0 +1,531 @@
+"""Benchmarks the server's hot paths offline, against stub ffmpeg/ffprobe binaries.
+
+    python benchmark.py                               # run every scenario, print a table
+    python benchmark.py --requests 500 --concurrency 32 upload clip
+    python benchmark.py --save-baseline bench.json    # record a baseline
+    python benchmark.py --compare bench.json          # exit 1 if anything regressed
+    python benchmark.py --transcode --segments 1,2,4  # MP4 conversion wall clock, real ffmpeg
+    python benchmark.py --startup                     # import, server boot and cleanup CLI times
+
+The app runs in a child process (werkzeug's threaded server, or gunicorn
+with --gunicorn) with RECDIR and DB_FILE in a temp directory and
+FFMPEG_PATH/FFPROBE_PATH pointing at stubs that sleep --ffmpeg-seconds
+and write --ffmpeg-bytes, so results measure this service rather than the
+encoder. Uploads are random bytes (unique unless --duplicate-uploads), which
+is all the stubs need. Only the standard library is used on the client side.
+
+Each scenario reports throughput, p50/p99 latency and errors, plus the
+metadata-store operations and ffmpeg runs per request (diffed from
+/metrics) and the server's RSS, so regressions in the store or subprocess
+paths show up even when latency hides them. Throughput and latency only
+count 2xx responses, so a fast 503 can't pass for a speedup, and --compare
+fails on any rise in the error rate.
+
+--transcode is different: it measures the encoder, so it needs a real
+ffmpeg. It converts one long recording (--transcode-source, or a generated
+VP8/Opus test clip of --transcode-seconds) with the single-process path
+(1 segment) and with the split/encode/concat path, and reports the
+wall-clock speedup, with the host's CPU count next to it. The speedup comes
+from idle cores: on a 1-CPU host a 60s 720p clip took 18.3s, 17.9s and
+18.2s with 1, 2 and 4 segments, which is why the default segment count
+follows FFMPEG_SLOTS (the CPU count). A segment-count vs wall-time table
+from a multi-core host has not been recorded yet; only a 1-CPU host was
+available when this mode was written.
+
+--startup measures cold starts instead: importing app.py, a server
+answering its first request, and `python app.py cleanup --dry-run`, each
+in a fresh process (--startup-runs times, median reported). On the same
+1-CPU host, 5 runs gave medians of 392ms to import, 526ms to the first
+response and 497ms for the cleanup dry run against an empty RECDIR.
+"""
+import argparse, concurrent.futures, http.cookiejar, json, os, re, shutil, socket, statistics, subprocess, sys, tempfile, time, urllib.error, urllib.request, uuid
+
+SCENARIOS = ["upload", "clip", "download_mp4", "public", "session_files", "delete"]
+
+# Compared against a baseline; `higher` means bigger is better. The error
+# rate is checked separately: any increase is a regression.
+COMPARED = {"throughput": {"higher": True}, "p50_ms": {"higher": False}, "p99_ms": {"higher": False},
+            "store_ops_per_request": {"higher": False}, "ffmpeg_runs_per_request": {"higher": False}}
+
+FAKE_FFMPEG = '''\
+#!{python}
+import os, sys, time
+args = sys.argv[1:]
+time.sleep(float(os.environ.get("BENCH_FFMPEG_SECONDS", "0.05")))
+out = args[-1].replace("%v", "0").replace("%05d", "00000")
+os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+with open(out, "wb") as f:
+    f.write(os.urandom(int(os.environ.get("BENCH_FFMPEG_BYTES", "65536"))))
+if "-master_pl_name" in args:
+    root = os.path.dirname(os.path.dirname(out))
+    with open(os.path.join(root, args[args.index("-master_pl_name") + 1]), "w") as f:
+        f.write("#EXTM3U\\nv0/index.m3u8\\n")
+'''
+
+FAKE_FFPROBE = '''\
+#!{python}
+import json, os, sys
+duration = float(os.environ.get("BENCH_MEDIA_SECONDS", "60"))
+if any(arg.startswith("packet=") for arg in sys.argv):
+    for i in range(int(duration * 30)):
+        print(f"{{i / 30:.3f}},0.033,{{'K_' if i % 60 == 0 else '__'}}")
+else:
+    print(json.dumps({{
+        "streams": [{{"index": 0, "codec_type": "video", "codec_name": "vp8", "width": 1280, "height": 720, "r_frame_rate": "30/1"}},
+                    {{"index": 1, "codec_type": "audio", "codec_name": "opus", "sample_rate": "48000", "channels": 2}}],
+        "format": {{"format_name": "matroska,webm", "duration": str(duration), "bit_rate": "1000000"}},
+    }}))
+'''
+
+# ─────────────────────────────────────────────────────────
+# Server
+# ─────────────────────────────────────────────────────────
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _write_stub(path, source):
+    with open(path, "w") as f:
+        f.write(source.format(python=sys.executable))
+    os.chmod(path, 0o755)
+
+def start_server(args, workdir):
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    _write_stub(os.path.join(bindir, "ffmpeg"), FAKE_FFMPEG)
+    _write_stub(os.path.join(bindir, "ffprobe"), FAKE_FFPROBE)
+
+    port = _free_port()
+    env = dict(os.environ,
+               RECDIR=os.path.join(workdir, "recordings"),
+               DB_FILE=os.path.join(workdir, "bench.db"),
+               FFMPEG_PATH=os.path.join(bindir, "ffmpeg"),
+               FFPROBE_PATH=os.path.join(bindir, "ffprobe"),
+               EAGER_PIPELINE=args.pipeline,
+               BENCH_FFMPEG_SECONDS=str(args.ffmpeg_seconds),
+               BENCH_FFMPEG_BYTES=str(args.ffmpeg_bytes),
+               # Measure the service, not the abuse limits.
+               RATE_LIMIT_BURST="1000000000",
+               MAX_QUEUED_JOBS="1000000",
+               FFMPEG_SLOTS=str(max(args.concurrency, os.cpu_count() or 1)),
+               # Every worker's counters current at each scrape.
+               METRICS_FLUSH_SECONDS="0")
+    if args.gunicorn:
+        cmd = ["gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}", "app:app"]
+    else:
+        cmd = [sys.executable, os.path.abspath(__file__), "--serve", str(port)]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"Server exited during startup; see {log.name}")
+        try:
+            urllib.request.urlopen(base + "/metrics", timeout=1).read()
+            return proc, base
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"Server did not start within 30s; see {log.name}")
+
+def serve(port):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from werkzeug.serving import make_server
+    from app import app
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+def server_rss(proc):
+    """(current, peak) resident set size in bytes of the server and its children, from /proc."""
+    pids = [proc.pid]
+    try:
+        # gunicorn workers are children of the arbiter.
+        with open(f"/proc/{proc.pid}/task/{proc.pid}/children") as f:
+            pids += [int(pid) for pid in f.read().split()]
+    except OSError:
+        pass
+    rss = peak = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        rss += int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+        peak += int(status.get("VmHWM", "0 kB").split()[0]) * 1024
+    return rss, peak
+
+# ─────────────────────────────────────────────────────────
+# Client
+# ─────────────────────────────────────────────────────────
+
+class Client:
+    """One simulated browser: keeps the magic_token cookie between requests."""
+
+    def __init__(self, base):
+        self.base = base
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, body=None, headers=None):
+        req = urllib.request.Request(self.base + path, data=body, method=method, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=120) as res:
+                return res.status, res.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def upload(self, data):
+        boundary = uuid.uuid4().hex
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"video\"; filename=\"recording.webm\"\r\n"
+                f"Content-Type: video/webm\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        status, payload = self.request("POST", "/upload", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        return status, json.loads(payload).get("filename") if status == 200 else None
+
+    def post_json(self, path, data):
+        return self.request("POST", path, json.dumps(data).encode(), {"Content-Type": "application/json"})
+
+def _payload(args):
+    if args.duplicate_uploads:
+        return b"\x1a\x45\xdf\xa3" + b"\0" * (args.upload_bytes - 4)
+    # An EBML magic number is all the stubs care about; random bytes keep every upload unique.
+    return b"\x1a\x45\xdf\xa3" + os.urandom(args.upload_bytes - 4)
+
+def prepare(name, args, client, count):
+    """Creates whatever the scenario's requests need and returns one argument per request."""
+    if name == "upload":
+        return [_payload(args) for i in range(count)]
+    # Everything else works on recordings that already exist.
+    source_count = 1 if name in ("clip", "download_mp4", "public", "session_files") else count
+    sources = []
+    for i in range(source_count):
+        status, fname = client.upload(_payload(args))
+        if status != 200:
+            raise SystemExit(f"Setup upload for {name} failed with HTTP {status}")
+        sources.append(fname)
+    if name == "clip":
+        # Distinct ranges, so no request is answered from the clip cache.
+        return [(sources[0], i * 0.001, i * 0.001 + 5) for i in range(count)]
+    if name == "download_mp4":
+        fname = sources[0]
+        deadline = time.time() + 60
+        while client.request("GET", f"/download/mp4/{fname}")[0] != 200:
+            if time.time() > deadline:
+                raise SystemExit("MP4 conversion did not finish during setup")
+            time.sleep(0.1)
+        return [fname] * count
+    if name == "public":
+        status, payload = client.request("GET", f"/link/public/{sources[0]}")
+        token = json.loads(payload)["url"].rsplit("/", 1)[-1]
+        return [token] * count
+    if name == "session_files":
+        for i in range(args.session_size - 1):
+            client.upload(_payload(args))
+        return [None] * count
+    return sources
+
+def run_one(name, client, arg):
+    if name == "upload":
+        return client.upload(arg)[0]
+    if name == "clip":
+        fname, start, end = arg
+        return client.post_json(f"/clip/{fname}", {"start": start, "end": end})[0]
+    if name == "download_mp4":
+        return client.request("GET", f"/download/mp4/{arg}")[0]
+    if name == "public":
+        return client.request("GET", f"/public/{arg}")[0]
+    if name == "session_files":
+        return client.request("GET", "/session/files")[0]
+    if name == "delete":
+        return client.request("POST", f"/delete/{arg}")[0]
+    raise ValueError(name)
+
+METRIC_LINE = re.compile(r'^(grabscreen_store_operations_total|grabscreen_ffmpeg_runs_total)\{[^}]*\} ([0-9.e+-]+)$')
+
+def scrape_counts(base):
+    """Total store operations and ffmpeg runs so far, from /metrics."""
+    text = urllib.request.urlopen(base + "/metrics", timeout=10).read().decode()
+    totals = {"grabscreen_store_operations_total": 0.0, "grabscreen_ffmpeg_runs_total": 0.0}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            totals[match.group(1)] += float(match.group(2))
+    return totals
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def run_scenario(name, args, base, proc):
+    setup_client = Client(base)
+    inputs = prepare(name, args, setup_client, args.requests)
+    # Requests in the same scenario share a session, like one busy user per worker thread.
+    clients = [setup_client if name in ("session_files", "delete") else Client(base) for _ in range(args.concurrency)]
+    before = scrape_counts(base)
+
+    latencies, errors = [], 0   # latencies of 2xx responses only
+    def timed(i, arg):
+        started = time.perf_counter()
+        status = run_one(name, clients[i % len(clients)], arg)
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        for elapsed, status in pool.map(lambda pair: timed(*pair), enumerate(inputs)):
+            if 200 <= status < 300:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+    wall = time.perf_counter() - started
+
+    after = scrape_counts(base)
+    rss, peak = server_rss(proc)
+    n = len(inputs)
+    p50 = p99 = slowest = None
+    if latencies:
+        p50 = round(statistics.median(latencies) * 1000, 2)
+        p99 = round(_percentile(latencies, 0.99) * 1000, 2)
+        slowest = round(max(latencies) * 1000, 2)
+    return {
+        "requests": n,
+        "errors": errors,
+        "error_rate": round(errors / n, 4),
+        "throughput": round(len(latencies) / wall, 2),
+        "p50_ms": p50,
+        "p99_ms": p99,
+        "max_ms": slowest,
+        "store_ops_per_request": round((after["grabscreen_store_operations_total"] - before["grabscreen_store_operations_total"]) / n, 2),
+        "ffmpeg_runs_per_request": round((after["grabscreen_ffmpeg_runs_total"] - before["grabscreen_ffmpeg_runs_total"]) / n, 2),
+        "rss_mb": round(rss / 2 ** 20, 1),
+        "peak_rss_mb": round(peak / 2 ** 20, 1),
+    }
+
+# ─────────────────────────────────────────────────────────
+# Transcoding
+# ─────────────────────────────────────────────────────────
+
+def make_source(ffmpeg, path, seconds):
+    """A VP8/Opus WebM like MediaRecorder's, with a keyframe every 2 seconds."""
+    subprocess.run([ffmpeg, "-y", "-v", "error",
+                    "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                    "-c:v", "libvpx", "-b:v", "2M", "-g", "60", "-deadline", "realtime", "-cpu-used", "8",
+                    "-c:a", "libopus", path], check=True)
+
+def media_duration(ffprobe, path):
+    if not ffprobe:
+        return None
+    result = subprocess.run([ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                            capture_output=True, text=True)
+    try:
+        return round(float(result.stdout), 2)
+    except ValueError:
+        return None
+
+def run_transcode(args):
+    ffmpeg = args.ffmpeg or shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise SystemExit("--transcode needs a real ffmpeg (pass --ffmpeg PATH)")
+    ffprobe = shutil.which("ffprobe", path=os.path.dirname(ffmpeg)) or shutil.which("ffprobe")
+    segment_counts = [int(n) for n in args.segments.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="grabscreen-bench-")
+    os.environ.update(RECDIR=os.path.join(workdir, "recordings"), DB_FILE=os.path.join(workdir, "bench.db"),
+                      FFMPEG_PATH=ffmpeg, FFPROBE_PATH=ffprobe or "ffprobe", EAGER_PIPELINE="",
+                      FFMPEG_SLOTS=str(max(segment_counts) + 1), PARALLEL_TRANSCODE_MIN_SECONDS="0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    with app.app.app_context():
+        app.initialize()
+
+    results = {}
+    try:
+        fname = "benchmark.webm"
+        source = os.path.join(app.RECDIR, fname)
+        if args.transcode_source:
+            shutil.copyfile(args.transcode_source, source)
+        else:
+            make_source(ffmpeg, source, args.transcode_seconds)
+        app.add_recording(fname)
+        source_duration = app.probe_recording(fname)["duration"]    # not part of either path's time
+
+        for count in segment_counts:
+            app.PARALLEL_TRANSCODE_SEGMENTS = count
+            output = app.mp4_path_for(fname)
+            if os.path.exists(output):
+                os.remove(output)
+            started = time.perf_counter()
+            job, _ = app.enqueue_mp4_conversion(fname)
+            while job["state"] in (app.JOB_QUEUED, app.JOB_RUNNING):
+                time.sleep(0.05)
+            wall = time.perf_counter() - started
+            if job["state"] != app.JOB_DONE:
+                raise SystemExit(f"Conversion with {count} segment(s) failed: {job['error']}")
+            results[str(count)] = {"wall_s": round(wall, 2), "bytes": os.path.getsize(output),
+                                   "duration_s": media_duration(ffprobe, output)}
+        single = results[str(segment_counts[0])]["wall_s"]
+        for result in results.values():
+            result["speedup"] = round(single / result["wall_s"], 2)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"source_duration_s": source_duration, "cpus": os.cpu_count(), "results": results}, indent=2))
+    else:
+        print(f"Source: {source_duration}s, {os.cpu_count()} CPU(s)\n")
+        print(f"{'segments':>8}  {'wall s':>8}  {'speedup':>7}  {'output MB':>9}  {'duration s':>10}")
+        for count, result in results.items():
+            print(f"{count:>8}  {result['wall_s']:>8}  {result['speedup']:>7}  {result['bytes'] / 2 ** 20:>9.1f}  {str(result['duration_s']):>10}")
+    return 0
+
+# ─────────────────────────────────────────────────────────
+# Startup
+# ─────────────────────────────────────────────────────────
+
+IMPORT_PROBE = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+
+def run_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = {"import": [], "first_request": [], "cleanup_cli": []}
+    for _ in range(args.startup_runs):
+        workdir = tempfile.mkdtemp(prefix="grabscreen-bench-")
+        try:
+            env = dict(os.environ, RECDIR=os.path.join(workdir, "recordings"), DB_FILE=os.path.join(workdir, "bench.db"))
+            out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], env=env, cwd=here,
+                                 capture_output=True, text=True, check=True).stdout
+            samples["import"].append(float(out.split()[-1]))
+
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "app.py", "cleanup", "--dry-run"], env=env, cwd=here,
+                           capture_output=True, check=True)
+            samples["cleanup_cli"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            proc, _ = start_server(args, workdir)
+            samples["first_request"].append(time.perf_counter() - started)
+            proc.terminate()
+            proc.wait(10)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {name: {"median_ms": round(statistics.median(values) * 1000, 1),
+                      "min_ms": round(min(values) * 1000, 1), "max_ms": round(max(values) * 1000, 1)}
+               for name, values in samples.items()}
+    if args.json:
+        print(json.dumps({"runs": args.startup_runs, "results": results}, indent=2))
+    else:
+        print(f"{'':<14}  {'median ms':>9}  {'min ms':>8}  {'max ms':>8}")
+        for name, result in results.items():
+            print(f"{name:<14}  {result['median_ms']:>9}  {result['min_ms']:>8}  {result['max_ms']:>8}")
+    return 0
+
+# ─────────────────────────────────────────────────────────
+# Reporting
+# ─────────────────────────────────────────────────────────
+
+def print_table(results):
+    columns = ["requests", "errors", "throughput", "p50_ms", "p99_ms", "max_ms",
+               "store_ops_per_request", "ffmpeg_runs_per_request", "rss_mb", "peak_rss_mb"]
+    headers = ["scenario", "reqs", "errors", "req/s", "p50 ms", "p99 ms", "max ms", "store ops/req", "ffmpeg/req", "rss MB", "peak MB"]
+    rows = [[name] + [str(result[c]) for c in columns] for name, result in results.items()]
+    widths = [max(len(row[i]) for row in rows + [headers]) for i in range(len(headers))]
+    for row in [headers] + rows:
+        print("  ".join(cell.rjust(width) if i else cell.ljust(width) for i, (cell, width) in enumerate(zip(row, widths))))
+
+def compare(results, baseline, tolerance):
+    """Prints changes against the baseline and returns the regressions."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if not old:
+            continue
+        before, after = old.get("error_rate", 0), result["error_rate"]
+        flag = "REGRESSION" if after > before else ""
+        print(f"  {name:<14} {'error_rate':<24} {before:>10} -> {after:<10} {'':>7} {flag}")
+        if flag:
+            regressions.append((name, "error_rate"))
+        for metric, rule in COMPARED.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if rule["higher"] else change
+            flag = "REGRESSION" if worse > tolerance else ("improved" if worse < -tolerance else "")
+            print(f"  {name:<14} {metric:<24} {before:>10} -> {after:<10} {change:+7.1%} {flag}")
+            if flag == "REGRESSION":
+                regressions.append((name, metric))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--upload-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--duplicate-uploads", action="store_true", help="upload identical content every time")
+    parser.add_argument("--session-size", type=int, default=50, help="recordings in the session for session_files")
+    parser.add_argument("--ffmpeg-seconds", type=float, default=0.05, help="how long each stub ffmpeg run takes")
+    parser.add_argument("--ffmpeg-bytes", type=int, default=64 * 1024, help="how much each stub ffmpeg run writes")
+    parser.add_argument("--pipeline", default="", help="EAGER_PIPELINE for the server (default: none)")
+    parser.add_argument("--gunicorn", action="store_true", help="serve with gunicorn -c gunicorn.conf.py")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change that counts as a regression")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--transcode", action="store_true", help="benchmark MP4 conversion instead of the server")
+    parser.add_argument("--transcode-source", metavar="WEBM", help="recording to convert (default: a generated test clip)")
+    parser.add_argument("--transcode-seconds", type=int, default=300, help="length of the generated test clip")
+    parser.add_argument("--segments", default=f"1,{os.cpu_count() or 1}", help="segment counts to compare; the first is the reference")
+    parser.add_argument("--ffmpeg", metavar="PATH", help="ffmpeg for --transcode (default: the one in PATH)")
+    parser.add_argument("--startup", action="store_true", help="benchmark cold starts instead of the server")
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve)
+    if args.transcode:
+        return run_transcode(args)
+    if args.startup:
+        return run_startup(args)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="grabscreen-bench-")
+    proc, base = start_server(args, workdir)
+    results = {}
+    try:
+        for name in args.scenarios or SCENARIOS:
+            results[name] = run_scenario(name, args, base, proc)
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("scenarios", "save_baseline", "compare", "json", "serve")}
+    if args.json:
+        print(json.dumps({"config": config, "results": results}, indent=2))
+    else:
+        print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"created": time.time(), "config": config, "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"\nNote: the baseline was recorded with different settings: {baseline.get('config')}")
+        print(f"\nCompared with {args.compare} (tolerance {args.tolerance:.0%}):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s).")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
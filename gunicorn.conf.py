@@ -0,0 +1,69 @@
+# Gunicorn configuration for GrabScreen (used by render.yaml's startCommand).
+#
+# Concurrency model
+# -----------------
+# By default every worker is a gevent worker: each request runs in its own
+# greenlet, and anything that waits on I/O yields to the others. That covers
+# everything slow this app does:
+#   * uploads: request.stream reads from the socket
+#   * media downloads: sendfile/socket writes via send_media()
+#   * SMTP: the outbox sender thread's smtplib connection
+#   * ffmpeg/ffprobe: subprocess waits in run_ffmpeg() and the job workers
+#     (threads become greenlets once gevent has patched the standard library)
+# so one slow viewer or uploader no longer pins a whole worker process.
+#
+# State every worker must agree on is in SQLite: sessions, links, artifacts,
+# probes, the mail outbox, rate limit buckets and jobs. A job row lets any
+# worker report on, join or cancel a conversion, but the job itself runs in
+# the worker that queued it, which polls its row for cancels. ffmpeg slots
+# are flock'ed files under RECDIR/.slots. What remains per-process (job
+# threads and their ffmpeg processes, metrics before they are flushed) is
+# guarded by threading locks, which gevent makes cooperative.
+#
+# Sizing for thousands of concurrent viewers on one instance
+# ----------------------------------------------------------
+#   WEB_CONCURRENCY              worker processes (default: CPU count, max 4)
+#   GUNICORN_WORKER_CONNECTIONS  simultaneous clients per worker (default 1000)
+# Capacity is WEB_CONCURRENCY * GUNICORN_WORKER_CONNECTIONS connections, e.g.
+# 4 * 1000 = 4000. Every connection is a file descriptor, so `ulimit -n` must
+# be above that, plus per worker: ffmpeg pipes, logs, and the SQLite
+# connections, up to 3 fds each (database, -wal, -shm). Each request greenlet
+# needs its own connection; idle ones are pooled (DB_POOL_SIZE per worker,
+# default 16), so only requests beyond that many at once pay for connecting,
+# and job and mail threads keep one each. SQLite calls don't yield to other
+# greenlets: a writer waiting on the lock stalls the whole worker for up to
+# DB_BUSY_TIMEOUT_SECONDS (default 2), so keep write transactions short.
+# CPU-heavy work is bounded separately: FFMPEG_SLOTS ffmpeg processes per
+# host (shared by all workers), TRANSCODE_WORKERS job threads per process.
+# If a front proxy can serve files (MEDIA_ACCEL_REDIRECT_PREFIX), media
+# responses stop occupying a connection here at all.
+#
+# The app is preloaded: the master imports app.py and builds the app once,
+# and workers fork from it sharing that memory copy-on-write. Importing only
+# defines things (directories, the database, the mailer and job threads are
+# all set up on first use in each worker), so nothing is inherited that
+# shouldn't be. GUNICORN_PRELOAD=0 imports in each worker instead.
+#
+# Set GUNICORN_WORKER_CLASS=gthread (with GUNICORN_THREADS) where gevent is
+# unavailable, or =sync to get the old one-request-per-process behaviour.
+import multiprocessing
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+
+if worker_class == "gevent":
+    # Patch before the app is imported, so --preload is safe too.
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))  # only used by gthread workers
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Async workers heartbeat while requests are in flight, so this only has to
+# cover a worker that is genuinely stuck.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
@@ -14,7 +14,16 @@ document.addEventListener("DOMContentLoaded", () => {
     });
   };
   
-  const apiFetch = (url, opts = {}) => fetch(url, opts);
+  // A busy server answers 503 with Retry-After: wait and retry a couple of times before giving up.
+  const apiFetch = async (url, opts = {}, retries = 2) => {
+      const res = await fetch(url, opts);
+      const wait = Number(res.headers.get("Retry-After"));
+      if (res.status === 503 && retries > 0 && wait > 0 && wait <= 10) {
+          await new Promise(resolve => setTimeout(resolve, wait * 1000));
+          return apiFetch(url, opts, retries - 1);
+      }
+      return res;
+  };
   const fullUrl = (f) => `${location.origin}/recordings/${f}`;
   
   // +++ FIX: DEFINED THE HELPER FUNCTION IN A SHARED SCOPE +++
@@ -80,6 +89,57 @@ document.addEventListener("DOMContentLoaded", () => {
   // CORE FUNCTIONS
   // ===================================================================
 
+  // --- Streaming Upload ---
+  // Recordings are uploaded in slices while MediaRecorder is still running
+  // (see UPLOAD_TIMESLICE_MS), so stopping only has to flush the last slice and
+  // finalize. A failed chunk is retried from the server's received offset; if
+  // the chunked API is unavailable we fall back to one multipart POST.
+  const UPLOAD_TIMESLICE_MS = 2000;
+  const createStreamingUpload = () => {
+    const parts = [];
+    let uploadId = null, sent = 0, broken = false;
+    let queue = apiFetch("/upload/init", { method: "POST", headers: {"Content-Type": "application/json"}, body: "{}" })
+      .then(r => r.json())
+      .then(r => { if (r.status === "ok") uploadId = r.upload_id; else broken = true; })
+      .catch(() => { broken = true; });
+
+    const sendPart = async (blob, start) => {
+      for (let attempt = 0; attempt < 5; attempt++) {
+        try {
+          const res = await fetch(`/upload/${uploadId}?offset=${sent}`, { method: "PUT", body: blob.slice(sent - start) });
+          const r = await res.json();
+          if (res.ok) { sent = r.received; return; }
+          if (typeof r.received === "number" && r.received >= start && r.received <= start + blob.size) sent = r.received;
+          else if (res.status !== 500) break;
+        } catch {}
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+      }
+      broken = true;
+    };
+
+    return {
+      push(blob) {
+        if (!blob || !blob.size) return;
+        const start = parts.reduce((n, p) => n + p.size, 0);
+        parts.push(blob);
+        queue = queue.then(() => { if (!broken && uploadId) return sendPart(blob, start); });
+      },
+      async finish() {
+        await queue;
+        const total = parts.reduce((n, p) => n + p.size, 0);
+        if (!broken && uploadId && sent === total) {
+          const res = await apiFetch(`/upload/${uploadId}/finalize`, {
+            method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify({ size: total }),
+          }).then(r => r.json()).catch(() => null);
+          if (res && res.status === "ok") return res;
+        }
+        const fd = new FormData();
+        fd.append("video", new Blob(parts, { type: "video/webm" }), "recording.webm");
+        return apiFetch("/upload", { method: "POST", body: fd }).then(r => r.json());
+      },
+    };
+  };
+
   const showView = (viewName) => {
     recorderView.classList.add("hidden");
     privacyView.classList.add("hidden");
@@ -101,7 +161,12 @@ document.addEventListener("DOMContentLoaded", () => {
     const card = document.createElement("div");
     card.className = "media-card";
     card.dataset.filename = filename;
-    card.innerHTML = `<video src="${fullUrl(filename)}#t=0.1" preload="metadata"></video><p>${filename.substring(10)}</p>`;
+    // A few-KB poster instead of a video element per card; fall back to the
+    // video itself until the server has generated previews.
+    card.innerHTML = `<img src="/previews/${filename}/poster" loading="lazy" alt=""><p>${filename.substring(10)}</p>`;
+    card.querySelector("img").addEventListener("error", (e) => {
+      e.target.outerHTML = `<video src="${fullUrl(filename)}#t=0.1" preload="metadata"></video>`;
+    }, { once: true });
     mediaGrid.prepend(card);
     card.addEventListener("click", () => activateFile(filename));
   };
@@ -123,7 +188,9 @@ document.addEventListener("DOMContentLoaded", () => {
       return;
     }
     currentFile = filename;
-    preview.src = fullUrl(filename); 
+    // Browsers without WebM support (e.g. Safari on iOS) get the HLS rendition instead.
+    const useHls = !preview.canPlayType("video/webm") && preview.canPlayType("application/vnd.apple.mpegurl");
+    preview.src = useHls ? `${location.origin}/hls/${filename}/master.m3u8` : fullUrl(filename);
     previewArea.classList.remove("hidden");
     actionsPanel.innerHTML = `
       <a href="/download/${filename}" class="btn" data-action="download-webm" download><i class="fa-solid fa-download"></i> Download WEBM</a>
@@ -138,8 +205,35 @@ document.addEventListener("DOMContentLoaded", () => {
     previewArea.scrollIntoView({ behavior: 'smooth', block: 'center' });
   };
   
+  // Seek previews: cues from the recording's WebVTT index, each pointing at a
+  // tile of the sprite sheet ("sprite.jpg#xywh=x,y,w,h").
+  let seekCues = [];
+  const loadSeekPreviews = async (filename) => {
+    seekCues = [];
+    try {
+      const res = await fetch(`/previews/${filename}/thumbs.vtt`);
+      if (res.status !== 200) return;  // 202 while previews are still being generated
+      const toSeconds = (ts) => ts.split(":").reduce((acc, part) => acc * 60 + parseFloat(part), 0);
+      const base = `/previews/${filename}/`;
+      seekCues = (await res.text()).split("\n\n").map(block => {
+        const m = block.match(/([\d:.]+) --> ([\d:.]+)\s+(\S+)#xywh=(\d+),(\d+),(\d+),(\d+)/);
+        return m && { start: toSeconds(m[1]), end: toSeconds(m[2]), src: base + m[3], x: +m[4], y: +m[5], w: +m[6], h: +m[7] };
+      }).filter(Boolean);
+    } catch {}
+  };
+  const showSeekPreview = (time) => {
+    const el = $("#trimPreview");
+    const cue = seekCues.find(c => time >= c.start && time < c.end) || seekCues[seekCues.length - 1];
+    if (!el || !cue) return;
+    el.style.width = `${cue.w}px`;
+    el.style.height = `${cue.h}px`;
+    el.style.background = `url(${cue.src}) -${cue.x}px -${cue.y}px`;
+    el.classList.remove("hidden");
+  };
+
   const createSlider = (videoDuration) => {
     if (trimSlider) { trimSlider.destroy(); }
+    loadSeekPreviews(currentFile);
     const startValues = [0, Math.min(10, videoDuration)];
     trimSlider = noUiSlider.create(trimSliderEl, {
       start: startValues, connect: true, range: { min: 0, max: videoDuration }, step: 0.1,
@@ -149,11 +243,32 @@ document.addEventListener("DOMContentLoaded", () => {
       trimStartTime.textContent = formatTime(start);
       trimEndTime.textContent = formatTime(end);
     });
-    trimSlider.on('slide', (values, handle) => { preview.currentTime = parseFloat(values[handle]); });
+    trimSlider.on('slide', (values, handle) => {
+      const t = parseFloat(values[handle]);
+      if (seekCues.length) showSeekPreview(t); else preview.currentTime = t;
+    });
+    trimSlider.on('end', (values, handle) => {
+      $("#trimPreview")?.classList.add("hidden");
+      preview.currentTime = parseFloat(values[handle]);
+    });
     clipPanel.classList.remove("hidden");
     clipPanel.scrollIntoView({ behavior: 'smooth', block: 'center' });
   };
 
+  // MediaRecorder WebMs usually carry no duration header, so the browser
+  // reports Infinity; the server's probe cache knows the real length.
+  const createSliderFromServerInfo = async () => {
+    try {
+      const r = await apiFetch(`/info/${currentFile}`).then(r => r.json());
+      if (r.status === "ok" && r.info.duration > 0) {
+        statusMsg.textContent = "";
+        createSlider(r.info.duration);
+        return;
+      }
+    } catch {}
+    statusMsg.textContent = "❌ Metadata loaded, but the video duration is invalid.";
+  };
+
   const setupTrimSlider = () => {
     statusMsg.textContent = "⏳ Initializing trimmer...";
     if (preview.readyState >= 1 && isFinite(preview.duration) && preview.duration > 0) {
@@ -168,7 +283,7 @@ document.addEventListener("DOMContentLoaded", () => {
       if (isFinite(preview.duration) && preview.duration > 0) {
         createSlider(preview.duration);
       } else {
-        statusMsg.textContent = "❌ Metadata loaded, but the video duration is invalid.";
+        createSliderFromServerInfo();
       }
     };
     preview.addEventListener('loadedmetadata', onMetadataLoaded);
@@ -422,15 +537,13 @@ document.addEventListener("DOMContentLoaded", () => {
       screenStream = await navigator.mediaDevices.getDisplayMedia({ video: { mediaSource: "screen" }, audio: true });
       mediaRecorder = new MediaRecorder(screenStream, { mimeType: "video/webm; codecs=vp8" });
       chunks = [];
-      mediaRecorder.ondataavailable = e => chunks.push(e.data);
+      const upload = createStreamingUpload();
+      mediaRecorder.ondataavailable = e => { chunks.push(e.data); upload.push(e.data); };
 
       mediaRecorder.onstop = async () => {
-      const blob = new Blob(chunks, { type: "video/webm" });
-      const fd = new FormData();
-      fd.append("video", blob, "recording.webm");
       statusMsg.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Uploading & processing...`;
       stopAllStreams(); 
-      const res = await apiFetch("/upload", { method: "POST", body: fd }).then(r => r.json());
+      const res = await upload.finish();
       if (res.status === "ok") {
     
       statusMsg.innerHTML = `
@@ -447,7 +560,7 @@ document.addEventListener("DOMContentLoaded", () => {
       resetRecordingButtons(); 
       };
 
-      mediaRecorder.start();
+      mediaRecorder.start(UPLOAD_TIMESLICE_MS);
       screenStream.getVideoTracks()[0].onended = () => stopBtn.click(); 
       statusMsg.textContent = "🎬 Recording screen only…";
       startBtn.classList.add("hidden");
@@ -478,15 +591,13 @@ document.addEventListener("DOMContentLoaded", () => {
           updateWebcamOverlayStyle();
           mediaRecorder = new MediaRecorder(combinedStream, { mimeType: "video/webm; codecs=vp8" });
           chunks = [];
-          mediaRecorder.ondataavailable = e => chunks.push(e.data);
+          const upload = createStreamingUpload();
+          mediaRecorder.ondataavailable = e => { chunks.push(e.data); upload.push(e.data); };
          
          mediaRecorder.onstop = async () => {
-         const blob = new Blob(chunks, { type: "video/webm" });
-         const fd = new FormData();
-         fd.append("video", blob, "recording.webm");
          statusMsg.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Uploading & processing...`;
          stopAllStreams(); 
-         const res = await apiFetch("/upload", { method: "POST", body: fd }).then(r => r.json());
+         const res = await upload.finish();
          if (res.status === "ok") {
          statusMsg.innerHTML = `
            ✅ Recording saved! 
@@ -502,7 +613,7 @@ document.addEventListener("DOMContentLoaded", () => {
          resetRecordingButtons(); 
          };
 
-          mediaRecorder.start();
+          mediaRecorder.start(UPLOAD_TIMESLICE_MS);
           statusMsg.textContent = "🎬 Recording screen + webcam…";
           screenStream.getVideoTracks()[0].onended = () => stopBtn.click();
           if (webcamStream?.getVideoTracks()[0]) { webcamStream.getVideoTracks()[0].onended = () => stopBtn.click(); }
@@ -534,15 +645,13 @@ document.addEventListener("DOMContentLoaded", () => {
       }
       mediaRecorder = new MediaRecorder(webcamStream, { mimeType: "video/webm; codecs=vp8" });
       chunks = [];
-      mediaRecorder.ondataavailable = e => chunks.push(e.data);
+      const upload = createStreamingUpload();
+      mediaRecorder.ondataavailable = e => { chunks.push(e.data); upload.push(e.data); };
 
       mediaRecorder.onstop = async () => {
-      const blob = new Blob(chunks, { type: "video/webm" });
-      const fd = new FormData();
-      fd.append("video", blob, "recording.webm");
       statusMsg.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Uploading & processing...`;
       stopAllStreams(); 
-      const res = await apiFetch("/upload", { method: "POST", body: fd }).then(r => r.json());
+      const res = await upload.finish();
       if (res.status === "ok") {
          statusMsg.innerHTML = `
       ✅ Recording saved! 
@@ -558,7 +667,7 @@ document.addEventListener("DOMContentLoaded", () => {
       resetRecordingButtons(); 
       };
 
-      mediaRecorder.start();
+      mediaRecorder.start(UPLOAD_TIMESLICE_MS);
       statusMsg.textContent = "🎬 Recording webcam…";
       webcamStream.getTracks().forEach(track => { track.onended = () => stopBtn.click(); });
       startBtn.classList.add("hidden");
@@ -713,26 +822,32 @@ document.addEventListener("DOMContentLoaded", () => {
         mp4Button.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Converting...`;
         statusMsg.textContent = "⏳ Converting to MP4. This might take a moment...";
         try {
-            const downloadUrl = `/download/mp4/${currentFile}`;
-            const response = await fetch(downloadUrl);
-            if (response.ok) {
+            // Conversion runs as a background job on the server: queue it, poll
+            // until it finishes, then let the browser download the cached file.
+            const file = currentFile;
+            let r = await apiFetch(`/convert/mp4/${file}`, { method: "POST" }).then(r => r.json());
+            while (r.status === "ok" && !r.ready && !["failed", "cancelled"].includes(r.job.state)) {
+                await new Promise(resolve => setTimeout(resolve, 1500));
+                const res = await apiFetch(`/jobs/${r.job.id}`);
+                // An unknown job has expired: re-queue (deduplicated).
+                r = res.status === 404
+                    ? await apiFetch(`/convert/mp4/${file}`, { method: "POST" }).then(r => r.json())
+                    : { ...r, ...(await res.json()) };
+            }
+            if (r.status === "ok" && (r.ready || r.job.state === "done")) {
                 trackAction('action_download_mp4_success');
-                const blob = await response.blob();
-                const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.style.display = 'none';
-                a.href = url;
-                a.download = currentFile.replace('.webm', '.mp4');
+                a.href = `/download/mp4/${file}`;
+                a.download = file.replace('.webm', '.mp4');
                 document.body.appendChild(a);
                 a.click();
-                window.URL.revokeObjectURL(url);
                 a.remove();
                 statusMsg.textContent = `✅ MP4 conversion complete! Check your downloads.`;
                 showFeedbackModalIfNeeded();
             } else {
                 trackAction('action_download_mp4_fail');
-                const errorData = await response.json();
-                statusMsg.textContent = `❌ MP4 conversion failed: ${errorData.error || 'Unknown error'}`;
+                statusMsg.textContent = `❌ MP4 conversion failed: ${r.error || r.job?.error || 'Unknown error'}`;
             }
         } catch (error) {
             trackAction('action_download_mp4_fail');
@@ -776,7 +891,7 @@ document.addEventListener("DOMContentLoaded", () => {
       const btn = e.target.closest("button");
       btn.disabled = true; btn.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Cutting...`;
       trackAction('action_clip_success');
-      const r = await apiFetch(`/clip/${currentFile}`, { method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify({ start, end }) }).then(x => x.json());
+      const r = await apiFetch(`/clip/${currentFile}`, { method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify({ start, end, mode: $("#clipPrecise")?.checked ? "precise" : "fast" }) }).then(x => x.json());
       if (r.status === "ok") { addFileToGrid(r.clip); activateFile(r.clip); $("#clipCancel").click(); } else { alert("❌ " + r.error); }
       btn.disabled = false; btn.innerHTML = `<i class="fa-solid fa-share-nodes"></i> Create & Share Clip`;
   });
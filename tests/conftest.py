@@ -0,0 +1,35 @@
+import json, os, sys, tempfile, time
+
+import pytest
+
+# app.py reads its storage paths at import time; keep tests off /var/data.
+_workdir = tempfile.mkdtemp(prefix="grabscreen-tests-")
+os.environ["RECDIR"] = os.path.join(_workdir, "recordings")
+os.environ["DB_FILE"] = os.path.join(_workdir, "grabscreen.db")
+os.environ["EAGER_PIPELINE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as grabscreen  # noqa: E402
+
+@pytest.fixture
+def client():
+    with grabscreen.app.app_context():
+        yield grabscreen.app.test_client()
+
+@pytest.fixture
+def recording():
+    """Writes a recording into RECDIR with its probe already cached, so no ffprobe runs."""
+    def make(fname, duration, keyframes=(0.0,)):
+        os.makedirs(grabscreen.RECDIR, exist_ok=True)
+        path = os.path.join(grabscreen.RECDIR, fname)
+        with open(path, "wb") as f:
+            f.write(os.urandom(1024))
+        st = os.stat(path)
+        info = {"duration": duration, "format": "matroska,webm", "bit_rate": None,
+                "video": {"codec": "vp8", "width": 1280, "height": 720, "fps": 30.0},
+                "audio": None, "keyframes": list(keyframes), "size": st.st_size}
+        with grabscreen.get_db() as db:
+            db.execute("INSERT OR REPLACE INTO probes (filename, size, mtime_ns, probed_at, info) VALUES (?, ?, ?, ?, ?)",
+                       (fname, st.st_size, st.st_mtime_ns, time.time(), json.dumps(info)))
+        return fname
+    return make
@@ -0,0 +1,51 @@
+import io, os
+
+import app as grabscreen
+
+def upload(client, data):
+    response = client.post("/upload", data={"video": (io.BytesIO(data), "video.webm")}, content_type="multipart/form-data")
+    assert response.status_code == 200
+    body = response.get_json()
+    return body["filename"], body["duplicate"]
+
+def test_duplicate_uploads_share_one_blob(client):
+    data = os.urandom(4096)
+    first, first_duplicate = upload(client, data)
+    second, second_duplicate = upload(client, data)
+    assert (first_duplicate, second_duplicate) == (False, True)
+
+    digest = grabscreen.content_hash_for(first)
+    assert grabscreen.content_hash_for(second) == digest
+    assert grabscreen.blob_refcount(digest) == 2
+    blob = os.stat(grabscreen.blob_path(digest))
+    for fname in (first, second):
+        assert os.path.samestat(os.stat(os.path.join(grabscreen.RECDIR, fname)), blob)
+
+def test_the_blob_and_its_derived_files_go_with_the_last_reference(client):
+    data = os.urandom(4096)
+    first, _ = upload(client, data)
+    second, _ = upload(client, data)
+    digest = grabscreen.content_hash_for(first)
+    mp4 = grabscreen.mp4_path_for(first)
+    os.makedirs(os.path.dirname(mp4), exist_ok=True)
+    with open(mp4, "wb") as f:
+        f.write(b"mp4")
+    grabscreen.register_artifact(digest, "mp4", mp4)
+
+    grabscreen.purge_recording(first)
+    assert grabscreen.blob_refcount(digest) == 1
+    assert os.path.exists(grabscreen.blob_path(digest)) and os.path.exists(mp4)
+    with open(os.path.join(grabscreen.RECDIR, second), "rb") as f:
+        assert f.read() == data
+
+    grabscreen.purge_recording(second)
+    assert grabscreen.blob_refcount(digest) == 0
+    assert not os.path.exists(grabscreen.blob_path(digest))
+    assert not os.path.exists(mp4)
+    assert grabscreen.artifacts_for(digest) == []
+
+def test_different_content_is_not_deduplicated(client):
+    first, _ = upload(client, os.urandom(4096))
+    second, duplicate = upload(client, os.urandom(4096))
+    assert not duplicate
+    assert grabscreen.content_hash_for(first) != grabscreen.content_hash_for(second)
@@ -0,0 +1,64 @@
+import os, uuid
+
+import pytest
+
+import app as grabscreen
+
+@pytest.fixture
+def cache(client, monkeypatch):
+    """An empty artifact cache with room for 250 bytes and a settable clock."""
+    with grabscreen.get_db() as db:
+        db.execute("DELETE FROM artifacts")
+    monkeypatch.setattr(grabscreen, "ARTIFACT_CACHE_BYTES", 250)
+    now = [1_000_000.0]
+    monkeypatch.setattr(grabscreen.time, "time", lambda: now[0])
+    return now
+
+def artifact(cache, source=None, size=100):
+    """Registers a derived file of `size` bytes, one clock tick after the last."""
+    cache[0] += 1
+    path = os.path.join(grabscreen.MP4_DIR, "test", f"{uuid.uuid4().hex}.mp4")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    grabscreen.register_artifact(source or uuid.uuid4().hex, "mp4", path)
+    return path
+
+def lookup(cache, path):
+    cache[0] += 1
+    return grabscreen.cache_lookup("unused", "mp4", path)
+
+def test_the_least_recently_used_artifact_goes_first(cache):
+    first, second = artifact(cache), artifact(cache)
+    assert lookup(cache, first)
+    third = artifact(cache)   # 300 bytes: one has to go
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+    assert not grabscreen.is_cached_artifact(second)
+    assert not lookup(cache, second)
+
+def test_lfu_keeps_the_most_requested_artifact(cache, monkeypatch):
+    monkeypatch.setattr(grabscreen, "ARTIFACT_CACHE_POLICY", "lfu")
+    popular, other = artifact(cache), artifact(cache)
+    for _ in range(3):
+        lookup(cache, popular)
+    lookup(cache, other)   # more recent, but requested less
+    artifact(cache)
+    assert os.path.exists(popular)
+    assert not os.path.exists(other)
+
+def test_the_artifact_just_built_is_kept_even_over_budget(cache):
+    big = artifact(cache, size=400)
+    assert os.path.exists(big)
+    assert grabscreen.cache_stats()["bytes"] == 400
+
+def test_artifacts_of_pinned_recordings_are_never_evicted(cache, recording):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 5.0)
+    digest = grabscreen.content_hash_for(fname)   # indexes it
+    assert grabscreen.set_retention(fname, "pinned")
+    pinned = artifact(cache, source=digest, size=200)
+    unpinned = artifact(cache, size=100)
+    assert grabscreen.enforce_cache_budget(budget=0) == 1
+    assert os.path.exists(pinned)
+    assert not os.path.exists(unpinned)
+    assert grabscreen.cache_stats()["evictable_bytes"] == 0
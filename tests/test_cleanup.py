@@ -0,0 +1,84 @@
+import json, os, subprocess, sys, time, uuid
+
+import pytest
+
+import app as grabscreen
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_cli(tmp_path, *args):
+    env = dict(os.environ, RECDIR=str(tmp_path / "recordings"), DB_FILE=str(tmp_path / "grabscreen.db"))
+    return subprocess.run([sys.executable, "app.py", *args], cwd=REPO, env=env, capture_output=True, text=True, timeout=60)
+
+@pytest.mark.parametrize("args", [["cleanup"], ["cleanup", "--dry-run"], ["cleanup", "--reindex"]])
+def test_cleanup_cli_on_a_fresh_deploy(tmp_path, args):
+    # No RECDIR yet: the cron (and benchmark.py --startup) must still exit cleanly.
+    result = run_cli(tmp_path, *args)
+    assert result.returncode == 0, result.stderr
+    assert "Traceback" not in result.stderr
+
+def test_cleanup_cli_dry_run_prints_a_report(tmp_path):
+    result = run_cli(tmp_path, "cleanup", "--dry-run")
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report["dry_run"] is True
+    assert report["recordings"] == []
+
+def stored(retention="default", age=0.0):
+    """A recording in the blob store, created `age` seconds ago."""
+    data = os.urandom(2048)
+    fname = f"{uuid.uuid4().hex}.webm"
+    os.makedirs(grabscreen.UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(grabscreen.UPLOAD_DIR, f"{fname}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    digest = grabscreen.hash_file(tmp_path)
+    grabscreen.store_recording(tmp_path, digest, fname)
+    grabscreen.add_recording(fname, content_hash=digest)
+    with grabscreen.get_db() as db:
+        db.execute("UPDATE recordings SET created = created - ? WHERE filename = ?", (age, fname))
+    grabscreen.set_retention(fname, retention)   # re-derive expires_at from the backdated creation time
+    return fname
+
+def indexed(fname):
+    return grabscreen.get_db().execute("SELECT 1 FROM recordings WHERE filename = ?", (fname,)).fetchone() is not None
+
+@pytest.fixture
+def expired(client):
+    return stored(age=grabscreen.RETENTION_POLICIES["default"] + 60)
+
+def test_dry_run_reports_what_would_go_and_deletes_nothing(client, expired):
+    path = os.path.join(grabscreen.RECDIR, expired)
+    report = grabscreen.cleanup_old_files(dry_run=True)
+    assert expired in report["recordings"]
+    assert report["bytes"] >= 2048
+    assert os.path.exists(path) and indexed(expired)
+
+def test_cleanup_purges_expired_recordings_only(client, expired):
+    fresh = stored()
+    pinned = stored("pinned", age=grabscreen.RETENTION_POLICIES["default"] + 60)
+    digest = grabscreen.content_hash_for(expired)
+
+    report = grabscreen.cleanup_old_files()
+    assert expired in report["recordings"]
+    assert not os.path.exists(os.path.join(grabscreen.RECDIR, expired)) and not indexed(expired)
+    assert not os.path.exists(grabscreen.blob_path(digest))
+    for kept in (fresh, pinned):
+        assert kept not in report["recordings"]
+        assert os.path.exists(os.path.join(grabscreen.RECDIR, kept)) and indexed(kept)
+
+def test_cleanup_removes_abandoned_uploads(client):
+    os.makedirs(grabscreen.UPLOAD_DIR, exist_ok=True)
+    abandoned = os.path.join(grabscreen.UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    in_progress = os.path.join(grabscreen.UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    for path in (abandoned, in_progress):
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+    old = time.time() - grabscreen.UPLOAD_STALE_SECONDS - 60
+    os.utime(abandoned, (old, old))
+
+    report = grabscreen.cleanup_old_files(dry_run=True)
+    assert report["stale_uploads"] >= 1 and os.path.exists(abandoned)
+    grabscreen.cleanup_old_files()
+    assert not os.path.exists(abandoned)
+    assert os.path.exists(in_progress)
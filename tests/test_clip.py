@@ -0,0 +1,50 @@
+import os
+
+import app as grabscreen
+from app import (CLIP_METHOD_COPY, CLIP_METHOD_REENCODE, CLIP_METHOD_SMART, CLIP_MODE_PRECISE,
+                 KEYFRAME_SNAP_SECONDS, plan_clip)
+
+KEYFRAMES = [0.0, 2.0, 4.0, 6.0, 8.0]
+
+def test_start_on_a_keyframe_is_a_stream_copy():
+    assert plan_clip(KEYFRAMES, 4.0, 7.0) == (CLIP_METHOD_COPY, 4.0)
+
+def test_start_just_after_a_keyframe_snaps_back_to_it():
+    assert plan_clip(KEYFRAMES, 4.0 + KEYFRAME_SNAP_SECONDS, 7.0) == (CLIP_METHOD_COPY, 4.0)
+
+def test_start_just_before_a_keyframe_snaps_forward_to_it():
+    assert plan_clip(KEYFRAMES, 4.0 - KEYFRAME_SNAP_SECONDS, 7.0) == (CLIP_METHOD_COPY, 4.0)
+
+def test_start_mid_gop_re_encodes_up_to_the_next_keyframe():
+    assert plan_clip(KEYFRAMES, 3.0, 7.0) == (CLIP_METHOD_SMART, 4.0)
+
+def test_clip_inside_one_gop_is_re_encoded():
+    assert plan_clip(KEYFRAMES, 4.5, 5.5) == (CLIP_METHOD_REENCODE, 4.5)
+
+def test_start_after_the_last_keyframe_is_re_encoded():
+    assert plan_clip(KEYFRAMES, 9.0, 12.0) == (CLIP_METHOD_REENCODE, 9.0)
+
+def test_precise_mode_and_missing_keyframes_re_encode():
+    assert plan_clip(KEYFRAMES, 4.0, 7.0, mode=CLIP_MODE_PRECISE) == (CLIP_METHOD_REENCODE, 4.0)
+    assert plan_clip([], 3.0, 7.0) == (CLIP_METHOD_REENCODE, 3.0)
+
+def test_clip_starting_past_the_end_is_rejected(client, recording):
+    fname = recording("past_end.webm", duration=10.0, keyframes=KEYFRAMES)
+    response = client.post(f"/clip/{fname}", json={"start": 12, "end": 15})
+    assert response.status_code == 400
+    assert "past the end" in response.get_json()["error"]
+
+def test_clip_ending_past_the_end_is_cut_at_the_end(client, recording, monkeypatch):
+    fname = recording("long_end.webm", duration=10.0, keyframes=KEYFRAMES)
+    cuts = []
+
+    def fake_cut_clip(orig, out_path, start, end, mode):
+        cuts.append((start, end))
+        with open(out_path, "wb") as f:
+            f.write(os.urandom(64))
+        return CLIP_METHOD_COPY
+
+    monkeypatch.setattr(grabscreen, "cut_clip", fake_cut_clip)
+    response = client.post(f"/clip/{fname}", json={"start": 8, "end": 30})
+    assert response.status_code == 200, response.get_json()
+    assert cuts == [(8.0, 10.0)]
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import app as grabscreen
+from app import CLIP_METHOD_COPY, CLIP_METHOD_REENCODE, CLIP_MODE_PRECISE, EDIT_MAX_RANGES, plan_edit
+
+def info(keyframes=(0.0, 2.0, 4.0, 6.0, 8.0), width=1280, codec="vp8"):
+    return {"duration": 10.0, "video": {"codec": codec, "width": width, "height": 720},
+            "audio": None, "keyframes": list(keyframes)}
+
+def test_ranges_starting_near_keyframes_are_stream_copied_from_snapped_starts():
+    infos = {"a.webm": info(), "b.webm": info()}
+    ranges = [("a.webm", 2.1, 5.0), ("b.webm", 5.9, 9.0)]
+    assert plan_edit(ranges, infos) == (CLIP_METHOD_COPY, [("a.webm", 2.0, 5.0), ("b.webm", 6.0, 9.0)])
+
+def test_overlapping_ranges_of_one_recording_are_kept_as_given():
+    infos = {"a.webm": info()}
+    ranges = [("a.webm", 0.0, 6.0), ("a.webm", 4.0, 8.0)]
+    assert plan_edit(ranges, infos) == (CLIP_METHOD_COPY, ranges)
+
+def test_one_range_starting_mid_gop_re_encodes_the_whole_edit():
+    infos = {"a.webm": info()}
+    ranges = [("a.webm", 0.0, 3.0), ("a.webm", 5.0, 9.0)]
+    assert plan_edit(ranges, infos) == (CLIP_METHOD_REENCODE, ranges)
+
+def test_sources_with_different_streams_are_re_encoded():
+    infos = {"a.webm": info(), "b.webm": info(width=640)}
+    ranges = [("a.webm", 0.0, 3.0), ("b.webm", 2.0, 4.0)]
+    assert plan_edit(ranges, infos) == (CLIP_METHOD_REENCODE, ranges)
+
+def test_precise_mode_re_encodes():
+    ranges = [("a.webm", 2.0, 4.0)]
+    assert plan_edit(ranges, {"a.webm": info()}, mode=CLIP_MODE_PRECISE) == (CLIP_METHOD_REENCODE, ranges)
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """Replaces the ffmpeg run of /edit; collects the ranges it was asked to render."""
+    calls = []
+
+    def fake_render_edit(ranges, infos, out_path, mode):
+        calls.append(ranges)
+        with open(out_path, "wb") as f:
+            f.write(os.urandom(64))
+        return CLIP_METHOD_COPY
+
+    monkeypatch.setattr(grabscreen, "render_edit", fake_render_edit)
+    return calls
+
+def test_edit_accepts_overlapping_ranges_and_clamps_ends(client, recording, rendered):
+    src = recording("edit_src.webm", duration=10.0)
+    response = client.post("/edit", json={"ranges": [{"source": src, "start": 0, "end": 6},
+                                                     {"source": src, "start": 4, "end": 30}]})
+    assert response.status_code == 200, response.get_json()
+    assert rendered == [[(src, 0.0, 6.0), (src, 4.0, 10.0)]]
+
+@pytest.mark.parametrize("start, end", [(5, 5), (6, 2), (-1, 3), (10, 12), (11, 12)])
+def test_edit_rejects_empty_reversed_negative_and_past_end_ranges(client, recording, rendered, start, end):
+    src = recording("edit_invalid.webm", duration=10.0)
+    response = client.post("/edit", json={"ranges": [{"source": src, "start": start, "end": end}]})
+    assert response.status_code == 400
+    assert "Invalid range" in response.get_json()["error"]
+    assert rendered == []
+
+def test_edit_rejects_no_ranges_and_too_many(client, recording, rendered):
+    src = recording("edit_count.webm", duration=10.0)
+    assert client.post("/edit", json={"ranges": []}).status_code == 400
+    too_many = [{"source": src, "start": 0, "end": 1}] * (EDIT_MAX_RANGES + 1)
+    assert client.post("/edit", json={"ranges": too_many}).status_code == 400
+    assert rendered == []
+
+@pytest.mark.parametrize("source", ["missing.webm", "../edit_src.webm", "edit_src.mp4"])
+def test_edit_rejects_unknown_sources(client, recording, rendered, source):
+    recording("edit_src.webm", duration=10.0)
+    response = client.post("/edit", json={"ranges": [{"source": source, "start": 0, "end": 1}]})
+    assert response.status_code == 404
+    assert rendered == []
+
+def test_edit_rejects_malformed_ranges(client, rendered):
+    assert client.post("/edit", json={"ranges": [{"source": "a.webm", "start": "soon"}]}).status_code == 400
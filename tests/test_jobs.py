@@ -0,0 +1,94 @@
+import fcntl, os, sys, time, uuid
+
+import pytest
+
+import app as grabscreen
+
+def insert_job(state, filename="jobs.webm", kind="mp4", owner="0-gone", error=None):
+    job_id = uuid.uuid4().hex
+    with grabscreen.get_db() as db:
+        db.execute("INSERT INTO jobs (id, kind, filename, state, priority, owner, created, error, finished) "
+                   "VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)",
+                   (job_id, kind, filename, state, owner, time.time(), error,
+                    None if state in (grabscreen.JOB_QUEUED, grabscreen.JOB_RUNNING) else time.time()))
+    return job_id
+
+def test_ready_is_final_for_a_cancelled_job(client):
+    job_id = insert_job(grabscreen.JOB_CANCELLED, error="Cancelled")
+    response = client.get(f"/jobs/{job_id}/ready")
+    assert response.status_code == 410
+    assert response.get_json()["job"]["state"] == "cancelled"
+
+def test_background_jobs_have_their_own_queue_cap(client, monkeypatch):
+    monkeypatch.setattr(grabscreen, "MAX_QUEUED_JOBS", 1)
+    monkeypatch.setattr(grabscreen, "MAX_QUEUED_BACKGROUND_JOBS", 2)
+    owner = grabscreen._job_owner_id()
+    backlog = [insert_job(grabscreen.JOB_QUEUED, filename=f"{uuid.uuid4().hex}.webm", kind="previews", owner=owner)
+               for _ in range(2)]
+    with grabscreen.get_db() as db:
+        db.execute("UPDATE jobs SET priority = ? WHERE id IN (?, ?)", (grabscreen.PRIORITY_BACKGROUND, *backlog))
+    try:
+        # A full pipeline backlog doesn't turn away a request someone waits on...
+        job, created = grabscreen.enqueue_job("mp4", f"{uuid.uuid4().hex}.webm", lambda f: None)
+        assert created
+        # ...but does stop more background work.
+        with pytest.raises(grabscreen.Overloaded):
+            grabscreen.enqueue_job("previews", f"{uuid.uuid4().hex}.webm", lambda f: None,
+                                   priority=grabscreen.PRIORITY_BACKGROUND)
+    finally:
+        with grabscreen.get_db() as db:
+            db.execute("DELETE FROM jobs WHERE id IN (?, ?)", backlog)
+
+@pytest.fixture
+def other_worker():
+    """The owner id of another live worker process: its lock file is flock'ed."""
+    owner = f"99999-{uuid.uuid4().hex[:8]}"
+    os.makedirs(grabscreen.JOB_OWNER_DIR, exist_ok=True)
+    with open(os.path.join(grabscreen.JOB_OWNER_DIR, f"{owner}.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield owner
+
+def wait_for(job_id, states, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = grabscreen.get_job(job_id)
+        if job["state"] in states:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} is still {job['state']}")
+
+def test_a_job_queued_by_another_worker_is_joined(client, other_worker):
+    fname = f"{uuid.uuid4().hex}.webm"
+    job_id = insert_job(grabscreen.JOB_QUEUED, filename=fname, owner=other_worker)
+    job, created = grabscreen.enqueue_job("mp4", fname, lambda f: None)
+    assert (job["id"], created) == (job_id, False)
+    count = grabscreen.get_db().execute("SELECT COUNT(*) FROM jobs WHERE filename = ?", (fname,)).fetchone()[0]
+    assert count == 1
+
+def test_a_job_left_by_a_dead_worker_is_failed_and_not_joined(client):
+    fname = f"{uuid.uuid4().hex}.webm"
+    lost = insert_job(grabscreen.JOB_RUNNING, filename=fname, owner="99999-deadbeef")
+    job, created = grabscreen.enqueue_job("mp4", fname, lambda f: None)
+    assert created and job["id"] != lost
+    assert grabscreen.get_job(lost)["state"] == grabscreen.JOB_FAILED
+    assert grabscreen.get_job(lost)["error"] == grabscreen.JOB_LOST_ERROR
+
+def test_a_cancel_from_another_worker_stops_the_running_ffmpeg(client):
+    fname = f"{uuid.uuid4().hex}.webm"
+    sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+    job, _ = grabscreen.enqueue_job("mp4", fname, lambda f: grabscreen.run_ffmpeg(sleeper, slot=False))
+    wait_for(job["id"], [grabscreen.JOB_RUNNING])
+    started = time.time()
+    # What cancel_jobs_for() in another worker does: it can only reach the row.
+    with grabscreen.get_db() as db:
+        db.execute("UPDATE jobs SET state = ?, error = 'Cancelled', finished = ? WHERE id = ?",
+                   (grabscreen.JOB_CANCELLED, time.time(), job["id"]))
+    deadline = time.time() + 10
+    while not job["finished"] and time.time() < deadline:
+        time.sleep(0.05)
+    # The worker running it noticed within JOB_CANCEL_POLL_SECONDS and killed
+    # ffmpeg, rather than letting it run for 30s.
+    assert job["state"] == grabscreen.JOB_CANCELLED
+    assert not job["processes"]
+    assert time.time() - started < 5
+    assert grabscreen.get_job(job["id"])["state"] == grabscreen.JOB_CANCELLED
@@ -0,0 +1,34 @@
+import email.utils, os, uuid
+
+import pytest
+
+import app as grabscreen
+
+@pytest.fixture
+def accel(monkeypatch):
+    monkeypatch.setattr(grabscreen, "MEDIA_ACCEL_REDIRECT_PREFIX", "/protected")
+
+def test_accel_redirect_hands_the_file_to_nginx(client, recording, accel):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 5.0)
+    response = client.get(f"/download/{fname}")
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == f"/protected/{fname}"
+    assert response.headers["ETag"]
+
+def test_accel_redirect_answers_revalidation_itself(client, recording, accel):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 5.0)
+    etag = client.get(f"/download/{fname}").headers["ETag"]
+    response = client.get(f"/download/{fname}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert "X-Accel-Redirect" not in response.headers
+
+    mtime = os.stat(os.path.join(grabscreen.RECDIR, fname)).st_mtime
+    response = client.get(f"/download/{fname}", headers={"If-Modified-Since": email.utils.formatdate(mtime + 60, usegmt=True)})
+    assert response.status_code == 304
+    assert "X-Accel-Redirect" not in response.headers
+
+def test_accel_redirect_leaves_ranges_to_nginx(client, recording, accel):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 5.0)
+    response = client.get(f"/download/{fname}", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == f"/protected/{fname}"
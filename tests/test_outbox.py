@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import app as grabscreen
+
+@pytest.fixture
+def outbox(client, monkeypatch):
+    """An empty outbox with no sender thread, a settable clock and no jitter."""
+    with grabscreen.get_db() as db:
+        db.execute("DELETE FROM outbox")
+    monkeypatch.setattr(grabscreen, "_ensure_outbox_sender", lambda flask_app: None)
+    monkeypatch.setattr(grabscreen.random, "uniform", lambda a, b: 1.0)
+    now = [1_000_000.0]
+    monkeypatch.setattr(grabscreen.time, "time", lambda: now[0])
+    return now
+
+def fail_once(outbox_id):
+    (row,) = grabscreen._claim_outbox_batch()
+    assert row["id"] == outbox_id
+    grabscreen._mark_failed(row, "Connection refused")
+
+def next_attempt(outbox_id):
+    return grabscreen.get_db().execute("SELECT next_attempt_at FROM outbox WHERE id = ?", (outbox_id,)).fetchone()[0]
+
+def test_a_claimed_message_is_not_claimed_again(outbox):
+    outbox_id = grabscreen.queue_mail("Hi", ["a@example.com"], "body")
+    (row,) = grabscreen._claim_outbox_batch()
+    assert json.loads(row["message"])["subject"] == "Hi"
+    assert grabscreen._claim_outbox_batch() == []   # e.g. another worker's sender
+    # A sender that died mid-send gives it up once the claim runs out.
+    outbox[0] += grabscreen.MAIL_CLAIM_SECONDS + 1
+    assert [r["id"] for r in grabscreen._claim_outbox_batch()] == [outbox_id]
+
+def test_failures_back_off_exponentially_up_to_the_cap(outbox):
+    outbox_id = grabscreen.queue_mail("Hi", ["a@example.com"], "body")
+    delays = []
+    for _ in range(grabscreen.MAIL_MAX_ATTEMPTS - 1):
+        fail_once(outbox_id)
+        delay = next_attempt(outbox_id) - outbox[0]
+        delays.append(delay)
+        outbox[0] += delay - 1
+        assert grabscreen._claim_outbox_batch() == []   # not due yet
+        outbox[0] += 1
+    expected = [min(grabscreen.MAIL_RETRY_MAX_SECONDS, grabscreen.MAIL_RETRY_BASE_SECONDS * 2 ** i)
+                for i in range(grabscreen.MAIL_MAX_ATTEMPTS - 1)]
+    assert delays == expected
+    status = grabscreen.outbox_status(outbox_id)
+    assert (status["state"], status["attempts"], status["last_error"]) == ("pending", len(expected), "Connection refused")
+
+def test_a_message_is_given_up_after_the_last_attempt(outbox, monkeypatch):
+    monkeypatch.setattr(grabscreen, "MAIL_MAX_ATTEMPTS", 2)
+    outbox_id = grabscreen.queue_mail("Hi", ["a@example.com"], "body")
+    fail_once(outbox_id)
+    outbox[0] = next_attempt(outbox_id)
+    fail_once(outbox_id)
+    assert grabscreen.outbox_status(outbox_id)["state"] == "failed"
+    outbox[0] += grabscreen.MAIL_RETRY_MAX_SECONDS
+    assert grabscreen._claim_outbox_batch() == []
+
+def test_sent_mail_is_kept_for_a_while_then_purged(outbox):
+    outbox_id = grabscreen.queue_mail("Hi", ["a@example.com"], "body")
+    grabscreen._claim_outbox_batch()
+    grabscreen._mark_sent(outbox_id)
+    assert grabscreen.outbox_status(outbox_id)["state"] == "sent"
+    assert grabscreen.purge_sent_mail() == 0
+    outbox[0] += grabscreen.MAIL_SENT_RETENTION_SECONDS + 1
+    assert grabscreen.purge_sent_mail() == 1
+    assert grabscreen.outbox_status(outbox_id) is None
@@ -0,0 +1,35 @@
+import time, uuid
+
+import pytest
+
+import app as grabscreen
+
+@pytest.fixture
+def queued(monkeypatch):
+    calls = []
+    monkeypatch.setattr(grabscreen, "enqueue_job", lambda kind, fname, func, priority=0: calls.append((kind, fname, priority)))
+    monkeypatch.setattr(grabscreen, "RATE_LIMIT_BURST", 2.0)
+    return calls
+
+def test_missing_previews_are_built_as_background_work(client, recording, queued):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 10.0)
+    response = client.get(f"/previews/{fname}/poster")
+    assert response.status_code == 202
+    assert queued == [("previews", fname, grabscreen.PRIORITY_BACKGROUND)]
+
+def test_a_page_of_posters_is_rate_limited(client, recording, queued):
+    addr = {"REMOTE_ADDR": f"10.9.{uuid.uuid4().int % 250}.1"}
+    codes = [client.get(f"/previews/{recording(f'{uuid.uuid4().hex}.webm', 10.0)}/poster", environ_base=addr).status_code
+             for _ in range(4)]
+    assert codes == [202, 202, 429, 429]
+    assert len(queued) == 2
+
+def test_a_recent_failure_is_not_retried(client, recording, queued):
+    fname = recording(f"{uuid.uuid4().hex}.webm", 10.0)
+    with grabscreen.get_db() as db:
+        db.execute("INSERT INTO jobs (id, kind, filename, state, priority, owner, created, error, finished) "
+                   "VALUES (?, 'previews', ?, ?, 10, '0-gone', ?, 'Video conversion failed', ?)",
+                   (uuid.uuid4().hex, fname, grabscreen.JOB_FAILED, time.time(), time.time()))
+    response = client.get(f"/previews/{fname}/poster")
+    assert response.status_code == 404
+    assert queued == []
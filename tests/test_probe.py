@@ -0,0 +1,22 @@
+import json, subprocess
+
+import app as grabscreen
+
+STREAMS = {"streams": [{"index": 0, "codec_type": "video", "codec_name": "vp8", "width": 1280, "height": 720,
+                        "r_frame_rate": "30/1"}],
+           "format": {"format_name": "matroska,webm"}}
+
+def test_probe_reads_keyframes_and_end_from_packet_csv(monkeypatch):
+    runs = []
+    def fake_run(cmd, timeout=None, slot=True, op=None):
+        runs.append((cmd, slot))
+        out = "0.000000,0.033000,K_\n0.033000,0.033000,__\nN/A,N/A,__\n2.000000,0.033000,K_\n" \
+            if "csv=p=0" in cmd else json.dumps(STREAMS)
+        return subprocess.CompletedProcess(cmd, 0, out, "")
+    monkeypatch.setattr(grabscreen, "run_ffmpeg", fake_run)
+
+    info = grabscreen._run_ffprobe("/nowhere/x.webm")
+    assert info["keyframes"] == [0.0, 2.0]
+    assert info["duration"] == 2.033   # MediaRecorder files have no container duration
+    assert info["video"]["codec"] == "vp8"
+    assert all(slot for _, slot in runs)   # the packet pass reads the whole file; it waits its turn
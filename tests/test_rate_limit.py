@@ -0,0 +1,49 @@
+import uuid
+
+import pytest
+
+import app as grabscreen
+from app import take_rate_token
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A settable time.time(), with a bucket of 3 tokens refilling at 1 per second."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(grabscreen.time, "time", lambda: now[0])
+    monkeypatch.setattr(grabscreen, "RATE_LIMIT_BURST", 3.0)
+    monkeypatch.setattr(grabscreen, "RATE_LIMIT_PER_MINUTE", 60.0)
+    return now
+
+def drain(key):
+    """Takes tokens until refused. Returns (tokens taken, seconds to wait)."""
+    taken = 0
+    while True:
+        retry_after = take_rate_token(key)
+        if retry_after:
+            return taken, retry_after
+        taken += 1
+
+def test_a_new_key_gets_the_full_burst(clock):
+    assert drain(f"test:{uuid.uuid4()}") == (3, 1)
+
+def test_tokens_refill_at_the_configured_rate(clock):
+    key = f"test:{uuid.uuid4()}"
+    drain(key)
+    clock[0] += 0.5
+    assert take_rate_token(key) == 1
+    clock[0] += 0.5
+    assert take_rate_token(key) == 0
+    assert take_rate_token(key) == 1
+    clock[0] += 2
+    assert drain(key)[0] == 2
+
+def test_refill_stops_at_the_burst_size(clock):
+    key = f"test:{uuid.uuid4()}"
+    drain(key)
+    clock[0] += 3600
+    assert drain(key)[0] == 3
+
+def test_keys_have_separate_buckets(clock):
+    first, second = f"test:{uuid.uuid4()}", f"test:{uuid.uuid4()}"
+    drain(first)
+    assert take_rate_token(second) == 0
@@ -0,0 +1,29 @@
+from app import MIN_SEGMENT_SECONDS, plan_segments
+
+EVERY_2S = [float(t) for t in range(0, 120, 2)]
+
+def test_cuts_land_on_the_keyframes_nearest_equal_parts():
+    assert plan_segments(EVERY_2S, 120.0, 4) == [30.0, 60.0, 90.0]
+
+def test_cuts_snap_to_the_closest_keyframe():
+    keyframes = [0.0, 25.0, 33.0, 58.0, 64.0, 100.0]
+    assert plan_segments(keyframes, 120.0, 4) == [33.0, 58.0, 100.0]
+
+def test_one_segment_or_a_short_recording_is_not_split():
+    assert plan_segments(EVERY_2S, 120.0, 1) == []
+    assert plan_segments(EVERY_2S, 2 * MIN_SEGMENT_SECONDS - 1, 4) == []
+
+def test_segment_count_is_capped_by_the_minimum_length():
+    cuts = plan_segments(EVERY_2S, 3.5 * MIN_SEGMENT_SECONDS, 8)
+    assert len(cuts) == 2
+    bounds = [0.0] + cuts + [3.5 * MIN_SEGMENT_SECONDS]
+    assert all(b - a >= MIN_SEGMENT_SECONDS for a, b in zip(bounds, bounds[1:]))
+
+def test_cuts_that_would_leave_a_short_segment_are_dropped():
+    # The only keyframe near the middle is too close to the end to cut at.
+    keyframes = [0.0, 55.0]
+    assert plan_segments(keyframes, 60.0, 2) == []
+
+def test_no_keyframes_means_no_cuts():
+    assert plan_segments([], 120.0, 4) == []
+    assert plan_segments([0.0], 120.0, 4) == []
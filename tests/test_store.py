@@ -0,0 +1,19 @@
+import app as grabscreen
+
+def test_requests_hand_their_connection_back(client):
+    grabscreen.release_db()
+    client.get("/jobs/unknown")
+    pooled = {id(conn) for conn in grabscreen._db_pool}
+    assert pooled
+    for _ in range(3):
+        client.get("/jobs/unknown")
+        assert {id(conn) for conn in grabscreen._db_pool} == pooled   # reused, not reconnected
+
+def test_an_open_transaction_is_not_handed_on(client):
+    grabscreen.release_db()
+    db = grabscreen.get_db()
+    db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('pool-test', '1')")
+    assert db.in_transaction
+    grabscreen.release_db()
+    assert not db.in_transaction
+    assert grabscreen.get_db().execute("SELECT 1 FROM meta WHERE key = 'pool-test'").fetchone() is None
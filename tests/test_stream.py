@@ -0,0 +1,45 @@
+import subprocess, sys
+
+import pytest
+
+import app as grabscreen
+
+ENDLESS = [sys.executable, "-c", "import sys\nwhile True: sys.stdout.buffer.write(b'x' * 65536)"]
+
+@pytest.fixture
+def one_slot(monkeypatch):
+    monkeypatch.setattr(grabscreen, "FFMPEG_SLOTS", 1)
+    monkeypatch.setattr(grabscreen, "STREAM_IDLE_TIMEOUT_SECONDS", 0.5)
+
+def test_a_stalled_stream_gives_its_slot_back(client, one_slot):
+    chunks = grabscreen.stream_ffmpeg(ENDLESS, op="test_stream")
+    next(chunks)
+    # The client stops reading: the generator is never resumed.
+    slot = grabscreen.acquire_ffmpeg_slot(wait=5)
+    assert slot is not None
+    grabscreen.release_ffmpeg_slot(slot)
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(chunks)
+
+def test_a_stream_read_to_the_end_releases_its_slot_once(client, one_slot):
+    chunks = grabscreen.stream_ffmpeg([sys.executable, "-c", "print('done')"], op="test_stream")
+    assert b"".join(chunks) == b"done\n"
+    slot = grabscreen.acquire_ffmpeg_slot(wait=0)
+    assert slot is not None
+    grabscreen.release_ffmpeg_slot(slot)
+
+def test_a_failed_remux_falls_back_to_a_regular_conversion(client, recording, monkeypatch, tmp_path):
+    fname = recording("remux.webm", 10.0)
+    frag_path = tmp_path / "stream.frag.mp4"
+    frag_path.write_bytes(b"not really mp4")
+    queued, converted = [], []
+    monkeypatch.setattr(grabscreen, "enqueue_job", lambda kind, filename, func, **kw: (queued.append(func), (None, True))[1])
+    def broken_remux(cmd, **kw):
+        raise subprocess.CalledProcessError(1, cmd, stderr="Invalid data found when processing input")
+    monkeypatch.setattr(grabscreen, "run_ffmpeg", broken_remux)
+    monkeypatch.setattr(grabscreen, "convert_to_mp4", converted.append)
+
+    assert grabscreen._finish_streamed_mp4(fname, str(frag_path))
+    queued[0](fname)
+    assert converted == [fname]
+    assert not frag_path.exists()
@@ -0,0 +1,105 @@
+import hashlib, os
+
+import app as grabscreen
+
+def start_upload(client, size=None):
+    response = client.post("/upload/init", json={"size": size} if size else {})
+    assert response.status_code == 200
+    return response.get_json()["upload_id"]
+
+def put(client, upload_id, data, offset=None):
+    url = f"/upload/{upload_id}" + (f"?offset={offset}" if offset is not None else "")
+    return client.put(url, data=data)
+
+def test_finalize_forgets_the_upload_hasher(client):
+    upload_id = start_upload(client)
+    put(client, upload_id, b"a" * 100)
+    assert upload_id in grabscreen._upload_hashers
+    assert client.post(f"/upload/{upload_id}/finalize", json={"size": 100}).status_code == 200
+    assert upload_id not in grabscreen._upload_hashers
+
+def test_abandoned_upload_hashers_are_dropped(client, monkeypatch):
+    abandoned = start_upload(client)
+    put(client, abandoned, b"a" * 100)
+    hasher, hashed, _ = grabscreen._upload_hashers[abandoned]
+    grabscreen._upload_hashers[abandoned] = (hasher, hashed, 0.0)   # last used long ago
+
+    active = start_upload(client)
+    put(client, active, b"b" * 100)
+    assert abandoned not in grabscreen._upload_hashers
+    assert active in grabscreen._upload_hashers
+
+    monkeypatch.setattr(grabscreen, "UPLOAD_HASHERS_MAX", 1)
+    newest = start_upload(client)
+    put(client, newest, b"c" * 100)
+    assert list(grabscreen._upload_hashers) == [newest]
+
+def finalize(client, upload_id, size):
+    return client.post(f"/upload/{upload_id}/finalize", json={"size": size})
+
+def stored_bytes(fname):
+    with open(os.path.join(grabscreen.RECDIR, fname), "rb") as f:
+        return f.read()
+
+def test_an_interrupted_upload_resumes_from_the_received_offset(client):
+    data = os.urandom(3000)
+    upload_id = start_upload(client, size=len(data))
+    assert put(client, upload_id, data[:1000], offset=0).get_json()["received"] == 1000
+    # The client lost track of the upload: ask where to continue.
+    status = client.get(f"/upload/{upload_id}").get_json()
+    assert (status["received"], status["size"]) == (1000, 3000)
+    assert put(client, upload_id, data[1000:], offset=status["received"]).get_json()["received"] == 3000
+
+    response = finalize(client, upload_id, len(data))
+    assert response.status_code == 200
+    fname = response.get_json()["filename"]
+    assert stored_bytes(fname) == data
+    assert grabscreen.content_hash_for(fname) == hashlib.sha256(data).hexdigest()
+
+def test_a_gap_is_refused_with_the_offset_to_resume_from(client):
+    upload_id = start_upload(client)
+    put(client, upload_id, b"a" * 100, offset=0)
+    response = put(client, upload_id, b"b" * 100, offset=150)
+    assert response.status_code == 409
+    assert response.get_json()["received"] == 100
+    assert put(client, upload_id, b"c", offset=-1).status_code == 409
+    assert put(client, upload_id, b"c", offset="x").status_code == 400
+
+def test_chunks_past_the_declared_size_are_refused(client):
+    upload_id = start_upload(client, size=100)
+    response = put(client, upload_id, b"a" * 101, offset=0)
+    assert response.status_code == 413
+    assert response.get_json()["received"] == 0
+
+def test_finalize_refuses_an_incomplete_upload(client):
+    upload_id = start_upload(client, size=200)
+    put(client, upload_id, b"a" * 100, offset=0)
+    response = finalize(client, upload_id, 200)
+    assert response.status_code == 409
+    assert response.get_json()["received"] == 100
+
+def test_a_retried_chunk_keeps_the_streamed_hash_right(client, monkeypatch):
+    data = os.urandom(3000)
+    upload_id = start_upload(client)
+    put(client, upload_id, data[:2000], offset=0)
+    # The response to the second chunk was lost; it is sent again, overlapping.
+    put(client, upload_id, data[1000:2000], offset=1000)
+    put(client, upload_id, data[2000:], offset=2000)
+    _, hashed, _ = grabscreen._upload_hashers[upload_id]
+    assert hashed == 3000
+
+    # The streamed digest is used as is: finalize doesn't read the file again.
+    monkeypatch.setattr(grabscreen, "hash_file", lambda path: "not used")
+    response = finalize(client, upload_id, len(data))
+    assert grabscreen.content_hash_for(response.get_json()["filename"]) == hashlib.sha256(data).hexdigest()
+
+def test_a_resume_on_another_worker_hashes_the_file_at_finalize(client):
+    data = os.urandom(3000)
+    upload_id = start_upload(client)
+    put(client, upload_id, data[:1000], offset=0)
+    grabscreen._upload_hashers.clear()   # the rest arrives at a worker that never saw the start
+    put(client, upload_id, data[1000:], offset=1000)
+    assert upload_id not in grabscreen._upload_hashers
+
+    response = finalize(client, upload_id, len(data))
+    assert grabscreen.content_hash_for(response.get_json()["filename"]) == hashlib.sha256(data).hexdigest()